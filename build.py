@@ -20,4 +20,5 @@ def set_properties(project):
     project.depends_on('pony')
     project.depends_on('PyJWT')
     project.depends_on('docopt')
+    project.depends_on('requests')
     project.set_property('coverage_exceptions', ['beehaiv.server'])
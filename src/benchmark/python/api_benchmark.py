@@ -0,0 +1,405 @@
+"""
+Usage:
+    api_benchmark.py [options]
+
+Measures throughput and p50/p99 latency of the API for trial ingestion,
+trial listings, state reads and writes and authentication. Every scenario
+runs in-process through falcon's test client and over HTTP against a
+local threaded WSGI server. The database is a temporary SQLite file with
+the tuned storage profile, filled with synthetic trials.
+
+Options:
+    -n N, --requests=N
+        Requests per scenario. Listings of many rows send fewer requests,
+        at least 3. Default: 500
+    -c N, --clients=N
+        Number of concurrent clients. Default: 4
+    --rows=SIZES
+        Comma separated numbers of trials for the listing scenarios, up to
+        10000000. Default: 1000,10000,100000
+    --transport=TRANSPORT
+        inprocess, wsgi or both. Default: both
+    --scenarios=NAMES
+        Comma separated scenarios to run. Default: all of them
+    -o FILE, --output=FILE
+        Write the results as JSON to FILE.
+    --baseline=FILE
+        JSON results of an earlier run. Exit with status 1 if a scenario
+        lost more than the tolerance in throughput or p99 latency, or
+        had more failed requests.
+
+Runs also exit with status 1 if a scenario misses its latency target, e.g.
+a batch of 10000 trials must be stored in under a second.
+    --tolerance=FRACTION
+        Allowed regression against the baseline. Default: 0.2
+"""
+import json
+import os
+import platform
+import random
+import socketserver
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, \
+    make_server
+
+import hug
+import requests
+from docopt import docopt
+from falcon.testing import TestClient
+from pony import orm
+
+from beehaiv import api, crypto, metrics, storage
+
+VARIABLE_NAMES = ['contrast', 'condition', 'response', 'rt']
+BATCH_SIZE = 100
+BULK_SIZE = 10000
+WARMUP = 5
+# p99 latency goals per scenario in ms
+TARGETS_MS = {'ingest_10k': 1000}
+
+
+def synthetic_trial(rng):
+    return {'contrast': round(rng.random(), 4),
+            'condition': rng.choice(['easy', 'hard']),
+            'response': rng.randint(0, 1),
+            'rt': round(rng.lognormvariate(-0.7, 0.3), 3)}
+
+
+def generate_trials(filename, exp_id, observer_id, rows, seed=1,
+                    chunk_size=100000):
+    """Insert synthetic trials with plain SQL, much faster than Pony"""
+    rng = random.Random(seed)
+    connection = sqlite3.connect(filename)
+    try:
+        for start in range(0, rows, chunk_size):
+            connection.executemany(
+                'INSERT INTO "Trial" ("experiment", "observer", "data", '
+                '"seq") VALUES (?, ?, ?, ?)',
+                ((exp_id, observer_id,
+                  json.dumps([synthetic_trial(rng)[name]
+                              for name in VARIABLE_NAMES]),
+                  seq + 1)
+                 for seq in range(start, min(start + chunk_size, rows))))
+            connection.commit()
+        connection.execute('UPDATE "Experiment" SET "version" = ? '
+                           'WHERE "id" = ?', (rows, exp_id))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def setup(row_counts):
+    filename = os.path.join(tempfile.mkdtemp(), 'beehaiv.sqlite')
+    storage.use_sqlite_pragmas(api.db, storage.sqlite_pragmas())
+    storage.bind(api.db, 'sqlite:///' + filename)
+    metrics.instrument(api.db)
+    api.db.generate_mapping(create_tables=True)
+    with orm.db_session():
+        admin = api.User(username='admin',
+                         password=crypto.hash_password('password'),
+                         isadmin=True)
+        observer = api.User(username='observer',
+                            password=crypto.hash_password('password'))
+        ingest = api.Experiment(owner=admin, name='ingest',
+                                variable_names=','.join(VARIABLE_NAMES))
+        listings = {rows: api.Experiment(
+            owner=admin, name='listing-{}'.format(rows),
+            variable_names=','.join(VARIABLE_NAMES))
+            for rows in row_counts}
+        api.State(observer=observer, experiment=ingest,
+                  state_json=json.dumps({'contrast': 0.5, 'step': 0}))
+    for rows, expr in listings.items():
+        generate_trials(filename, expr.id, admin.id, rows)
+    return {
+        'ingest': ingest.id,
+        'listings': {rows: expr.id for rows, expr in listings.items()},
+        'observer': observer.id,
+        'basic': crypto.get_basic_token('observer', 'password'),
+        'observer_token': crypto.create_token(observer.id).decode('ascii'),
+        'admin_token': crypto.create_token(admin.id).decode('ascii'),
+    }
+
+
+def scenarios(fixture, row_counts, n):
+    """name -> (requests, trials per request, request factory)"""
+    rng = random.Random(2)
+    basic = {'Authorization': fixture['basic']}
+    observer = {'Authorization': fixture['observer_token']}
+    admin = {'Authorization': fixture['admin_token']}
+    trials = '/v1/experiments/{}/trials/'.format(fixture['ingest'])
+    state = '/v1/experiments/{}/state/'.format(fixture['ingest'])
+    json_body = {'Content-Type': 'application/json'}
+
+    def post_trial(i):
+        return ('POST', trials, None, dict(basic, **json_body),
+                json.dumps(synthetic_trial(rng)))
+
+    def post_batch(i):
+        return ('POST', trials, None, dict(basic, **json_body),
+                json.dumps([synthetic_trial(rng)
+                            for _ in range(BATCH_SIZE)]))
+
+    def post_bulk(i):
+        return ('POST', trials, None, dict(basic, **json_body),
+                json.dumps([synthetic_trial(rng)
+                            for _ in range(BULK_SIZE)]))
+
+    def get_state(i):
+        return 'GET', state, None, observer, None
+
+    def put_state(i):
+        return ('PUT', state, None, dict(observer, **json_body),
+                json.dumps({'state': {'contrast': rng.random(), 'step': i}}))
+
+    def get_token(i):
+        return 'GET', '/v1/token/', None, basic, None
+
+    def get_user(i):
+        return ('GET', '/v1/users/{}/'.format(fixture['observer']), None,
+                observer, None)
+
+    result = {'ingest': (n, 1, post_trial),
+              'ingest_batch': (n, BATCH_SIZE, post_batch),
+              'ingest_10k': (min(n, 20), BULK_SIZE, post_bulk),
+              'state_read': (n, 0, get_state),
+              'state_write': (n, 0, put_state),
+              'auth_basic': (n, 0, get_token),
+              'auth_token': (n, 0, get_user)}
+    for rows in row_counts:
+        path = '/v1/experiments/{}/trials/'.format(
+            fixture['listings'][rows])
+        result['listing_{}'.format(rows)] = (
+            min(n, max(3, n * 1000 // rows)), rows,
+            lambda i, path=path: ('GET', path, {'stream': 'json'}, admin,
+                                  None))
+    return result
+
+
+class InProcess(object):
+    name = 'inprocess'
+
+    def __init__(self):
+        self.client = TestClient(hug.API(api).http.server())
+
+    def session(self):
+        return self
+
+    def request(self, method, path, params, headers, body):
+        result = self.client.simulate_request(
+            method, path, params=params, headers=headers, body=body)
+        return result.status_code, len(result.content)
+
+    def close(self):
+        pass
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class Session(object):
+
+    def __init__(self, url):
+        self.url = url
+        self.session = requests.Session()
+
+    def request(self, method, path, params, headers, body):
+        response = self.session.request(method, self.url + path,
+                                        params=params, headers=headers,
+                                        data=body)
+        return response.status_code, len(response.content)
+
+
+class Wsgi(object):
+    name = 'wsgi'
+
+    def __init__(self):
+        self.server = make_server('127.0.0.1', 0,
+                                  hug.API(api).http.server(),
+                                  server_class=ThreadingWSGIServer,
+                                  handler_class=QuietHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def session(self):
+        return Session(self.url)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def percentile(timings, fraction):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1,
+                       int(round(fraction * (len(ordered) - 1))))]
+
+
+def run(transport, count, factory, clients):
+    """Send count requests from concurrent clients, return the statistics
+
+    A few warm-up requests are sent first and not counted.
+    """
+    timings = []
+    errors = []
+    received = []
+    lock = threading.Lock()
+    counter = iter(range(count))
+
+    # Fill caches and open connections before timing
+    session = transport.session()
+    for i in range(min(WARMUP, count)):
+        session.request(*factory(i))
+
+    def client():
+        session = transport.session()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            method, path, params, headers, body = factory(i)
+            start = time.perf_counter()
+            status, size = session.request(method, path, params, headers,
+                                           body)
+            elapsed = time.perf_counter() - start
+            with lock:
+                timings.append(elapsed)
+                received.append(size)
+                if not 200 <= status < 300:
+                    errors.append(status)
+
+    threads = [threading.Thread(target=client)
+               for _ in range(min(clients, count))]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    return {'requests': count,
+            'seconds': seconds,
+            'requests_per_second': count / seconds,
+            'p50_ms': 1000 * percentile(timings, 0.5),
+            'p99_ms': 1000 * percentile(timings, 0.99),
+            'bytes_received': sum(received),
+            'errors': len(errors)}
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            check=True).stdout.decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def regressions(results, baseline, tolerance):
+    previous = {(result['scenario'], result['transport']): result
+                for result in baseline['results']}
+    for result in results:
+        before = previous.get((result['scenario'], result['transport']))
+        if before is None:
+            continue
+        if result['requests_per_second'] < \
+                (1 - tolerance) * before['requests_per_second']:
+            yield '{scenario} ({transport}): {requests_per_second:.1f} ' \
+                'requests/s'.format(**result) + \
+                ', was {:.1f}'.format(before['requests_per_second'])
+        if result['p99_ms'] > (1 + tolerance) * before['p99_ms']:
+            yield '{scenario} ({transport}): p99 {p99_ms:.2f} ms'.format(
+                **result) + ', was {:.2f}'.format(before['p99_ms'])
+        # Requests that fail fast would otherwise pass as faster
+        if result['errors'] > before.get('errors', 0):
+            yield '{scenario} ({transport}): {errors} errors'.format(
+                **result) + ', was {}'.format(before.get('errors', 0))
+
+
+def missed_targets(results):
+    for result in results:
+        target = TARGETS_MS.get(result['scenario'])
+        if target is not None and result['p99_ms'] > target:
+            yield '{scenario} ({transport}): p99 {p99_ms:.2f} ms'.format(
+                **result) + ', target is {} ms'.format(target)
+
+
+def report(result):
+    print('{scenario:16} | {transport:9} | {requests_per_second:9.1f} '
+          'req/s | {trials_per_second:11.0f} trials/s | '
+          'p50 {p50_ms:9.2f} ms | p99 {p99_ms:9.2f} ms | '
+          '{errors} errors'.format(**result))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    n = int(args['--requests'] or 500)
+    clients = int(args['--clients'] or 4)
+    row_counts = [int(rows) for rows in
+                  (args['--rows'] or '1000,10000,100000').split(',')]
+    transports = {'inprocess': [InProcess],
+                  'wsgi': [Wsgi],
+                  'both': [InProcess, Wsgi]}[args['--transport'] or 'both']
+    tolerance = float(args['--tolerance'] or 0.2)
+
+    start = time.perf_counter()
+    fixture = setup(row_counts)
+    print('Generated {} trials in {:.1f} s'.format(
+        sum(row_counts), time.perf_counter() - start))
+    available = scenarios(fixture, row_counts, n)
+    names = args['--scenarios'].split(',') if args['--scenarios'] \
+        else list(available)
+
+    results = []
+    for transport_class in transports:
+        transport = transport_class()
+        try:
+            for name in names:
+                count, trials, factory = available[name]
+                result = dict(scenario=name, transport=transport.name,
+                              clients=clients,
+                              **run(transport, count, factory, clients))
+                result['trials_per_second'] = \
+                    trials * result['requests_per_second']
+                results.append(result)
+                report(result)
+        finally:
+            transport.close()
+
+    output = {'revision': git_revision(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'sqlite': sqlite3.sqlite_version,
+              'results': results}
+    if args['--output']:
+        with open(args['--output'], 'w') as f:
+            json.dump(output, f, indent=2)
+
+    failed = False
+    for line in missed_targets(results):
+        print('Target missed: ' + line)
+        failed = True
+    if args['--baseline']:
+        with open(args['--baseline']) as f:
+            for line in regressions(results, json.load(f), tolerance):
+                print('Regression: ' + line)
+                failed = True
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,66 @@
+"""
+Usage:
+    auth_benchmark.py [options]
+
+Measures what basic-auth costs per request, with and without the cache of
+verified credentials.
+
+Options:
+    -n N, --requests=N
+        Number of requests per measurement. Default: 200
+"""
+import time
+import statistics
+
+import hug
+from docopt import docopt
+from falcon.testing import TestClient
+from pony import orm
+
+from beehaiv import api, crypto
+
+
+def setup():
+    api.db.bind(provider='sqlite', filename=':memory:')
+    api.db.generate_mapping(create_tables=True)
+    with orm.db_session():
+        api.User(username='observer',
+                 password=crypto.hash_password('password'))
+    return {'Authorization': crypto.get_basic_token('observer', 'password')}
+
+
+def measure(function, n, cached):
+    timings = []
+    for _ in range(n):
+        if not cached:
+            crypto.credentials.clear()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(name, timings):
+    print('{:28} | {:9.3f} ms | {:9.3f} ms'.format(
+        name,
+        1000 * statistics.median(timings),
+        1000 * max(timings)))
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    n = int(args['--requests'] or 200)
+    headers = setup()
+
+    def verify():
+        assert crypto.verify_user('observer', 'password')
+
+    client = TestClient(hug.API(api).http.server())
+
+    def request():
+        assert client.simulate_get('/v1/token/', headers=headers).json
+
+    print('{:28} | {:>12} | {:>12}'.format('', 'median', 'max'))
+    for name, function in [('verify_user', verify), ('GET /token/', request)]:
+        report(name + ' without cache', measure(function, n, False))
+        report(name + ' with cache', measure(function, n, True))
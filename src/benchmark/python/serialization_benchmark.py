@@ -0,0 +1,64 @@
+"""
+Usage:
+    serialization_benchmark.py [options]
+
+Measures serialization time and bytes on the wire for a trial listing,
+for the stdlib JSON encoder, the fast encoder and every available
+compression.
+
+Options:
+    -n N, --trials=N
+        Number of trials in the listing. Default: 1000000
+"""
+import gzip
+import json
+import random
+import time
+
+from docopt import docopt
+
+from beehaiv import encoding
+
+
+def trials(n):
+    rng = random.Random(1)
+    return [{'id': i + 1,
+             'experiment': 1,
+             'observer': rng.randint(1, 20),
+             'contrast': round(rng.random(), 4),
+             'condition': rng.choice(['easy', 'hard']),
+             'response': rng.randint(0, 1)}
+            for i in range(n)]
+
+
+def measure(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def report(name, seconds, size):
+    print('{:22} | {:9.3f} s | {:9.1f} MiB'.format(
+        name, seconds, size / 2 ** 20))
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    listing = trials(int(args['--trials'] or 1000000))
+
+    data, seconds = measure(
+        lambda: json.dumps(listing).encode('utf8'))
+    report('json', seconds, len(data))
+    data, seconds = measure(encoding.dumps, listing)
+    report('orjson' if encoding.orjson else 'json (fallback)',
+           seconds, len(data))
+
+    for encoding_ in sorted(encoding.available_encodings()):
+        compressed, seconds = measure(encoding.compress, data, encoding_)
+        report('  + ' + encoding_, seconds, len(compressed))
+    compressed, seconds = measure(
+        lambda: b''.join(encoding.compress_chunks(
+            [data[i:i + 2 ** 16] for i in range(0, len(data), 2 ** 16)],
+            'gzip')))
+    report('  + gzip, streamed', seconds, len(compressed))
+    assert gzip.decompress(compressed) == data
@@ -0,0 +1,90 @@
+"""
+Usage:
+    storage_benchmark.py [options]
+
+Measures trial POSTs per second from concurrent clients against an SQLite
+file, once with SQLite defaults and once with the tuned storage profile.
+Only successful POSTs count; failed ones (e.g. "database is locked") are
+reported separately and make the run exit with status 1.
+
+Options:
+    -n N, --requests=N
+        Number of trial POSTs per client. Default: 200
+    -c N, --clients=N
+        Number of concurrent clients. Default: 8
+    --profile=PROFILE
+        Only run with this BEEHAIV_SQLITE_PROFILE and print the result as
+        JSON.
+"""
+import json
+import os
+import sys
+import subprocess
+import tempfile
+import threading
+import time
+
+import hug
+from docopt import docopt
+from falcon.testing import TestClient
+from pony import orm
+
+from beehaiv import api, crypto, storage
+
+
+def run(requests, clients):
+    directory = tempfile.mkdtemp()
+    storage.use_sqlite_pragmas(api.db, storage.sqlite_pragmas())
+    api.db.bind(provider='sqlite',
+                filename=os.path.join(directory, 'beehaiv.sqlite'),
+                create_db=True)
+    api.db.generate_mapping(create_tables=True)
+    with orm.db_session():
+        user = api.User(username='observer', password='password')
+        expr = api.Experiment(owner=user, name='benchmark',
+                              variable_names='stimulus,response')
+    headers = {'Authorization': crypto.get_basic_token('observer',
+                                                       'password')}
+    client = TestClient(hug.API(api).http.server())
+    url = '/v1/experiments/{}/trials/'.format(expr.id)
+
+    errors = []
+
+    def post():
+        for i in range(requests):
+            result = client.simulate_post(url, headers=headers,
+                                          json={'stimulus': i, 'response': 1})
+            if not 200 <= result.status_code < 300:
+                errors.append(result.status_code)
+
+    threads = [threading.Thread(target=post) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    return {'trials_per_second': (requests * clients - len(errors)) / seconds,
+            'errors': len(errors)}
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    requests = int(args['--requests'] or 200)
+    clients = int(args['--clients'] or 8)
+    if args['--profile']:
+        print(json.dumps(run(requests, clients)))
+        sys.exit()
+
+    errors = 0
+    for profile in ['default', 'tuned']:
+        result = json.loads(subprocess.run(
+            [sys.executable, __file__, '--profile', profile,
+             '-n', str(requests), '-c', str(clients)],
+            env=dict(os.environ, BEEHAIV_SQLITE_PROFILE=profile),
+            stdout=subprocess.PIPE, check=True).stdout)
+        print('{:8} | {trials_per_second:8.0f} trials/s | {errors} failed '
+              'requests'.format(profile, **result))
+        errors += result['errors']
+    if errors:
+        sys.exit(1)
@@ -1,14 +1,39 @@
 import hug
 from pony import orm
 import json
+import math
+import os
+import queue
 import falcon
 
+from .cache import TTLCache
 from .models import db, Experiment, Trial, User, State
-from . import crypto
+from . import crypto, encoding, events, export, ingest, metrics, models, \
+    patch, streaming
 
-basic_auth = hug.http(requires=hug.authentication.basic(crypto.verify_user))
-token_auth = hug.http(requires=hug.authentication.token(crypto.verify_token))
-admin_auth = hug.http(requires=hug.authentication.token(crypto.verify_admin))
+basic_check = hug.authentication.basic(
+    metrics.phase('auth')(crypto.verify_user))
+token_check = hug.authentication.token(
+    metrics.phase('auth')(crypto.verify_token))
+
+
+def observer_check(request, response, **kwargs):
+    """Basic HTTP Authentication or an access token"""
+    header = request.get_header('Authorization')
+    if isinstance(header, bytes):
+        header = header.decode('latin-1')
+    if header is None or header.lower().startswith('basic '):
+        return basic_check(request, response, **kwargs)
+    return token_check(request, response, **kwargs)
+
+
+basic_auth = hug.http(requires=basic_check)
+token_auth = hug.http(requires=token_check)
+observer_auth = hug.http(requires=observer_check)
+admin_auth = hug.http(requires=hug.authentication.token(
+    metrics.phase('auth')(crypto.verify_admin)))
+refresh_auth = hug.http(requires=hug.authentication.token(
+    metrics.phase('auth')(crypto.verify_refresh_token)))
 
 
 @hug.exception()
@@ -19,26 +44,35 @@ def handle_exceptions(exception):
         raise falcon.HTTPConflict()
     elif isinstance(exception, orm.CacheIndexError):
         raise falcon.HTTPConflict()
+    elif isinstance(exception, models.KeyConflict):
+        raise falcon.HTTPConflict(description=str(exception))
     elif isinstance(exception, KeyError):
         raise falcon.HTTPBadRequest()
     else:
         raise exception
 
 
+@hug.request_middleware()
+def start_timer(request, response):
+    if metrics.timing_requests():
+        metrics.begin(request)
+
+
 @hug.response_middleware()
 def CORS(request, response, resource):
     response.set_header('Access-Control-Allow-Origin', '*')
     response.set_header('Access-Control-Allow-Methods',
-                        'GET, POST, PUT, OPTIONS')
+                        'GET, POST, PUT, PATCH, OPTIONS')
     response.set_header(
         'Access-Control-Allow-Headers',
         'Authorization,Keep-Alive,User-Agent,'
-        'If-Modified-Since,Cache-Control,Content-Type'
+        'If-Modified-Since,If-None-Match,If-Match,Idempotency-Key,'
+        'Cache-Control,Content-Type'
     )
     response.set_header(
         'Access-Control-Expose-Headers',
         'Authorization,Keep-Alive,User-Agent,'
-        'If-Modified-Since,Cache-Control,Content-Type'
+        'If-Modified-Since,Cache-Control,Content-Type,ETag'
     )
     if request.method == 'OPTIONS':
         response.set_header('Access-Control-Max-Age', '1728000')
@@ -47,14 +81,230 @@ def CORS(request, response, resource):
         response.status_code = hug.HTTP_204
 
 
+@hug.response_middleware()
+def compress(request, response, resource):
+    if response.get_header('Content-Encoding') or not encoding.compressible(
+            response.content_type):
+        return
+    response.append_header('Vary', 'Accept-Encoding')
+    encoding_ = encoding.negotiate(request.get_header('Accept-Encoding'))
+    if encoding_ is None:
+        return
+    if response.stream is not None:
+        response.stream = streaming.Stream(
+            encoding.compress_chunks(iter(response.stream.read, b''),
+                                     encoding_))
+    elif response.data is not None and len(response.data) >= \
+            encoding.MIN_SIZE:
+        response.data = encoding.compress(response.data, encoding_)
+    else:
+        return
+    response.set_header('Content-Encoding', encoding_)
+
+
+@hug.response_middleware()
+def record_timing(request, response, resource):
+    """Per route latency, phase and query metrics"""
+    timer = metrics.end()
+    if timer is None:
+        return
+    if metrics.SERVER_TIMING:
+        response.set_header('Server-Timing', metrics.server_timing(timer))
+    if metrics.ENABLED:
+        route = request.uri_template if resource is not None else 'unmatched'
+        metrics.registry.observe(request.method, route, response.status[:3],
+                                 timer)
+    metrics.check_budget(timer)
+
+
+@hug.format.content_type('application/json; charset=utf-8')
+def json_output(content, request=None, response=None, **kwargs):
+    """JSON output through the fast encoder"""
+    if hasattr(content, 'read'):
+        return content
+    if isinstance(content, encoding.RawJSON):
+        return bytes(content)
+    with metrics.phase('serialize'):
+        return encoding.dumps(content,
+                              default=hug.output_format._json_converter)
+
+
+@hug.format.content_type(metrics.CONTENT_TYPE)
+def prometheus_text(content, request=None, response=None, **kwargs):
+    return content
+
+
+def json_input(body, charset='utf-8', **kwargs):
+    try:
+        return encoding.loads(hug.input_format.text(body, charset))
+    except ValueError:
+        raise falcon.HTTPBadRequest(description='Malformed JSON')
+
+
+def ndjson(body, charset='utf-8', **kwargs):
+    """Newline delimited JSON, one document per line"""
+    try:
+        return [encoding.loads(line)
+                for line in hug.input_format.text(body, charset).splitlines()
+                if line.strip()]
+    except ValueError:
+        raise falcon.HTTPBadRequest(description='Malformed JSON')
+
+
+hug.API(__name__).http.output_format = json_output
+hug.API(__name__).http.set_input_format('application/json', json_input)
+hug.API(__name__).http.set_input_format('application/x-ndjson', ndjson)
+hug.API(__name__).http.set_input_format(patch.MERGE_PATCH, json_input)
+hug.API(__name__).http.set_input_format(patch.JSON_PATCH, json_input)
+
+
+def is_finite(value):
+    """False for JSON values that contain a NaN or infinite number"""
+    if isinstance(value, float):
+        return math.isfinite(value)
+    if isinstance(value, dict):
+        return all(map(is_finite, value.values()))
+    if isinstance(value, list):
+        return all(map(is_finite, value))
+    return True
+
+
+def encode_trial(variable_names, body):
+    if not isinstance(body, dict):
+        raise falcon.HTTPBadRequest()
+    body = dict(body)
+    data = [body.pop(key) for key in variable_names]
+    if len(body) or not is_finite(data):
+        raise falcon.HTTPBadRequest()
+    return data
+
+
+KEY_FIELD = '_key'
+KEY_CACHE_SIZE = int(os.getenv('BEEHAIV_IDEMPOTENCY_CACHE_SIZE', '10000'))
+KEY_CACHE_TTL = float(os.getenv('BEEHAIV_IDEMPOTENCY_CACHE_TTL', '600'))
+
+# (experiment id, observer id, idempotency key) -> (trial id, posted trial)
+# of committed trials
+trial_keys = TTLCache(KEY_CACHE_SIZE, KEY_CACHE_TTL)
+
+
+def idempotency_keys(request, items, is_list):
+    """Per trial keys from a _key field or the Idempotency-Key header"""
+    header = request.get_header('Idempotency-Key')
+    keys = []
+    for index, item in enumerate(items):
+        key = item.get(KEY_FIELD) if isinstance(item, dict) else None
+        if key is None and header:
+            key = '{}:{}'.format(header, index) if is_list else header
+        if key is not None and not (isinstance(key, str) and
+                                    0 < len(key) <= 128):
+            raise falcon.HTTPBadRequest()
+        keys.append(key)
+    return keys
+
+
+def without_key(item):
+    if isinstance(item, dict) and KEY_FIELD in item:
+        item = dict(item)
+        del item[KEY_FIELD]
+    return item
+
+
+def publish_trials(exp_id, trials):
+    """Push committed trials to live subscribers of the experiment"""
+    if events.hub.has_subscribers(exp_id):
+        events.hub.publish(exp_id, [(trial.seq, trial.summary())
+                                    for trial in trials])
+
+
+def etag_matches(header, etag):
+    # All tags are weak, since compression re-encodes the bodies. They
+    # still change with every version, so If-Match compares them too.
+    tags = {tag.strip().replace('W/', '', 1) for tag in header.split(',')}
+    return '*' in tags or etag.replace('W/', '', 1) in tags
+
+
+def not_modified(request, response, etag):
+    """Set the ETag and answer 304 if the client has the current version"""
+    response.set_header('ETag', etag)
+    response.set_header('Cache-Control', 'private, no-cache')
+    header = request.get_header('If-None-Match')
+    if header is not None and etag_matches(header, etag):
+        response.status = falcon.HTTP_304
+        return True
+    return False
+
+
+def check_precondition(request, etag):
+    header = request.get_header('If-Match')
+    if header is not None and not etag_matches(header, etag):
+        raise falcon.HTTPPreconditionFailed()
+
+
+def experiment_etag(expr):
+    return 'W/"{}-{}"'.format(expr.id, expr.version)
+
+
+def trial_etag(trial):
+    return 'W/"t{}-{}"'.format(trial.id, trial.seq)
+
+
+def state_etag(state):
+    return 'W/"s{}-{}"'.format(state.id, state.version)
+
+
+def locked_experiment(exp_id):
+    """Load an experiment whose change sequence is about to be bumped"""
+    expr = Experiment.get_for_update(id=exp_id)
+    if expr is None:
+        raise falcon.HTTPNotFound()
+    return expr
+
+
+TRIAL_FIELDS = ['id', 'experiment', 'observer']
+TRIAL_PARAMETERS = {'after_id', 'before_id', 'limit', 'observer', 'fields',
+                    'stream', 'group_by', 'values', 'stats', 'quantiles',
+                    'format'}
+OPERATORS = {'eq', 'ne', 'lt', 'lte', 'gt', 'gte'}
+
+comma_separated = hug.types.delimited_list(',')
+non_negative = hug.types.greater_than(-1)
+
+
+def query_value(value):
+    """Numbers as int or float, everything else including nan as str"""
+    for type_ in (int, float):
+        try:
+            number = type_(value)
+        except ValueError:
+            continue
+        if math.isfinite(number):
+            return number
+    return value
+
+
+def data_predicates(variable_names, params):
+    """Parse ?variable=value and ?variable__operator=value parameters"""
+    where = []
+    for key, values in params.items():
+        name, _, operator = key.rpartition('__')
+        if name not in variable_names or operator not in OPERATORS:
+            name, operator = key, 'eq'
+            if name not in variable_names or key in TRIAL_PARAMETERS:
+                continue
+        if not isinstance(values, list):
+            values = [values]
+        where.extend((variable_names.index(name), operator, query_value(value))
+                     for value in values)
+    return where
+
+
 # End point /experiments/
 
 @admin_auth.get('/experiments/', versions=1)
 def get_all_experiments():
     with orm.db_session():
-        owners_experiments = orm.select(e for e in Experiment)
-        return [expr.summary()
-                for expr in owners_experiments]
+        return Experiment.all_summaries()
 
 
 @admin_auth.post('/experiments/', versions=1)
@@ -71,61 +321,130 @@ def post_experiments(body, response, user: hug.directives.user):
 
 
 @admin_auth.get('/experiments/{exp_id}/', versions=1)
-def get_experiments(exp_id: int, response):
+def get_experiments(exp_id: int, request, response):
     with orm.db_session():
-        return Experiment[exp_id].summary()
+        expr = Experiment[exp_id]
+        if not_modified(request, response, experiment_etag(expr)):
+            return
+        return expr.summary()
 
 
 @admin_auth.put('/experiments/{exp_id}/', versions=1)
 def put_experiments(exp_id: int, body, response):
     with orm.db_session():
-        expr = Experiment[exp_id]
+        expr = locked_experiment(exp_id)
         if 'name' in body:
             expr.name = body['name']
         if 'owner' in body:
             expr.owner = User[body['owner']]
+        expr.version += 1
         return expr.summary()
 
 
 # End point /experiments/<id>/trials/
 @admin_auth.get('/experiments/{exp_id}/trials/', versions=1)
-def get_all_experiments_trials(exp_id: int, response, request):
+def get_all_experiments_trials(exp_id: int,
+                               response,
+                               request,
+                               after_id: hug.types.number = 0,
+                               before_id: hug.types.number = None,
+                               limit: non_negative = None,
+                               observer: hug.types.number = None,
+                               fields: comma_separated = None,
+                               stream: hug.types.one_of(('ndjson',
+                                                         'json')) = None):
     with orm.db_session():
         expr = Experiment[exp_id]
-        trials = (trial.summary() for trial in expr.trials)
-        return json.dumps(list(trials))
-
-
-@basic_auth.post('/experiments/{exp_id}/trials/', versions=1)
+        variable_names = expr.variable_names.split(',')
+        if fields is not None and not set(fields).issubset(
+                TRIAL_FIELDS + variable_names):
+            raise falcon.HTTPBadRequest()
+        filters = {'before_id': before_id,
+                   'observer': observer,
+                   'where': data_predicates(variable_names, request.params)}
+        if not_modified(request, response, experiment_etag(expr)):
+            return
+        if stream is None:
+            trials = expr.select_trials(after_id, **filters)
+            if limit is not None:
+                trials = trials.limit(limit)
+            return expr.trial_summaries(trials, fields)
+
+    batches = streaming.trial_batches(exp_id, after_id, limit,
+                                      fields=fields, **filters)
+    if stream == 'ndjson':
+        response.content_type = 'application/x-ndjson'
+        return streaming.Stream(streaming.ndjson_lines(batches))
+    return streaming.Stream(streaming.json_array(batches))
+
+
+@observer_auth.post('/experiments/{exp_id}/trials/', versions=1)
 def post_experiments_trials(exp_id: int,
                             body,
+                            request,
                             response,
                             user: hug.directives.user):
     if body is None:
-        raise falcon.BadRequest()
+        raise falcon.HTTPBadRequest()
+    is_list = isinstance(body, list)
+    items = body if is_list else [body]
+    keys = idempotency_keys(request, items, is_list)
+
+    # Retries of committed requests are answered without the write lock
+    known = [trial_keys.get((exp_id, user['id'], key)) if key else None
+             for key in keys]
+    for key, item, cached in zip(keys, items, known):
+        if cached is not None and not patch.json_equal(cached[1],
+                                                       without_key(item)):
+            raise models.KeyConflict(
+                'Key {!r} was used for another trial'.format(key))
+    if items and None not in known:
+        if is_list:
+            return [trial_id for trial_id, item in known]
+        with orm.db_session():
+            return Trial[known[0][0]].summary()
 
     with orm.db_session():
-        expr = Experiment[exp_id]
-
-        observer = User[user['id']]
-        trial_data = ','.join([str(body.pop(key))
-                               for key in expr.variable_names.split(',')])
-
-        if len(body):
-            raise falcon.HTTPBadRequest()
-
-        trial = expr.trials.create(observer=observer, trial_data=trial_data)
-
+        if ingest.writer is None:
+            expr = locked_experiment(exp_id)
+        else:
+            expr = Experiment[exp_id]
+        variable_names = expr.variable_names.split(',')
+        rows = [encode_trial(variable_names, without_key(item))
+                for item in items]
+
+        if ingest.writer is not None:
+            try:
+                ids = ingest.writer.submit(exp_id, user['id'], rows, keys)
+            except queue.Full:
+                raise falcon.HTTPServiceUnavailable(retry_after=1)
+            response.status = falcon.HTTP_202
+            if is_list:
+                return ids
+            data = {'id': ids[0], 'experiment': exp_id, 'observer': user['id']}
+            data.update(zip(variable_names, rows[0]))
+            return data
+
+        trials = expr.add_trials(User[user['id']], rows, keys)
         orm.commit()
-        return trial.summary()
+        for key, item, trial in zip(keys, items, trials):
+            if key is not None:
+                trial_keys.set((exp_id, user['id'], key),
+                               (trial.id, without_key(item)))
+        publish_trials(exp_id, trials)
+        if is_list:
+            return [trial.id for trial in trials]
+        return trials[0].summary()
 
 
 @admin_auth.get('/experiments/{exp_id}/trials/{trial_id}/', versions=1)
-def get_experiments_trials(exp_id: int, trial_id: int, response):
+def get_experiments_trials(exp_id: int, trial_id: int, request, response):
     with orm.db_session():
         expr = Experiment[exp_id]
         trial = Trial[trial_id]
         if trial in expr.trials:
+            if not_modified(request, response, trial_etag(trial)):
+                return
             return trial.summary()
         else:
             raise falcon.HTTPNotFound()
@@ -134,75 +453,277 @@ def get_experiments_trials(exp_id: int, trial_id: int, response):
 @admin_auth.put('/experiments/{exp_id}/trials/{trial_id}/', versions=1)
 def put_experiments_trials(exp_id: int, trial_id: int, response, body):
     with orm.db_session():
-        expr = Experiment[exp_id]
+        expr = locked_experiment(exp_id)
         trial = Trial[trial_id]
         if trial in expr.trials:
             variable_names = expr.variable_names.split(',')
-            data = {key: value
-                    for key, value in
-                    zip(variable_names,
-                        trial.trial_data.split(','))}
-            for key in data:
-                if key in body:
-                    data[key] = body.pop(key)
-            trial.trial_data = ','.join([data[key] for key in variable_names])
+            trial.data = [body.get(key, value)
+                          for key, value in zip(variable_names, trial.data)]
+            trial.seq = expr.next_seq()
+            orm.commit()
+            publish_trials(exp_id, [trial])
             return trial.summary()
         else:
             raise falcon.HTTPNotFound()
 
 
-@basic_auth.get('/experiments/{exp_id}/state/', versions=1)
-def get_state(exp_id: int, response, user: hug.directives.user):
+@admin_auth.get('/experiments/{exp_id}/changes/', versions=1)
+def get_experiments_changes(exp_id: int,
+                            response,
+                            since: hug.types.number = 0,
+                            limit: non_negative = 1000,
+                            fields: comma_separated = None):
+    with orm.db_session():
+        expr = Experiment[exp_id]
+        variable_names = expr.variable_names.split(',')
+        if fields is not None and not set(fields).issubset(
+                TRIAL_FIELDS + variable_names):
+            raise falcon.HTTPBadRequest()
+        trials = expr.select_changes(since)[:limit]
+        return {'trials': expr.trial_summaries(trials, fields),
+                'cursor': trials[-1].seq if trials else since}
+
+
+@admin_auth.get('/experiments/{exp_id}/events/', versions=1)
+def get_experiments_events(exp_id: int,
+                           request,
+                           response,
+                           since: hug.types.number = None):
+    if since is None and request.get_header('Last-Event-ID'):
+        try:
+            since = int(request.get_header('Last-Event-ID'))
+        except ValueError:
+            raise falcon.HTTPBadRequest()
+    with orm.db_session():
+        expr = Experiment[exp_id]
+        if since is None:
+            since = expr.version
+    subscription = events.hub.subscribe(exp_id)
+    response.content_type = 'text/event-stream'
+    response.set_header('Cache-Control', 'no-cache')
+    response.set_header('X-Accel-Buffering', 'no')
+    return streaming.Stream(events.sse(
+        subscription,
+        lambda since: streaming.trial_changes(exp_id, since),
+        since))
+
+
+@admin_auth.get('/experiments/{exp_id}/aggregate/', versions=1)
+def get_experiments_aggregate(exp_id: int,
+                              response,
+                              request,
+                              group_by: comma_separated = (),
+                              values: comma_separated = (),
+                              stats: comma_separated = ('mean',),
+                              quantiles: comma_separated = (),
+                              after_id: hug.types.number = 0,
+                              before_id: hug.types.number = None,
+                              observer: hug.types.number = None):
+    with orm.db_session():
+        expr = Experiment[exp_id]
+        variable_names = expr.variable_names.split(',')
+        if not (set(group_by).issubset(variable_names + ['observer']) and
+                set(values).issubset(variable_names) and
+                set(stats).issubset(models.AGGREGATES) and
+                not set(group_by) & set(values)):
+            raise falcon.HTTPBadRequest()
+        try:
+            quantiles = [float(q) for q in quantiles]
+        except ValueError:
+            raise falcon.HTTPBadRequest()
+        if not all(0 <= q <= 1 for q in quantiles):
+            raise falcon.HTTPBadRequest()
+        return expr.aggregate_trials(
+            group_by, values, stats, quantiles,
+            after_id=after_id,
+            before_id=before_id,
+            observer=observer,
+            where=data_predicates(variable_names, request.params))
+
+
+@admin_auth.get('/experiments/{exp_id}/export/', versions=1)
+def get_experiments_export(exp_id: int,
+                           response,
+                           request,
+                           format: hug.types.one_of(tuple(
+                               export.CONTENT_TYPES)) = 'csv',
+                           after_id: hug.types.number = 0,
+                           before_id: hug.types.number = None,
+                           observer: hug.types.number = None):
+    if format != 'csv' and export.pyarrow is None:
+        raise falcon.HTTPNotImplemented(
+            description='{} export requires pyarrow'.format(format))
+    types = None
+    with orm.db_session():
+        expr = Experiment[exp_id]
+        variable_names = expr.variable_names.split(',')
+        filters = {'before_id': before_id,
+                   'observer': observer,
+                   'where': data_predicates(variable_names, request.params)}
+        if format != 'csv':
+            # Column types must hold for every exported trial, so trials
+            # added while streaming are left out
+            types, last_id = expr.variable_types(after_id=after_id,
+                                                 **filters)
+            filters['before_id'] = (last_id or 0) + 1
+    batches = streaming.trial_batches(
+        exp_id, after_id, batch_size=export.BATCH_SIZE, **filters)
+    response.content_type = export.CONTENT_TYPES[format]
+    response.set_header('Content-Disposition',
+                        'attachment; filename="experiment-{}.{}"'
+                        .format(exp_id, format))
+    return streaming.Stream(
+        export.chunks(format, variable_names, batches, types))
+
+
+@observer_auth.get('/experiments/{exp_id}/state/', versions=1)
+def get_state(exp_id: int, request, response, user: hug.directives.user):
     with orm.db_session():
         observer = User[user['id']]
         experiment = Experiment[exp_id]
         state = State.get(observer=observer, experiment=experiment)
         if state:
-            return json.loads(state.state_json)
+            if not_modified(request, response, state_etag(state)):
+                return
+            return encoding.RawJSON(state.state_json.encode('utf8'))
         else:
             raise falcon.HTTPNotFound()
 
 
-@basic_auth.post('/experiments/{exp_id}/state/', versions=1)
+def save_state(state, value, response):
+    state.state_json = encoding.dumps(value).decode('utf8')
+    state.version += 1
+    orm.flush()
+    response.set_header('ETag', state_etag(state))
+    return encoding.RawJSON(state.state_json.encode('utf8'))
+
+
+def patched(value, patch_type, document):
+    try:
+        if patch_type == patch.MERGE_PATCH:
+            return patch.merge_patch(value, document)
+        return patch.json_patch(value, document)
+    except patch.PatchError as error:
+        raise falcon.HTTPUnprocessableEntity(description=str(error))
+
+
+def locked_state(exp_id, user, request):
+    """The observer's state, locked and checked against If-Match"""
+    state = State.get_for_update(observer=User[user['id']],
+                                 experiment=Experiment[exp_id])
+    if state is None:
+        raise falcon.HTTPNotFound()
+    check_precondition(request, state_etag(state))
+    return state
+
+
+@observer_auth.post('/experiments/{exp_id}/state/', versions=1)
 def post_state(exp_id: int, body, response, user: hug.directives.user):
     with orm.db_session():
         observer = User[user['id']]
         experiment = Experiment[exp_id]
-        state = State.get(observer=observer, experiment=experiment)
-        if state:
-            raise falcon.HTTPBadRequest()
         if body is None or 'state' not in body:
             raise falcon.HTTPBadRequest()
         state = State(observer=observer,
                       experiment=experiment,
-                      state_json=json.dumps(body['state']))
-        return json.loads(state.state_json)
+                      state_json=encoding.dumps(body['state']).decode('utf8'))
+        try:
+            orm.commit()
+        except orm.TransactionIntegrityError:
+            raise falcon.HTTPBadRequest()
+        response.set_header('ETag', state_etag(state))
+        return encoding.RawJSON(state.state_json.encode('utf8'))
 
 
-@basic_auth.put('/experiments/{exp_id}/state/', versions=1)
-def put_state(exp_id: int, body, response, user: hug.directives.user):
+@observer_auth.put('/experiments/{exp_id}/state/', versions=1)
+def put_state(exp_id: int, body, request, response,
+              user: hug.directives.user):
+    if body is None or 'state' not in body:
+        raise falcon.HTTPBadRequest()
+    with orm.db_session():
+        try:
+            state = locked_state(exp_id, user, request)
+        except falcon.HTTPNotFound:
+            raise falcon.HTTPBadRequest()
+        return save_state(state, body['state'], response)
+
+
+@observer_auth.patch('/experiments/{exp_id}/state/', versions=1)
+def patch_state(exp_id: int, body, request, response,
+                user: hug.directives.user):
+    content_type = (request.content_type or '').split(';')[0].strip()
+    if content_type not in (patch.MERGE_PATCH, patch.JSON_PATCH):
+        raise falcon.HTTPUnsupportedMediaType()
+    with orm.db_session():
+        state = locked_state(exp_id, user, request)
+        value = patched(encoding.loads(state.state_json), content_type, body)
+        return save_state(state, value, response)
+
+
+STATE_UPDATES = {'state': None,
+                 'merge_patch': patch.MERGE_PATCH,
+                 'json_patch': patch.JSON_PATCH}
+
+
+@observer_auth.post('/experiments/{exp_id}/steps/', versions=1)
+def post_steps(exp_id: int, body, request, response,
+               user: hug.directives.user):
+    """Record trials and update the observer's state in one transaction"""
+    if not isinstance(body, dict) or 'trials' not in body:
+        raise falcon.HTTPBadRequest()
+    updates = [key for key in STATE_UPDATES if key in body]
+    if len(updates) > 1:
+        raise falcon.HTTPBadRequest()
+    trials_body = body['trials']
+    if not isinstance(trials_body, list):
+        trials_body = [trials_body]
+
     with orm.db_session():
+        expr = locked_experiment(exp_id)
+        variable_names = expr.variable_names.split(',')
+        rows = [encode_trial(variable_names, trial) for trial in trials_body]
         observer = User[user['id']]
-        experiment = Experiment[exp_id]
-        state = State.get(observer=observer, experiment=experiment)
+        state = State.get_for_update(observer=observer, experiment=expr)
         if state is None:
-            raise falcon.HTTPBadRequest()
-        state.state_json = json.dumps(body['state'])
-        return json.loads(state.state_json)
+            if request.get_header('If-Match') is not None:
+                raise falcon.HTTPPreconditionFailed()
+            value = None
+        else:
+            check_precondition(request, state_etag(state))
+            value = encoding.loads(state.state_json)
+
+        if updates:
+            key = updates[0]
+            if key == 'state':
+                value = body[key]
+            else:
+                value = patched(value, STATE_UPDATES[key], body[key])
+            if state is None:
+                state = State(observer=observer, experiment=expr,
+                              state_json='null', version=0)
+            save_state(state, value, response)
+        elif state is not None:
+            response.set_header('ETag', state_etag(state))
+
+        trials = expr.add_trials(observer, rows)
+        orm.commit()
+        publish_trials(exp_id, trials)
+        return {'trials': [trial.id for trial in trials], 'state': value}
 
 
 # End point /users/
 @hug.post('/users/', versions=1)
 def post_users(body, response):
     with orm.db_session():
-        user = User(username=body['username'], password=body['password'])
+        user = User(username=body['username'],
+                    password=crypto.hash_password(body['password']))
     return user.safe_json()
 
 
 @admin_auth.get('/users/', versions=1)
 def get_all_users():
     with orm.db_session():
-        return [user.safe_json() for user in orm.select(user for user in User)]
+        return User.all_safe_json()
 
 
 @token_auth.put('/users/{user_id}/', versions=1)
@@ -219,9 +740,14 @@ def put_users(user_id: int, body, response, user: hug.directives.user):
         if 'isadmin' in body and not user['isadmin']:
             raise falcon.HTTPUnauthorized()
 
+        username = user_.username
         for key, value in body.items():
+            if key == 'password':
+                value = crypto.hash_password(value)
             setattr(user_, key, value)
-        return user_.safe_json()
+        result = user_.safe_json()
+    crypto.forget_user(username)
+    return result
 
 
 @token_auth.get('/users/{user_id}/', versions=1)
@@ -235,4 +761,21 @@ def get_users(user_id: int, response, user: hug.directives.user):
 
 @basic_auth.get('/token/', versions=1)
 def get_token(user: hug.directives.user):
-    return crypto.create_token(user['id'])
+    return crypto.encode_token(user)
+
+
+@basic_auth.get('/refresh_token/', versions=1)
+def get_refresh_token(user: hug.directives.user):
+    return crypto.create_token(user['id'], 'refresh')
+
+
+@refresh_auth.get('/token/refresh/', versions=1)
+def get_token_refresh(user: hug.directives.user):
+    return crypto.encode_token(user)
+
+
+@admin_auth.get('/metrics', output=prometheus_text)
+def get_metrics():
+    if not metrics.ENABLED:
+        raise falcon.HTTPNotFound()
+    return metrics.registry.render()
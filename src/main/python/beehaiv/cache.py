@@ -0,0 +1,48 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class TTLCache(object):
+    """Thread safe LRU mapping whose entries expire after ttl seconds"""
+
+    def __init__(self, maxsize=1024, ttl=300, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._items[key]
+            except KeyError:
+                return default
+            if expires <= self.clock():
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._items[key] = (self.clock() + ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            expires, value = self._items.pop(key, (None, default))
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
@@ -1,12 +1,29 @@
 import os
+import hmac
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from base64 import b64encode
+from base64 import b64encode, b64decode
 from pony import orm
 import jwt
 
 from .models import User
+from .cache import TTLCache
 
 SECRET_KEY = os.getenv('BEEHAIV_SECRET', 'secret')
+AUTH_CACHE_SIZE = int(os.getenv('BEEHAIV_AUTH_CACHE_SIZE', '1024'))
+AUTH_CACHE_TTL = float(os.getenv('BEEHAIV_AUTH_CACHE_TTL', '300'))
+KDF_ITERATIONS = int(os.getenv('BEEHAIV_KDF_ITERATIONS', '260000'))
+KDF_WORKERS = int(os.getenv('BEEHAIV_KDF_WORKERS', '0'))
+TOKEN_LIFETIME = float(os.getenv('BEEHAIV_TOKEN_LIFETIME', '300'))
+REFRESH_TOKEN_LIFETIME = float(os.getenv('BEEHAIV_REFRESH_TOKEN_LIFETIME',
+                                         '2592000'))
+TOKEN_CACHE_SIZE = int(os.getenv('BEEHAIV_TOKEN_CACHE_SIZE', '1024'))
+
+credentials = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+tokens = TTLCache(TOKEN_CACHE_SIZE, TOKEN_LIFETIME)
+kdf_pool = ThreadPoolExecutor(KDF_WORKERS) if KDF_WORKERS > 0 else None
 
 
 def get_basic_token(username, password):
@@ -15,45 +32,153 @@ def get_basic_token(username, password):
     ).decode('utf8')
 
 
+def run_kdf(function, *args):
+    if kdf_pool is None:
+        return function(*args)
+    return kdf_pool.submit(function, *args).result()
+
+
+def hash_password(password, iterations=None):
+    iterations = iterations or KDF_ITERATIONS
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf8'),
+                                 salt, iterations)
+    return 'pbkdf2_sha256${}${}${}'.format(iterations,
+                                           b64encode(salt).decode('ascii'),
+                                           b64encode(digest).decode('ascii'))
+
+
+def is_hashed(stored):
+    return stored.startswith('pbkdf2_sha256$')
+
+
+def check_password(password, stored):
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode('utf8'),
+                                   stored.encode('utf8'))
+    _, iterations, salt, digest = stored.split('$')
+    candidate = hashlib.pbkdf2_hmac('sha256', password.encode('utf8'),
+                                    b64decode(salt), int(iterations))
+    return hmac.compare_digest(candidate, b64decode(digest))
+
+
+def credential_digest(username, password):
+    return hmac.new(SECRET_KEY.encode('utf8'),
+                    '{}:{}'.format(username, password).encode('utf8'),
+                    hashlib.sha256).digest()
+
+
 def verify_user(username, password):
+    digest = credential_digest(username, password)
+    cached = credentials.get(username)
+    if cached is not None and hmac.compare_digest(cached[0], digest):
+        return dict(cached[1])
+
     with orm.db_session():
         user = User.get(username=username)
-        if user.password == password:
-            return {'username': user.username,
-                    'id': user.id,
-                    'isadmin': user.isadmin}
-        else:
+        if user is None:
             return False
+        info = {'username': user.username,
+                'id': user.id,
+                'isadmin': user.isadmin}
+        stored = user.password
 
+    if not run_kdf(check_password, password, stored):
+        return False
+    if not is_hashed(stored):
+        with orm.db_session():
+            User[info['id']].password = run_kdf(hash_password, password)
+    credentials.set(username, (digest, info))
+    return dict(info)
 
-@orm.db_session()
-def create_token(user_id):
-    user = User[user_id]
-    return jwt.encode({'username': user.username,
-                       'isadmin': user.isadmin,
-                       'id': user.id,
-                       'exp': datetime.utcnow() + timedelta(minutes=5)},
+
+def forget_user(username):
+    credentials.pop(username)
+
+
+def password_stamp(stored):
+    """Changes with the stored password, reveals nothing about it"""
+    return hmac.new(SECRET_KEY.encode('utf8'), stored.encode('utf8'),
+                    hashlib.sha256).hexdigest()[:16]
+
+
+def encode_token(user, token_type='access', lifetime=None, **claims):
+    if lifetime is None:
+        lifetime = (REFRESH_TOKEN_LIFETIME if token_type == 'refresh'
+                    else TOKEN_LIFETIME)
+    return jwt.encode(dict(claims,
+                           username=user['username'],
+                           isadmin=user['isadmin'],
+                           id=user['id'],
+                           type=token_type,
+                           exp=datetime.utcnow() + timedelta(
+                               seconds=lifetime)),
                       SECRET_KEY,
                       algorithm='HS256')
 
 
-def verify_token(token):
-    try:
-        return jwt.decode(token, SECRET_KEY, algorithm='HS256')
-    except jwt.DecodeError:
-        return False
-    except jwt.ExpiredSignatureError:
-        return False
+@orm.db_session()
+def create_token(user_id, token_type='access', lifetime=None):
+    """Refresh tokens are bound to the user's current password"""
+    user = User[user_id]
+    claims = {}
+    if token_type == 'refresh':
+        claims['stamp'] = password_stamp(user.password)
+    return encode_token({'username': user.username,
+                         'isadmin': user.isadmin,
+                         'id': user.id},
+                        token_type, lifetime, **claims)
 
 
-def verify_admin(token):
+def decode_token(token, token_type='access'):
     try:
         info = jwt.decode(token, SECRET_KEY, algorithm='HS256')
     except jwt.DecodeError:
         return False
     except jwt.ExpiredSignatureError:
         return False
-    if info['isadmin']:
+    # Tokens issued before refresh tokens existed have no type
+    if info.get('type', 'access') != token_type:
+        return False
+    return info
+
+
+def verify_token(token):
+    """Claims of a valid access token, cached until the token expires"""
+    if isinstance(token, str):
+        token = token.encode('utf8')
+    digest = hashlib.sha256(token).digest()
+    info = tokens.get(digest)
+    if info is None:
+        info = decode_token(token)
+        if not info:
+            return False
+        expires_in = info['exp'] - time.time() if 'exp' in info else None
+        tokens.set(digest, info, ttl=expires_in)
+    return dict(info)
+
+
+def verify_admin(token):
+    info = verify_token(token)
+    if info and info['isadmin']:
         return info
     else:
         return False
+
+
+def verify_refresh_token(token):
+    """Current account of a valid refresh token's user
+
+    Changing the password revokes the refresh tokens issued before.
+    """
+    info = decode_token(token, 'refresh')
+    if not info:
+        return False
+    with orm.db_session():
+        user = User.get(id=info['id'])
+        if user is None or not hmac.compare_digest(
+                info.get('stamp', ''), password_stamp(user.password)):
+            return False
+        return {'username': user.username,
+                'id': user.id,
+                'isadmin': user.isadmin}
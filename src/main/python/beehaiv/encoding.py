@@ -0,0 +1,132 @@
+import gzip
+import json
+import os
+import zlib
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+MIN_SIZE = 1024
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'text/')
+
+
+class RawJSON(bytes):
+    """JSON that is already serialized, e.g. as stored in the database"""
+
+
+def dumps(content, default=None):
+    """Serialize to JSON bytes, with orjson if it is installed"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(content, default=default)
+        except TypeError:
+            # e.g. integers beyond 64 bit, which the stdlib encoder handles
+            pass
+    return json.dumps(content, default=default,
+                      ensure_ascii=False).encode('utf8')
+
+
+def reject_constant(name):
+    raise ValueError('{} is not valid JSON'.format(name))
+
+
+def loads(data):
+    """Parse JSON; like orjson, the stdlib fallback rejects NaN and Infinity"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data, parse_constant=reject_constant)
+
+
+def available_encodings():
+    encodings = {'gzip'}
+    if brotli is not None:
+        encodings.add('br')
+    if zstandard is not None:
+        encodings.add('zstd')
+    return encodings
+
+
+def configured_encodings(environ=os.environ):
+    """Encodings from BEEHAIV_COMPRESSION in order of preference"""
+    names = environ.get('BEEHAIV_COMPRESSION', 'zstd,br,gzip').split(',')
+    available = available_encodings()
+    return [name.strip() for name in names if name.strip() in available]
+
+
+ENCODINGS = configured_encodings()
+
+
+def negotiate(accept_encoding, encodings=None):
+    """Pick the first of encodings that Accept-Encoding allows"""
+    if encodings is None:
+        encodings = ENCODINGS
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in encodings:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def compressible(content_type):
+    # Event streams must reach the client event by event
+    return (content_type is not None and
+            content_type.startswith(COMPRESSIBLE) and
+            not content_type.startswith('text/event-stream'))
+
+
+def compressor(encoding):
+    """Object with compress() and flush() for incremental compression"""
+    if encoding == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == 'br':
+        return brotli.Compressor(quality=4)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    raise ValueError('Unknown encoding {}'.format(encoding))
+
+
+def compress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, 6)
+    if encoding == 'br':
+        return brotli.compress(data, quality=4)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    raise ValueError('Unknown encoding {}'.format(encoding))
+
+
+def compress_chunks(chunks, encoding):
+    # falcon stops reading a stream at the first empty chunk
+    stream = compressor(encoding)
+    for chunk in chunks:
+        data = stream.compress(chunk)
+        if data:
+            yield data
+    data = stream.flush()
+    if data:
+        yield data
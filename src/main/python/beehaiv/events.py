@@ -0,0 +1,134 @@
+import os
+import queue
+import threading
+
+from .encoding import dumps
+
+BUFFER_SIZE = int(os.getenv('BEEHAIV_EVENT_BUFFER', 1000))
+HEARTBEAT = 15
+RESYNC = object()
+
+
+class Subscription(object):
+    """Bounded buffer of (seq, trial) events for one subscriber
+
+    When a slow subscriber's buffer overflows, its events are dropped and
+    replaced by RESYNC, which tells it to catch up from the database.
+    Publishers never block.
+    """
+
+    def __init__(self, exp_id, maxsize=BUFFER_SIZE):
+        self.exp_id = exp_id
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def put(self, events):
+        with self.lock:
+            if self.closed:
+                return
+            for event in events:
+                try:
+                    self.queue.put_nowait(event)
+                except queue.Full:
+                    self.replace(RESYNC)
+                    return
+
+    def get(self, timeout):
+        return self.queue.get(timeout=timeout)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.replace(None)
+
+    def replace(self, marker):
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self.queue.put_nowait(marker)
+
+
+class Hub(object):
+    """In-process fan out of committed trials to subscribers"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    def subscribe(self, exp_id, maxsize=BUFFER_SIZE):
+        subscription = Subscription(exp_id, maxsize)
+        with self.lock:
+            self.subscriptions.setdefault(exp_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.exp_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.exp_id, None)
+
+    def has_subscribers(self, exp_id):
+        return exp_id in self.subscriptions
+
+    def publish(self, exp_id, events):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(exp_id, ()))
+        for subscription in subscriptions:
+            subscription.put(events)
+
+    def close(self):
+        with self.lock:
+            subscriptions = [subscription
+                             for subscriptions in self.subscriptions.values()
+                             for subscription in subscriptions]
+        for subscription in subscriptions:
+            subscription.close()
+
+
+hub = Hub()
+
+
+def format_event(seq, trial):
+    return b'id: %d\nevent: trial\ndata: %s\n\n' % (seq, dumps(trial))
+
+
+def sse(subscription, changes, since=0, heartbeat=HEARTBEAT):
+    """Server-Sent Events: trials since a cursor, then live trials
+
+    changes(since) yields committed (seq, trial) pairs from the database.
+    It is used to start, after a RESYNC, after a quiet heartbeat (to pick
+    up trials written by other processes) and when a live event skips a
+    sequence number, because publishers may deliver out of order.
+    """
+    try:
+        yield b'retry: 1000\n\n'
+        catch_up = True
+        while True:
+            if catch_up:
+                for seq, trial in changes(since):
+                    yield format_event(seq, trial)
+                    since = seq
+                catch_up = False
+            try:
+                event = subscription.get(heartbeat)
+            except queue.Empty:
+                yield b': keepalive\n\n'
+                catch_up = True
+                continue
+            if event is None:
+                return
+            if event is RESYNC:
+                catch_up = True
+                continue
+            seq, trial = event
+            if seq == since + 1:
+                yield format_event(seq, trial)
+                since = seq
+            elif seq > since:
+                catch_up = True
+    finally:
+        hub.unsubscribe(subscription)
@@ -0,0 +1,157 @@
+import csv
+import io
+import json
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+BATCH_SIZE = 10000
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+TRIAL_COLUMNS = ['id', 'experiment', 'observer']
+
+# Start of an Arrow IPC message that never comes. Readers fail on it
+# instead of taking an aborted stream for the complete export.
+TRUNCATED_MESSAGE = b'\xff\xff\xff\xff\x08\x00\x00\x00'
+
+
+class Sink(object):
+    """Write target for pyarrow that hands out what was written so far"""
+
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def csv_value(value):
+    if isinstance(value, (list, dict, bool)):
+        return json.dumps(value)
+    return value
+
+
+def csv_chunks(variable_names, batches):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, TRIAL_COLUMNS + variable_names)
+    writer.writeheader()
+    yield buffer.getvalue().encode('utf8')
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows({key: csv_value(value)
+                          for key, value in trial.items()}
+                         for trial in batch)
+        yield buffer.getvalue().encode('utf8')
+
+
+class ExportError(ValueError):
+    pass
+
+
+def arrow_type(json_types):
+    """Column type for the JSON types of a variable, string if mixed"""
+    if json_types == {'number'}:
+        return pyarrow.float64()
+    if json_types == {'boolean'}:
+        return pyarrow.bool_()
+    return pyarrow.string()
+
+
+def arrow_schema(variable_names, types):
+    """Column types of the export, from Experiment.variable_types"""
+    return pyarrow.schema(
+        [(name, pyarrow.int64()) for name in TRIAL_COLUMNS] +
+        [(name, arrow_type(types.get(name, set())))
+         for name in variable_names])
+
+
+def coerce(value, type_):
+    if value is None:
+        return None
+    if type_ == pyarrow.string():
+        return value if isinstance(value, str) else json.dumps(value)
+    if type_ == pyarrow.float64():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+    elif type_ == pyarrow.bool_():
+        if isinstance(value, bool):
+            return value
+    else:
+        return value
+    # Only possible if the trial changed after the types were queried
+    raise ExportError('{!r} does not fit a {} column'.format(value, type_))
+
+
+def record_batch(schema, batch):
+    return pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array([coerce(trial[field.name], field.type)
+                        for trial in batch], type=field.type)
+         for field in schema],
+        schema=schema)
+
+
+def arrow_chunks(variable_names, batches, file_format='arrow', types=None):
+    """Arrow IPC stream or Parquet file with one row group per batch
+
+    If a trial does not fit the schema, the file ends unreadable and
+    ExportError is raised, which aborts the response.
+    """
+    schema = arrow_schema(variable_names, types or {})
+    sink = Sink()
+    writer = None
+    for batch in batches:
+        try:
+            data = record_batch(schema, batch)
+        except ExportError:
+            if writer is not None:
+                # Parquet files without their footer are unreadable anyway
+                yield sink.take() + (TRUNCATED_MESSAGE
+                                     if file_format != 'parquet' else b'')
+            raise
+        if writer is None:
+            if file_format == 'parquet':
+                writer = pyarrow.parquet.ParquetWriter(sink, schema)
+            else:
+                writer = pyarrow.ipc.new_stream(sink, schema)
+        if file_format == 'parquet':
+            writer.write_table(pyarrow.Table.from_batches([data]))
+        else:
+            writer.write_batch(data)
+        yield sink.take()
+    if writer is None:
+        if file_format == 'parquet':
+            writer = pyarrow.parquet.ParquetWriter(sink, schema)
+        else:
+            writer = pyarrow.ipc.new_stream(sink, schema)
+    writer.close()
+    yield sink.take()
+
+
+def chunks(file_format, variable_names, batches, types=None):
+    if file_format == 'csv':
+        return csv_chunks(variable_names, batches)
+    return arrow_chunks(variable_names, batches, file_format, types)
@@ -0,0 +1,128 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+import uuid
+from pony import orm
+
+from . import events
+from .models import Experiment, User
+
+logger = logging.getLogger(__name__)
+
+writer = None
+
+
+class TrialWriter(object):
+    """Inserts queued trials from a background thread in group commits
+
+    Every queue item holds all trials of one request, so a request is
+    either queued completely or rejected with queue.Full.
+    """
+
+    def __init__(self, queue_size=1000, batch_size=500, flush_interval=0.2):
+        self.queue = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run,
+                                       name='beehaiv-trial-writer',
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=None):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+    def flush(self):
+        self.queue.join()
+
+    def submit(self, exp_id, observer_id, rows, keys=None):
+        """Queue trials and return provisional ids
+
+        Trials with an idempotency key use it as provisional id.
+        """
+        if keys is None:
+            keys = [None] * len(rows)
+        trials = [(key or uuid.uuid4().hex, key, data)
+                  for key, data in zip(keys, rows)]
+        self.queue.put_nowait((exp_id, observer_id, trials))
+        return [provisional_id for provisional_id, key, data in trials]
+
+    def run(self):
+        while not (self.stopped.is_set() and self.queue.empty()):
+            items = self.next_batch()
+            if items:
+                self.write(items)
+                for _ in items:
+                    self.queue.task_done()
+
+    def next_batch(self):
+        items = []
+        trial_count = 0
+        deadline = time.monotonic() + self.flush_interval
+        while trial_count < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    item = self.queue.get(timeout=timeout)
+                else:
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            items.append(item)
+            trial_count += len(item[2])
+        return items
+
+    def write(self, items):
+        try:
+            inserted = self.insert(items)
+        except Exception:
+            logger.exception('Group commit of %d requests failed, '
+                             'retrying them one by one', len(items))
+            inserted = []
+            for item in items:
+                try:
+                    inserted.extend(self.insert([item]))
+                except Exception:
+                    logger.exception('Dropped %d trials for experiment %s',
+                                     len(item[2]), item[0])
+        self.publish(inserted)
+
+    @orm.db_session()
+    def insert(self, items):
+        inserted = []
+        for exp_id, observer_id, trials in items:
+            expr = Experiment.get_for_update(id=exp_id)
+            observer = User[observer_id]
+            inserted.append((exp_id, expr.add_trials(
+                observer,
+                [data for provisional_id, key, data in trials],
+                [key for provisional_id, key, data in trials])))
+        orm.commit()
+        return [(exp_id, [(trial.seq, trial.summary()) for trial in trials])
+                for exp_id, trials in inserted
+                if events.hub.has_subscribers(exp_id)]
+
+    def publish(self, inserted):
+        for exp_id, trial_events in inserted:
+            events.hub.publish(exp_id, trial_events)
+
+
+def start(**kwargs):
+    global writer
+    writer = TrialWriter(**kwargs)
+    writer.start()
+    return writer
+
+
+def stop():
+    global writer
+    if writer is not None:
+        writer.stop()
+        writer = None
@@ -0,0 +1,290 @@
+import functools
+import logging
+import os
+import threading
+import time
+
+ENABLED = bool(os.getenv('BEEHAIV_METRICS'))
+SERVER_TIMING = bool(os.getenv('BEEHAIV_SERVER_TIMING'))
+SLOW_QUERY_MS = float(os.getenv('BEEHAIV_SLOW_QUERY_MS', '0'))
+QUERY_BUDGET = int(os.getenv('BEEHAIV_QUERY_BUDGET', '0'))
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+PHASES = ('auth', 'db', 'serialize')
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+logger = logging.getLogger(__name__)
+local = threading.local()
+
+
+class RequestTimer(object):
+    """Time spent per phase while handling one request
+
+    Phases are exclusive: a query run during authentication counts as db
+    time, not as auth time. Time outside every phase is the handler's.
+    """
+
+    def __init__(self, request=None, clock=time.perf_counter):
+        self.request = request
+        self.clock = clock
+        self.start = clock()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+        self.stack = []
+        self.resumed = None
+
+    def enter(self, phase):
+        now = self.clock()
+        if self.stack:
+            self.phases[self.stack[-1]] += now - self.resumed
+        self.stack.append(phase)
+        self.resumed = now
+
+    def exit(self):
+        now = self.clock()
+        self.phases[self.stack.pop()] += now - self.resumed
+        self.resumed = now
+
+    def elapsed(self):
+        return self.clock() - self.start
+
+    def route(self):
+        if self.request is None:
+            return '-'
+        return '{} {}'.format(self.request.method,
+                              self.request.uri_template or self.request.path)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield (name + '_bucket', labels + (('le', format_value(bound)),),
+                   cumulative)
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, cumulative
+
+
+class Registry(object):
+    """Request metrics of this process in the Prometheus text format"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.requests = {}
+            self.durations = {}
+            self.phases = {}
+            self.queries = {}
+
+    def observe(self, method, route, status, timer):
+        labels = (('method', method), ('route', route))
+        duration = timer.elapsed()
+        with self.lock:
+            key = labels + (('status', status),)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram(self.durations, labels, LATENCY_BUCKETS).observe(
+                duration)
+            for phase, seconds in timer.phases.items():
+                histogram(self.phases, labels + (('phase', phase),),
+                          LATENCY_BUCKETS).observe(seconds)
+            histogram(self.queries, labels, QUERY_BUCKETS).observe(
+                timer.queries)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines.extend(render_family(
+                'beehaiv_requests_total', 'counter',
+                'Finished HTTP requests.',
+                [('beehaiv_requests_total', labels, count)
+                 for labels, count in sorted(self.requests.items())]))
+            for name, help_, histograms in [
+                    ('beehaiv_request_duration_seconds',
+                     'Time from routing to the end of the response '
+                     'middleware.', self.durations),
+                    ('beehaiv_request_phase_seconds',
+                     'Time per request spent in auth, db and serialize.',
+                     self.phases),
+                    ('beehaiv_request_queries',
+                     'SQL statements per request.', self.queries)]:
+                lines.extend(render_family(
+                    name, 'histogram', help_,
+                    [sample
+                     for labels, histogram_ in sorted(histograms.items())
+                     for sample in histogram_.samples(name, labels)]))
+        return ''.join(lines).encode('utf8')
+
+
+def histogram(histograms, labels, buckets):
+    if labels not in histograms:
+        histograms[labels] = Histogram(buckets)
+    return histograms[labels]
+
+
+def format_value(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return '{:.1f}'.format(value)
+    return repr(value)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def render_family(name, type_, help_, samples):
+    yield '# HELP {} {}\n'.format(name, help_)
+    yield '# TYPE {} {}\n'.format(name, type_)
+    for sample_name, labels, value in samples:
+        yield '{}{{{}}} {}\n'.format(
+            sample_name,
+            ','.join('{}="{}"'.format(key, escape(label))
+                     for key, label in labels),
+            format_value(value))
+
+
+registry = Registry()
+
+
+def current():
+    return getattr(local, 'timer', None)
+
+
+def timing_requests():
+    """Whether metrics, Server-Timing or a query budget need request timers"""
+    return bool(ENABLED or SERVER_TIMING or QUERY_BUDGET or
+                getattr(local, 'budgets', None))
+
+
+def begin(request=None):
+    local.timer = RequestTimer(request)
+    return local.timer
+
+
+def end():
+    timer = current()
+    local.timer = None
+    return timer
+
+
+class phase(object):
+    """Count the time of a block towards a phase of the current request"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timer = current()
+        if self.timer is not None:
+            self.timer.enter(self.name)
+
+    def __exit__(self, *exc_info):
+        if self.timer is not None:
+            self.timer.exit()
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            with phase(self.name):
+                return function(*args, **kwargs)
+        return timed
+
+
+def instrument(db):
+    """Count the statements and commits of a bound database as db time
+
+    With BEEHAIV_SLOW_QUERY_MS, statements that take longer are logged
+    with the route that ran them.
+    """
+    provider = db.provider
+    execute = provider.execute
+
+    @functools.wraps(execute)
+    def counted_execute(cursor, sql, *args, **kwargs):
+        timer = current()
+        if timer is not None:
+            timer.queries += 1
+        start = time.perf_counter()
+        try:
+            with phase('db'):
+                return execute(cursor, sql, *args, **kwargs)
+        finally:
+            milliseconds = (time.perf_counter() - start) * 1000
+            if SLOW_QUERY_MS and milliseconds > SLOW_QUERY_MS:
+                logger.warning('Slow query (%.1f ms) in %s: %s', milliseconds,
+                               '-' if timer is None else timer.route(), sql)
+
+    provider.execute = counted_execute
+    provider.commit = phase('db')(provider.commit)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class query_budget(object):
+    """Fail if a request finished in this block ran more than limit queries
+
+    Meant for tests, which run requests in the calling thread:
+
+        with metrics.query_budget(3):
+            hug.test.get(api, '/v1/experiments/')
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.violations = []
+
+    def __enter__(self):
+        if not hasattr(local, 'budgets'):
+            local.budgets = []
+        local.budgets.append(self)
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        local.budgets.remove(self)
+        if exc_type is None and self.violations:
+            raise QueryBudgetExceeded('; '.join(
+                '{} ran {} queries, budget is {}'.format(
+                    route, queries, self.limit)
+                for route, queries in self.violations))
+
+
+def check_budget(timer):
+    """Log requests over BEEHAIV_QUERY_BUDGET and record them in budgets"""
+    if QUERY_BUDGET and timer.queries > QUERY_BUDGET:
+        logger.warning('%s ran %d queries, budget is %d', timer.route(),
+                       timer.queries, QUERY_BUDGET)
+    for budget in getattr(local, 'budgets', ()):
+        if timer.queries > budget.limit:
+            budget.violations.append((timer.route(), timer.queries))
+
+
+def server_timing(timer):
+    return ', '.join(
+        ['{};dur={:.2f}'.format(name, seconds * 1000)
+         for name, seconds in timer.phases.items()] +
+        ['total;dur={:.2f}'.format(timer.elapsed() * 1000)])
@@ -0,0 +1,136 @@
+import json
+from pony import orm
+
+BATCH_SIZE = 10000
+
+
+def upgrade(db):
+    """Update tables created by earlier versions to the current models
+
+    Runs after db.bind() and before db.generate_mapping().
+    """
+    with orm.db_session():
+        trial_columns = columns(db, 'Trial')
+        if 'trial_data' in trial_columns:
+            split_trial_data(db)
+        if trial_columns and 'seq' not in trial_columns:
+            add_change_sequence(db)
+        if trial_columns and 'key' not in trial_columns:
+            add_trial_key(db)
+        if trial_columns:
+            create_trial_indexes(db)
+            scope_trial_keys(db)
+        state_columns = columns(db, 'State')
+        if state_columns:
+            create_state_key(db)
+        if state_columns and 'version' not in state_columns:
+            add_state_version(db)
+
+
+def table_name(db, entity):
+    return db.provider.normalize_name(entity)
+
+
+def quoted_table(db, entity):
+    return db.provider.quote_name(table_name(db, entity))
+
+
+def columns(db, table):
+    if db.provider.dialect == 'PostgreSQL':
+        return set(db.select('SELECT column_name '
+                             'FROM information_schema.columns '
+                             'WHERE table_name = $table',
+                             {'table': table_name(db, table)}))
+    return set(db.select('SELECT name FROM pragma_table_info($table)',
+                         {'table': table_name(db, table)}))
+
+
+def typed_value(text):
+    """int or float if the text is exactly how Python writes that number"""
+    for type_ in (int, float):
+        try:
+            value = type_(text)
+        except ValueError:
+            continue
+        if repr(value) == text and value - value == 0:
+            return value
+    return text
+
+
+def split_trial_data(db):
+    trial = quoted_table(db, 'Trial')
+    json_type = 'JSONB' if db.provider.dialect == 'PostgreSQL' else 'JSON'
+    placeholder = '?' if db.provider.paramstyle == 'qmark' else '%s'
+
+    db.execute('ALTER TABLE {} ADD COLUMN "data" {}'.format(trial, json_type))
+    cursor = db.get_connection().cursor()
+    after_id = 0
+    while True:
+        rows = db.select('SELECT "id", "trial_data" FROM {} '
+                         'WHERE "id" > $after_id ORDER BY "id" '
+                         'LIMIT $limit'.format(trial),
+                         {'after_id': after_id, 'limit': BATCH_SIZE})
+        if not rows:
+            break
+        cursor.executemany('UPDATE {} SET "data" = {} WHERE "id" = {}'
+                           .format(trial, placeholder, placeholder),
+                           [(json.dumps([typed_value(value) for value in
+                                         trial_data.split(',')]), id_)
+                            for id_, trial_data in rows])
+        after_id = rows[-1][0]
+    db.execute('ALTER TABLE {} DROP COLUMN "trial_data"'.format(trial))
+
+
+def add_change_sequence(db):
+    # Existing trials are numbered by id, which is in creation order
+    trial = quoted_table(db, 'Trial')
+    db.execute('ALTER TABLE {} ADD COLUMN "seq" INTEGER NOT NULL DEFAULT 0'
+               .format(trial))
+    db.execute('UPDATE {} SET "seq" = "id"'.format(trial))
+    if columns(db, 'Experiment'):
+        experiment = quoted_table(db, 'Experiment')
+        db.execute('ALTER TABLE {} ADD COLUMN "version" INTEGER NOT NULL '
+                   'DEFAULT 0'.format(experiment))
+        db.execute('UPDATE {0} SET "version" = ('
+                   'SELECT COALESCE(MAX("seq"), 0) FROM {1} '
+                   'WHERE {1}."experiment" = {0}."id")'
+                   .format(experiment, trial))
+
+
+def add_trial_key(db):
+    trial = quoted_table(db, 'Trial')
+    db.execute('ALTER TABLE {} ADD COLUMN "key" VARCHAR(128)'.format(trial))
+
+
+def create_trial_indexes(db):
+    trial = quoted_table(db, 'Trial')
+    db.execute('CREATE INDEX IF NOT EXISTS "idx_trial__experiment_id" '
+               'ON {} ("experiment", "id")'.format(trial))
+    db.execute('CREATE INDEX IF NOT EXISTS "idx_trial__experiment_seq" '
+               'ON {} ("experiment", "seq")'.format(trial))
+    db.execute('CREATE INDEX IF NOT EXISTS "idx_trial__observer" '
+               'ON {} ("observer")'.format(trial))
+
+
+def scope_trial_keys(db):
+    """Make idempotency keys unique per observer, not per experiment"""
+    trial = quoted_table(db, 'Trial')
+    db.execute('DROP INDEX IF EXISTS "unq_trial__experiment_key"')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS '
+               '"unq_trial__experiment_observer_key" '
+               'ON {} ("experiment", "observer", "key")'.format(trial))
+
+
+def create_state_key(db):
+    state = quoted_table(db, 'State')
+    db.execute('DELETE FROM {0} WHERE "id" NOT IN ('
+               'SELECT MAX("id") FROM {0} GROUP BY "experiment", "observer")'
+               .format(state))
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS '
+               '"unq_state__experiment_observer" '
+               'ON {} ("experiment", "observer")'.format(state))
+
+
+def add_state_version(db):
+    db.execute('ALTER TABLE {} ADD COLUMN "version" INTEGER NOT NULL '
+               'DEFAULT 1'.format(quoted_table(db, 'State')))
@@ -1,37 +1,348 @@
 from pony import orm
 
+from .encoding import dumps
+from .patch import json_equal
+
 db = orm.Database()
 
 
+class KeyConflict(ValueError):
+    """An idempotency key was reused for a different trial"""
+
+
 class Experiment(db.Entity):
     owner = orm.Required('User')
     name = orm.Required(str)
     trials = orm.Set('Trial')
     variable_names = orm.Required(str)
+    version = orm.Required(int, default=0)
     _states = orm.Set('State')
 
-    def summary(self):
+    def summary(self, trial_count=None):
+        if trial_count is None:
+            trial_count = self.trials.count()
         return {'id': self.id,
                 'owner': self.owner.id,
                 'name': self.name,
-                'trial_count': len(self.trials),
+                'trial_count': trial_count,
                 'variable_names': self.variable_names}
 
+    @classmethod
+    def all_summaries(cls):
+        return [expr.summary(trial_count)
+                for expr, trial_count in
+                orm.select((e, orm.count(e.trials)) for e in cls)]
+
+    def trial_summaries(self, trials, fields=None):
+        variable_names = self.variable_names.split(',')
+        return [trial.summary(variable_names, fields) for trial in trials]
+
+    def filter_trials(self, after_id=0, before_id=None, observer=None,
+                      where=()):
+        # filter_data refers to the "trial" alias in raw SQL
+        trials = orm.select(trial for trial in Trial
+                            if trial.experiment == self and
+                            trial.id > after_id)
+        if before_id is not None:
+            trials = trials.filter(lambda t: t.id < before_id)
+        if observer is not None:
+            trials = trials.filter(lambda t: t.observer.id == observer)
+        for index, operator, value in where:
+            trials = filter_data(trials, index, operator, value)
+        return trials
+
+    def select_trials(self, after_id=0, **filters):
+        return self.filter_trials(after_id, **filters).order_by(Trial.id)
+
+    def next_seq(self, count=1):
+        """Reserve count change sequence numbers and return the first
+
+        Call on an experiment loaded with get_for_update, so that
+        sequence numbers are committed in order.
+        """
+        self.version += count
+        return self.version - count + 1
+
+    def add_trials(self, observer, rows, keys=None):
+        """Create trials, reusing trials whose idempotency key is known
+
+        Keys belong to the observer. Call on an experiment loaded with
+        get_for_update. New trials are inserted with one statement and
+        not loaded as entities. Returns an AddedTrial per row, in order,
+        or raises KeyConflict if a known key comes with other data.
+        """
+        if keys is None:
+            keys = [None] * len(rows)
+        variable_names = self.variable_names.split(',')
+        known = {trial.key: AddedTrial(trial.id, trial.seq, self.id,
+                                       observer.id, variable_names,
+                                       trial.data)
+                 for trial in self.trials_by_key(
+                     observer, {key for key in keys if key is not None})}
+        trials = []
+        new = []
+        for key, data in zip(keys, rows):
+            trial = None if key is None else known.get(key)
+            if trial is None:
+                trial = AddedTrial(None, None, self.id, observer.id,
+                                   variable_names, data)
+                new.append((key, trial))
+                if key is not None:
+                    known[key] = trial
+            elif not json_equal(trial.data, data):
+                raise KeyConflict(
+                    'Key {!r} was used for another trial'.format(key))
+            trials.append(trial)
+
+        if new:
+            first = self.next_seq(len(new))
+            for seq, (key, trial) in enumerate(new, first):
+                trial.seq = seq
+            orm.flush()
+            insert_trials([(self.id, observer.id, trial.data, trial.seq, key)
+                           for key, trial in new])
+            ids = dict(orm.select((t.seq, t.id) for t in Trial
+                                  if t.experiment == self and t.seq >= first))
+            for key, trial in new:
+                trial.id = ids[trial.seq]
+        return trials
+
+    def trials_by_key(self, observer, keys):
+        if not keys:
+            return []
+        return self.trials.select(
+            lambda t: t.observer == observer and t.key in keys)
+
+    def select_changes(self, since=0):
+        return self.trials.select(lambda t: t.seq > since).order_by(Trial.seq)
+
+    def variable_types(self, **filters):
+        """JSON types of each variable's values, and the last trial id
+
+        Types are named as in JSON_TYPES. Runs a single query.
+        """
+        variable_names = self.variable_names.split(',')
+        columns = ['orm.max(t.id)']
+        sql = {}
+        for index in range(len(variable_names)):
+            for type_ in JSON_TYPES:
+                name = '{}{}'.format(type_, index)
+                sql[name] = is_type_sql(type_, index)
+                columns.append('orm.max(orm.raw_sql({}, int))'.format(name))
+        query = '({},) for t in trials'.format(', '.join(columns))
+        row = orm.select(query, globals(), dict(
+            sql, trials=self.filter_trials(**filters)))[:][0]
+        flags = iter(row[1:])
+        return ({name: {type_ for type_ in JSON_TYPES if next(flags)}
+                 for name in variable_names},
+                row[0])
+
+    def aggregate_trials(self, group_by=(), values=(), stats=('mean',),
+                         quantiles=(), **filters):
+        """Grouped count and statistics of numeric variables, run in SQL
+
+        Values that are not JSON numbers are left out of the statistics.
+        Each variable reports how many numeric values it had as count.
+        """
+        variable_names = self.variable_names.split(',')
+        keys = [group_key(variable_names, name) for name in group_by]
+        columns = keys + ['orm.count(t)']
+        sql = {}
+        for i, value in enumerate(values):
+            index = variable_names.index(value)
+            sql['number{}'.format(i)] = numeric_sql(index)
+            sql['is_number{}'.format(i)] = is_type_sql('number', index)
+            columns.append('orm.sum(orm.raw_sql(is_number{}, int))'.format(i))
+            columns.extend(
+                'orm.{}(orm.raw_sql(number{}, float))'.format(
+                    AGGREGATES[stat], i) for stat in stats)
+
+        trials = self.filter_trials(**filters)
+        groups = {}
+        query = '({},) for t in trials'.format(', '.join(columns))
+        for row in orm.select(query, globals(), dict(sql, trials=trials))[:]:
+            row = as_tuple(row)
+            group = dict(zip(group_by, row))
+            group['count'] = row[len(keys)]
+            aggregates = iter(row[len(keys) + 1:])
+            for value in values:
+                group[value] = {'count': next(aggregates) or 0}
+                group[value].update((stat, next(aggregates))
+                                    for stat in stats)
+            groups[hashable(row[:len(keys)])] = group
+
+        # Quantiles need the sorted samples, so only these are fetched
+        for value in (values if quantiles else ()):
+            number = numeric_sql(variable_names.index(value))
+            samples = {}
+            query = '({}orm.raw_sql(number, float),) for t in trials'.format(
+                ''.join(key + ', ' for key in keys))
+            rows = orm.select(query, globals(),
+                              {'trials': trials, 'number': number})
+            for row in map(as_tuple, rows.without_distinct()):
+                if row[-1] is not None:
+                    samples.setdefault(hashable(row[:-1]), []).append(
+                        row[-1])
+            for key, sample in samples.items():
+                sample.sort()
+                groups[key][value].update(
+                    ('q{:g}'.format(q), quantile(sample, q))
+                    for q in quantiles)
+
+        return list(groups.values())
+
 
 class Trial(db.Entity):
+    id = orm.PrimaryKey(int, auto=True)
     experiment = orm.Required(Experiment)
-    observer = orm.Required('User')
-    trial_data = orm.Required(str)
+    observer = orm.Required('User', index='idx_trial__observer')
+    data = orm.Required(orm.Json)
+    seq = orm.Required(int, default=0)
+    key = orm.Optional(str, 128, nullable=True)
+    orm.composite_index(experiment, id)
+    orm.composite_index(experiment, seq)
+    orm.composite_key(experiment, observer, key)
+
+    def summary(self, variable_names=None, fields=None):
+        if variable_names is None:
+            variable_names = self.experiment.variable_names.split(',')
+        return trial_summary(self.id, self.experiment.id, self.observer.id,
+                             variable_names, self.data, fields)
+
+
+class AddedTrial(object):
+    """A trial written by add_trials, summarized without loading it"""
+
+    def __init__(self, id, seq, experiment, observer, variable_names, data):
+        self.id = id
+        self.seq = seq
+        self.experiment = experiment
+        self.observer = observer
+        self.variable_names = variable_names
+        self.data = data
 
     def summary(self):
-        data = {'id': self.id,
-                'experiment': self.experiment.id,
-                'observer': self.observer.id}
-        data.update({key: value
-                    for key, value in
-                    zip(self.experiment.variable_names.split(','),
-                        self.trial_data.split(','))})
-        return data
+        return trial_summary(self.id, self.experiment, self.observer,
+                             self.variable_names, self.data)
+
+
+def trial_summary(trial_id, exp_id, observer_id, variable_names, values,
+                  fields=None):
+    data = {'id': trial_id,
+            'experiment': exp_id,
+            'observer': observer_id}
+    data.update(zip(variable_names, values))
+    if fields is not None:
+        data = {key: data[key] for key in fields}
+    return data
+
+
+def insert_trials(rows):
+    """Insert (experiment, observer, data, seq, key) rows in one statement
+
+    Pony inserts entities one statement at a time, which dominates the
+    time of large batches.
+    """
+    provider = db.provider
+    placeholder = '?' if provider.paramstyle == 'qmark' else '%s'
+    to_json = Trial.data.converters[0].val2dbval
+    sql = 'INSERT INTO {} ("experiment", "observer", "data", "seq", ' \
+        '"key") VALUES ({})'.format(provider.quote_name(Trial._table_),
+                                    ', '.join([placeholder] * 5))
+    connection = db.get_connection()
+    provider.execute(connection.cursor(), sql,
+                     [(exp_id, observer_id, to_json(data), seq, key)
+                      for exp_id, observer_id, data, seq, key in rows])
+
+
+AGGREGATES = {'mean': 'avg', 'sum': 'sum', 'min': 'min', 'max': 'max'}
+
+
+def group_key(variable_names, name):
+    if name == 'observer':
+        return 't.observer.id'
+    return 't.data[{}]'.format(variable_names.index(name))
+
+
+def as_tuple(row):
+    # Pony returns single column rows as plain values
+    return row if isinstance(row, tuple) else (row,)
+
+
+def hashable(values):
+    """Group key of JSON values; arrays and objects by their JSON text"""
+    return tuple(dumps(value) if isinstance(value, (list, dict)) else value
+                 for value in values)
+
+
+def quantile(sample, q):
+    """Linear interpolation between closest ranks of a sorted sample"""
+    position = (len(sample) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(sample) - 1)
+    return sample[lower] + (sample[upper] - sample[lower]) * (position - lower)
+
+
+# Raw SQL for the type and value of "trial"."data"[index], per dialect
+JSON_SQL = {
+    'SQLite': {
+        'number': 'json_type("trial"."data", \'$$[{index}]\') IN '
+                  "('integer', 'real')",
+        'text': 'json_type("trial"."data", \'$$[{index}]\') = \'text\'',
+        'real': 'CAST(json_extract("trial"."data", \'$$[{index}]\') '
+                'AS REAL)',
+        'string': 'json_extract("trial"."data", \'$$[{index}]\')',
+        'boolean': 'json_type("trial"."data", \'$$[{index}]\') IN '
+                   "('true', 'false')",
+        'composite': 'json_type("trial"."data", \'$$[{index}]\') IN '
+                     "('array', 'object')",
+    },
+    'PostgreSQL': {
+        'number': 'jsonb_typeof("trial"."data" -> {index}) = \'number\'',
+        'text': 'jsonb_typeof("trial"."data" -> {index}) = \'string\'',
+        'real': '("trial"."data" ->> {index})::float8',
+        'string': '("trial"."data" ->> {index})',
+        'boolean': 'jsonb_typeof("trial"."data" -> {index}) = \'boolean\'',
+        'composite': 'jsonb_typeof("trial"."data" -> {index}) IN '
+                     "('array', 'object')",
+    },
+}
+JSON_TYPES = ('number', 'text', 'boolean', 'composite')
+SQL_OPERATORS = {'eq': '=', 'ne': '=', 'lt': '<', 'lte': '<=', 'gt': '>',
+                 'gte': '>='}
+
+
+def json_sql(name, index):
+    return JSON_SQL[db.provider.dialect][name].format(index=int(index))
+
+
+def numeric_sql(index):
+    """The value as float if it is a JSON number, else NULL"""
+    return 'CASE WHEN {} THEN {} END'.format(json_sql('number', index),
+                                             json_sql('real', index))
+
+
+def is_type_sql(name, index):
+    return 'CASE WHEN {} THEN 1 ELSE 0 END'.format(json_sql(name, index))
+
+
+def filter_data(trials, index, operator, value):
+    """Compare numbers with numbers and strings with strings
+
+    Values of the other JSON type never match, except for 'ne'.
+    """
+    if operator not in SQL_OPERATORS:
+        raise ValueError('Unknown operator {!r}'.format(operator))
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        type_check, column = json_sql('number', index), json_sql('real', index)
+    else:
+        type_check, column = json_sql('text', index), json_sql('string', index)
+        value = str(value)
+    sql = '{} AND {} {} $value'.format(type_check, column,
+                                       SQL_OPERATORS[operator])
+    if operator == 'ne':
+        sql = 'NOT ({})'.format(sql)
+    return trials.filter(lambda t: orm.raw_sql(sql))
 
 
 class User(db.Entity):
@@ -42,14 +353,30 @@ class User(db.Entity):
     isadmin = orm.Required(bool, default=False)
     _states = orm.Set('State')
 
-    def safe_json(self):
+    def safe_json(self, trial_count=None, experiment_count=None):
+        if trial_count is None:
+            trial_count = self.trials.count()
+        if experiment_count is None:
+            experiment_count = self.experiments.count()
         return {'id': self.id,
                 'username': self.username,
-                'trial_count': len(self.trials),
-                'experiment_count': len(self.experiments)}
+                'trial_count': trial_count,
+                'experiment_count': experiment_count}
+
+    @classmethod
+    def all_safe_json(cls):
+        trial_counts = dict(orm.select((t.observer.id, orm.count(t))
+                                       for t in Trial))
+        experiment_counts = dict(orm.select((e.owner.id, orm.count(e))
+                                            for e in Experiment))
+        return [user.safe_json(trial_counts.get(user.id, 0),
+                               experiment_counts.get(user.id, 0))
+                for user in orm.select(u for u in cls)]
 
 
 class State(db.Entity):
     experiment = orm.Required(Experiment)
     observer = orm.Required(User)
     state_json = orm.Required(str)
+    version = orm.Required(int, default=1)
+    orm.composite_key(experiment, observer)
@@ -0,0 +1,144 @@
+import copy
+
+MERGE_PATCH = 'application/merge-patch+json'
+JSON_PATCH = 'application/json-patch+json'
+
+
+class PatchError(ValueError):
+    pass
+
+
+def merge_patch(target, patch):
+    """Apply an RFC 7386 JSON merge patch"""
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    if not isinstance(target, dict):
+        target = {}
+    else:
+        target = dict(target)
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = merge_patch(target.get(key), value)
+    return target
+
+
+def json_type(value):
+    for type_ in (bool, str, dict, list):
+        if isinstance(value, type_):
+            return type_
+    if isinstance(value, (int, float)):
+        return float
+    return type(value)
+
+
+def json_equal(a, b):
+    """Equality of JSON values as in RFC 6902: true is not 1, 1 is 1.0"""
+    if json_type(a) is not json_type(b):
+        return False
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(json_equal(a[key], b[key])
+                                            for key in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(map(json_equal, a, b))
+    return a == b
+
+
+def parse_pointer(pointer):
+    if pointer == '':
+        return []
+    if not isinstance(pointer, str) or not pointer.startswith('/'):
+        raise PatchError('Invalid JSON pointer {!r}'.format(pointer))
+    return [token.replace('~1', '/').replace('~0', '~')
+            for token in pointer[1:].split('/')]
+
+
+def list_index(container, token, appending=False):
+    if appending and token == '-':
+        return len(container)
+    if not token.isdigit() or (token != '0' and token.startswith('0')):
+        raise PatchError('Invalid array index {!r}'.format(token))
+    index = int(token)
+    if index > len(container) or (index == len(container) and not appending):
+        raise PatchError('Array index {} out of range'.format(index))
+    return index
+
+
+def resolve(document, tokens):
+    for token in tokens:
+        if isinstance(document, dict):
+            if token not in document:
+                raise PatchError('Missing member {!r}'.format(token))
+            document = document[token]
+        elif isinstance(document, list):
+            document = document[list_index(document, token)]
+        else:
+            raise PatchError('Cannot descend into {!r}'.format(document))
+    return document
+
+
+def add(document, tokens, value):
+    if not tokens:
+        return value
+    parent = resolve(document, tokens[:-1])
+    if isinstance(parent, dict):
+        parent[tokens[-1]] = value
+    elif isinstance(parent, list):
+        parent.insert(list_index(parent, tokens[-1], appending=True), value)
+    else:
+        raise PatchError('Cannot add to {!r}'.format(parent))
+    return document
+
+
+def remove(document, tokens):
+    if not tokens:
+        raise PatchError('Cannot remove the whole document')
+    parent = resolve(document, tokens[:-1])
+    if isinstance(parent, dict):
+        if tokens[-1] not in parent:
+            raise PatchError('Missing member {!r}'.format(tokens[-1]))
+        return parent.pop(tokens[-1])
+    if isinstance(parent, list):
+        return parent.pop(list_index(parent, tokens[-1]))
+    raise PatchError('Cannot remove from {!r}'.format(parent))
+
+
+def json_patch(document, operations):
+    """Apply RFC 6902 operations; the original document is not modified"""
+    if not isinstance(operations, list):
+        raise PatchError('A JSON patch is a list of operations')
+    document = copy.deepcopy(document)
+    for operation in operations:
+        try:
+            op = operation['op']
+            path = parse_pointer(operation['path'])
+            if op == 'add':
+                document = add(document, path,
+                               copy.deepcopy(operation['value']))
+            elif op == 'remove':
+                remove(document, path)
+            elif op == 'replace':
+                resolve(document, path)
+                if path:
+                    remove(document, path)
+                document = add(document, path,
+                               copy.deepcopy(operation['value']))
+            elif op in ('move', 'copy'):
+                source = parse_pointer(operation['from'])
+                if op == 'move' and path[:len(source)] == source and \
+                        path != source:
+                    raise PatchError('Cannot move a value into itself')
+                value = copy.deepcopy(resolve(document, source))
+                if op == 'move':
+                    remove(document, source)
+                document = add(document, path, value)
+            elif op == 'test':
+                if not json_equal(resolve(document, path), operation['value']):
+                    raise PatchError('Test failed at {}'.format(
+                        operation['path']))
+            else:
+                raise PatchError('Unknown operation {!r}'.format(op))
+        except (KeyError, TypeError):
+            raise PatchError('Malformed operation {!r}'.format(operation))
+    return document
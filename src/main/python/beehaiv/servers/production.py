@@ -1,7 +1,8 @@
 import os
 import hug
 from pony import orm
-from beehaiv import api, models
+from beehaiv import api, crypto, ingest, metrics, migrations, models, \
+    storage
 
 
 @hug.extend_api()
@@ -9,15 +10,22 @@ def main_api():
     return [api]
 
 
-api.db.bind(provider='sqlite',
-            filename=os.environ['BEEHAIV_STORAGE'],
-            create_db=True)
+storage.use_sqlite_pragmas(api.db, storage.sqlite_pragmas())
+storage.bind(api.db, storage.database_url())
+metrics.instrument(api.db)
+migrations.upgrade(api.db)
 api.db.generate_mapping(create_tables=True)
 
+if os.getenv('BEEHAIV_WRITE_BEHIND'):
+    ingest.start(
+        queue_size=int(os.getenv('BEEHAIV_WRITE_QUEUE_SIZE', '1000')),
+        batch_size=int(os.getenv('BEEHAIV_WRITE_BATCH_SIZE', '500')),
+        flush_interval=float(os.getenv('BEEHAIV_WRITE_FLUSH_INTERVAL', '0.2')))
+
 admin_user, admin_pass = os.environ['BEEHAIV_ADMIN'].split(':')
 with orm.db_session():
     user = models.User.get(username=admin_user)
     if not user:
         models.User(username=admin_user,
-                    password=admin_pass,
+                    password=crypto.hash_password(admin_pass),
                     isadmin=True)
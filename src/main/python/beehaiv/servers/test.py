@@ -1,6 +1,7 @@
+import os
 import hug
 from pony import orm
-from beehaiv import api, models
+from beehaiv import api, crypto, metrics, models, storage
 
 
 @hug.extend_api()
@@ -8,8 +9,11 @@ def main_api():
     return [api]
 
 
-api.db.bind(provider='sqlite', filename=':memory:')
+storage.bind(api.db, os.getenv('BEEHAIV_DATABASE_URL', 'sqlite:///:memory:'))
+metrics.instrument(api.db)
 api.db.generate_mapping(create_tables=True)
 
 with orm.db_session():
-    models.User(username='testuser', password='testpass', isadmin=True)
+    models.User(username='testuser',
+                password=crypto.hash_password('testpass'),
+                isadmin=True)
@@ -0,0 +1,72 @@
+import os
+import re
+from urllib.parse import urlparse, parse_qsl, unquote
+
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'BEEHAIV_SQLITE_JOURNAL_MODE', 'WAL'),
+    ('synchronous', 'BEEHAIV_SQLITE_SYNCHRONOUS', 'NORMAL'),
+    ('mmap_size', 'BEEHAIV_SQLITE_MMAP_SIZE', '268435456'),
+    ('cache_size', 'BEEHAIV_SQLITE_CACHE_SIZE', '-65536'),
+    ('busy_timeout', 'BEEHAIV_SQLITE_BUSY_TIMEOUT', '5000'),
+    ('temp_store', 'BEEHAIV_SQLITE_TEMP_STORE', 'MEMORY'),
+]
+
+
+def sqlite_pragmas(environ=os.environ):
+    if environ.get('BEEHAIV_SQLITE_PROFILE', 'tuned') != 'tuned':
+        return []
+    pragmas = []
+    for name, variable, default in SQLITE_PRAGMAS:
+        value = environ.get(variable, default)
+        if not value:
+            continue
+        if not re.match(r'^-?\w+$', value):
+            raise ValueError(
+                'Invalid value {!r} for {}'.format(value, variable))
+        pragmas.append((name, value))
+    return pragmas
+
+
+def use_sqlite_pragmas(db, pragmas):
+    """Run the pragmas on every new SQLite connection, call before bind"""
+    @db.on_connect(provider='sqlite')
+    def set_sqlite_pragmas(db, connection):
+        cursor = connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+
+
+def database_url(environ=os.environ):
+    if 'BEEHAIV_DATABASE_URL' in environ:
+        return environ['BEEHAIV_DATABASE_URL']
+    return 'sqlite:///' + environ['BEEHAIV_STORAGE']
+
+
+def bind_arguments(url):
+    """Translate a database URL into keyword arguments for db.bind()"""
+    if url.startswith('sqlite:///'):
+        filename = url[len('sqlite:///'):]
+        if filename != ':memory:':
+            return {'provider': 'sqlite',
+                    'filename': os.path.abspath(filename),
+                    'create_db': True}
+        return {'provider': 'sqlite', 'filename': filename}
+
+    parsed = urlparse(url)
+    if parsed.scheme not in ('postgres', 'postgresql'):
+        raise ValueError('Unsupported database URL {!r}'.format(url))
+    kwargs = {'provider': 'postgres', 'database': parsed.path.lstrip('/')}
+    if parsed.hostname:
+        kwargs['host'] = parsed.hostname
+    if parsed.port:
+        kwargs['port'] = parsed.port
+    if parsed.username:
+        kwargs['user'] = unquote(parsed.username)
+    if parsed.password:
+        kwargs['password'] = unquote(parsed.password)
+    kwargs.update(parse_qsl(parsed.query))
+    return kwargs
+
+
+def bind(db, url):
+    db.bind(**bind_arguments(url))
@@ -0,0 +1,66 @@
+from pony import orm
+
+from .encoding import dumps
+from .models import Experiment
+
+BATCH_SIZE = 1000
+
+
+class Stream(object):
+    """File like wrapper that hug passes on to falcon as response stream"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+
+    def read(self, size=-1):
+        return next(self.chunks, b'')
+
+    def close(self):
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def trial_batches(exp_id, after_id=0, limit=None, batch_size=BATCH_SIZE,
+                  fields=None, **filters):
+    """Yield trial summaries in id order, one db_session per batch"""
+    while limit is None or limit > 0:
+        size = batch_size if limit is None else min(batch_size, limit)
+        with orm.db_session():
+            expr = Experiment[exp_id]
+            trials = expr.select_trials(after_id, **filters)[:size]
+            batch = expr.trial_summaries(trials, fields)
+        if not trials:
+            return
+        yield batch
+        after_id = trials[-1].id
+        if limit is not None:
+            limit -= len(trials)
+        if len(trials) < size:
+            return
+
+
+def trial_changes(exp_id, since=0, batch_size=BATCH_SIZE):
+    """Yield (seq, trial summary) pairs in change order"""
+    while True:
+        with orm.db_session():
+            expr = Experiment[exp_id]
+            trials = expr.select_changes(since)[:batch_size]
+            batch = [(trial.seq, trial.summary()) for trial in trials]
+        yield from batch
+        if len(batch) < batch_size:
+            return
+        since = batch[-1][0]
+
+
+def ndjson_lines(batches):
+    for batch in batches:
+        yield b''.join(dumps(item) + b'\n' for item in batch)
+
+
+def json_array(batches):
+    separator = b'['
+    for batch in batches:
+        yield separator + b','.join(dumps(item) for item in batch)
+        separator = b','
+    yield b']' if separator == b',' else b'[]'
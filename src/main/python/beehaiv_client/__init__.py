@@ -0,0 +1,4 @@
+from .client import Client, UploadError
+from .journal import Journal
+
+__all__ = ['Client', 'Journal', 'UploadError']
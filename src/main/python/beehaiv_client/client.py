@@ -0,0 +1,176 @@
+import base64
+import json
+import logging
+import threading
+import time
+
+import requests
+
+from .journal import Journal
+
+logger = logging.getLogger(__name__)
+
+TOKEN_MARGIN = 30
+# Proxies and a full write-behind queue answer with these while the
+# server is unavailable, so they never count towards max_server_errors
+TRANSIENT_ERRORS = (502, 503, 504)
+
+
+class UploadError(Exception):
+    pass
+
+
+def token_expiry(token):
+    """exp claim of a JWT, read without verifying it"""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))['exp']
+    except (IndexError, KeyError, TypeError, ValueError):
+        return 0
+
+
+class Client(object):
+    """Records trials in a local journal and uploads them in the background
+
+    record() only writes to the journal, so the experiment loop never
+    waits for the network. Trials left over from a crash or a lost
+    connection are uploaded once the client runs again.
+    """
+
+    def __init__(self, url, username, password,
+                 journal='beehaiv-journal.sqlite3',
+                 batch_size=100,
+                 flush_interval=1.0,
+                 max_backoff=60.0,
+                 max_server_errors=5,
+                 session=None):
+        self.url = url.rstrip('/')
+        self.credentials = (username, password)
+        if not isinstance(journal, Journal):
+            journal = Journal(journal)
+        self.journal = journal
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.max_server_errors = max_server_errors
+        self.server_errors = {}
+        self.session = session or requests.Session()
+        self.token = None
+        self.token_expires = 0
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run,
+                                       name='beehaiv-uploader',
+                                       daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def record(self, exp_id, trial):
+        """Journal a trial for upload and return its key
+
+        Raises ValueError if the trial contains NaN or infinite numbers.
+        """
+        return self.journal.append(exp_id, trial)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """Stop after one more upload attempt; the rest stays journaled"""
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+    def flush(self, timeout=None):
+        """Wait until every journaled trial is uploaded"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.journal.count():
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            self.wakeup.set()
+            time.sleep(0.05)
+        return True
+
+    def run(self):
+        backoff = 0
+        while True:
+            try:
+                self.upload_pending()
+                backoff = 0
+            except (requests.RequestException, UploadError) as error:
+                backoff = min(max(2 * backoff, self.flush_interval),
+                              self.max_backoff)
+                logger.warning('Upload failed, retrying in %.1f s: %s',
+                               backoff, error)
+            if self.stopped.is_set():
+                return
+            self.wakeup.wait(backoff or self.flush_interval)
+            self.wakeup.clear()
+
+    def upload_pending(self):
+        while True:
+            batch = self.journal.next_batch(self.batch_size)
+            if batch is None:
+                return
+            self.upload(*batch)
+
+    def upload(self, batch, exp_id, trials):
+        response = self.post('/v1/experiments/{}/trials/'.format(exp_id),
+                             [dict(trial, _key=key) for key, trial in trials],
+                             {'Idempotency-Key': batch})
+        if response.status_code in (200, 202):
+            self.server_errors = {}
+            self.journal.finish(batch)
+        elif response.status_code in (400, 404, 409, 422) or \
+                self.server_error(batch, response.status_code):
+            # Retrying cannot succeed, keep the trials for inspection
+            logger.error('Server rejected %d trials for experiment %s: '
+                         '%s %s', len(trials), exp_id,
+                         response.status_code, response.text)
+            self.server_errors = {}
+            self.journal.finish(batch, 'rejected')
+        else:
+            raise UploadError('{} {}'.format(response.status_code,
+                                             response.reason))
+
+    def server_error(self, batch, status_code):
+        """Count a failed upload of batch, True if it is time to give up
+
+        Without this, a batch the server keeps failing on would block
+        every trial journaled after it.
+        """
+        if status_code < 500 or status_code in TRANSIENT_ERRORS:
+            return False
+        errors = self.server_errors.get(batch, 0) + 1
+        self.server_errors = {batch: errors}
+        return errors >= self.max_server_errors
+
+    def post(self, path, body, headers):
+        headers = dict(headers, Authorization=self.access_token())
+        response = self.session.post(self.url + path, json=body,
+                                     headers=headers)
+        if response.status_code == 401:
+            self.token = None
+            headers['Authorization'] = self.access_token()
+            response = self.session.post(self.url + path, json=body,
+                                         headers=headers)
+        return response
+
+    def access_token(self):
+        if self.token is None or \
+                self.token_expires - TOKEN_MARGIN < time.time():
+            response = self.session.get(self.url + '/v1/token/',
+                                        auth=self.credentials)
+            if response.status_code != 200:
+                raise UploadError('Cannot get token: {} {}'.format(
+                    response.status_code, response.reason))
+            self.token = response.json()
+            self.token_expires = token_expiry(self.token)
+        return self.token
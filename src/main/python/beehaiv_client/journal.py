@@ -0,0 +1,87 @@
+import json
+import sqlite3
+import threading
+import uuid
+
+
+class Journal(object):
+    """Append-only SQLite journal of trials waiting for upload
+
+    Trials are grouped into batches when they are first sent. A batch
+    keeps its key until the server has accepted it, so retrying a batch
+    sends the same trials under the same key.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connection().executescript(
+            'CREATE TABLE IF NOT EXISTS trials ('
+            '  id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            '  key TEXT NOT NULL UNIQUE,'
+            '  experiment INTEGER NOT NULL,'
+            '  data TEXT NOT NULL,'
+            '  batch TEXT,'
+            '  status TEXT NOT NULL DEFAULT \'pending\');'
+            'CREATE INDEX IF NOT EXISTS idx_trials_status '
+            '  ON trials (status, id);')
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def append(self, exp_id, trial, key=None):
+        """Journal a trial, NaN and infinite numbers raise ValueError"""
+        key = key or uuid.uuid4().hex
+        self.connection().execute(
+            'INSERT INTO trials (key, experiment, data) VALUES (?, ?, ?)',
+            (key, exp_id, json.dumps(trial, allow_nan=False)))
+        return key
+
+    def next_batch(self, size):
+        """Unfinished batch or a new one: (batch key, exp_id, trials)"""
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                "SELECT batch, experiment FROM trials "
+                "WHERE status = 'pending' ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                connection.execute('COMMIT')
+                return None
+            batch, exp_id = row
+            if batch is None:
+                batch = uuid.uuid4().hex
+                connection.execute(
+                    "UPDATE trials SET batch = ? WHERE id IN ("
+                    "  SELECT id FROM trials WHERE status = 'pending' "
+                    "  AND batch IS NULL AND experiment = ? "
+                    "  ORDER BY id LIMIT ?)", (batch, exp_id, size))
+            rows = connection.execute(
+                'SELECT key, data FROM trials WHERE batch = ? ORDER BY id',
+                (batch,)).fetchall()
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return batch, exp_id, [(key, json.loads(data)) for key, data in rows]
+
+    def finish(self, batch, status='uploaded'):
+        self.connection().execute(
+            'UPDATE trials SET status = ? WHERE batch = ?', (status, batch))
+
+    def count(self, status='pending'):
+        return self.connection().execute(
+            'SELECT COUNT(*) FROM trials WHERE status = ?',
+            (status,)).fetchone()[0]
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
@@ -1,14 +1,25 @@
-from unittest import TestCase
+from unittest import TestCase, mock
+import os
 import hug
+import falcon.testing
 from falcon import HTTP_200, HTTP_400, HTTP_404, HTTP_409, HTTP_401
+from falcon import HTTP_202, HTTP_304, HTTP_412, HTTP_415, HTTP_422
+from falcon import HTTP_503
 from pony import orm
 from base64 import b64encode
+import csv
+import gzip
+import io
 import json
+import unittest
 
-from beehaiv import api
+from beehaiv import api, crypto, encoding, events, export, ingest, metrics, \
+    patch, storage
 from beehaiv.crypto import create_token, get_basic_token
 
-api.db.bind(provider='sqlite', filename=':memory:')
+storage.bind(api.db, os.getenv('BEEHAIV_TEST_DATABASE_URL',
+                               'sqlite:///:memory:'))
+metrics.instrument(api.db)
 api.db.generate_mapping(create_tables=True)
 
 
@@ -17,6 +28,8 @@ class TestExperimentsEndpoint(TestCase):
     def setUp(self):
         api.db.drop_all_tables(with_all_data=True)
         api.db.create_tables()
+        crypto.credentials.clear()
+        api.trial_keys.clear()
         self.expected_expr_keys = {'id', 'owner', 'name', 'trial_count',
                                    'variable_names'}
         self.expected_trial_keys = {'id', 'experiment', 'observer', 'stimulus',
@@ -55,7 +68,7 @@ class TestExperimentsEndpoint(TestCase):
         trials = [
             api.Trial(experiment=expr,
                       observer=observer,
-                      trial_data='ANY_RESPONSE,ANY_STIMULUS,ANY_CONDITION')
+                      data=['ANY_RESPONSE', 'ANY_STIMULUS', 'ANY_CONDITION'])
             for _ in range(n)]
         orm.commit()
         return [trial.id for trial in trials]
@@ -67,7 +80,7 @@ class TestExperimentsEndpoint(TestCase):
         if basic:
             user = api.User[userid]
             basic_token = b64encode(
-                '{}:{}'.format(user.username, user.password).encode('utf8')
+                '{}:{}'.format(user.username, 'ANY_PASSWORD').encode('utf8')
             ).decode('utf8')
             return {'Authorization': 'Basic {}'.format(basic_token)}
         else:
@@ -88,6 +101,18 @@ class TestExperimentsEndpoint(TestCase):
         first_expr = resp.data[0]
         self.assertSetEqual(set(first_expr.keys()), self.expected_expr_keys)
 
+    def test_get_experiments_counts_trials(self):
+        userid, expid = self.create_experiment_with_user()
+        self.create_experiment_with_user(userid)
+        self.create_trials_in_experiment(expid, userid, 3)
+
+        resp = hug.test.get(api, '/v1/experiments/', headers=self.get_header())
+
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual({expr['id']: expr['trial_count']
+                          for expr in resp.data},
+                         {expid: 3, expid + 1: 0})
+
     def test_post_experiments_creates_and_returns(self):
         resp = hug.test.post(api,
                              '/v1/experiments/',
@@ -157,7 +182,7 @@ class TestExperimentsEndpoint(TestCase):
                             headers=self.get_header())
 
         self.assertEqual(resp.status, HTTP_200)
-        self.assertSequenceEqual(json.loads(resp.data), [])
+        self.assertSequenceEqual(resp.data, [])
 
     def test_get_all_trials_for_exp(self):
         userid, expid = self.create_experiment_with_user()
@@ -168,7 +193,55 @@ class TestExperimentsEndpoint(TestCase):
                             headers=self.get_header())
 
         self.assertEqual(resp.status, HTTP_200)
-        self.assertEqual(len(json.loads(resp.data)), 2)
+        self.assertEqual(len(resp.data), 2)
+
+    def test_get_all_trials_page_after_id(self):
+        userid, expid = self.create_experiment_with_user()
+        trial_ids = self.create_trials_in_experiment(expid, userid, 5)
+
+        resp = hug.test.get(api,
+                            '/v1/experiments/{}/trials'.format(expid),
+                            {'after_id': trial_ids[1], 'limit': 2},
+                            headers=self.get_header())
+
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual([trial['id'] for trial in resp.data],
+                         trial_ids[2:4])
+
+    def test_get_all_trials_with_negative_limit(self):
+        userid, expid = self.create_experiment_with_user()
+        for params in [{'limit': -1}, {'limit': -1, 'stream': 'json'}]:
+            resp = hug.test.get(api,
+                                '/v1/experiments/{}/trials'.format(expid),
+                                params, headers=self.get_header())
+            self.assertEqual(resp.status, HTTP_400)
+
+    def test_get_all_trials_streamed_as_ndjson(self):
+        userid, expid = self.create_experiment_with_user()
+        self.create_trials_in_experiment(expid, userid, 3)
+
+        resp = hug.test.get(api,
+                            '/v1/experiments/{}/trials'.format(expid),
+                            {'stream': 'ndjson'},
+                            headers=self.get_header())
+
+        self.assertEqual(resp.status, HTTP_200)
+        lines = resp.data.splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertSetEqual(set(json.loads(lines[0]).keys()),
+                            self.expected_trial_keys)
+
+    def test_get_all_trials_streamed_as_json(self):
+        userid, expid = self.create_experiment_with_user()
+        self.create_trials_in_experiment(expid, userid, 3)
+
+        resp = hug.test.get(api,
+                            '/v1/experiments/{}/trials'.format(expid),
+                            {'stream': 'json', 'limit': 2},
+                            headers=self.get_header())
+
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual(len(resp.data), 2)
 
     def test_get_all_trials_from_nonexisting_exp(self):
         resp = hug.test.get(api,
@@ -187,6 +260,19 @@ class TestExperimentsEndpoint(TestCase):
         self.assertEqual(resp.status, HTTP_200)
         self.assertEqual(set(resp.data.keys()), self.expected_trial_keys)
 
+    def test_post_trial_keeps_commas_and_numbers(self):
+        userid, expid = self.create_experiment_with_user()
+        resp = hug.test.post(api,
+                             '/v1/experiments/{}/trials'.format(expid),
+                             {'response': 1,
+                              'stimulus': 0.5,
+                              'condition': 'ANY,CONDITION'},
+                             headers=self.get_header(userid, basic=True))
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual(resp.data['response'], 1)
+        self.assertEqual(resp.data['stimulus'], 0.5)
+        self.assertEqual(resp.data['condition'], 'ANY,CONDITION')
+
     def test_post_trial_to_non_existing_exp(self):
         userid = self.create_user()
         resp = hug.test.post(api,
@@ -205,6 +291,185 @@ class TestExperimentsEndpoint(TestCase):
                              headers=self.get_header(userid, basic=True))
         self.assertEqual(resp.status, HTTP_400)
 
+    def test_post_trial_batch_to_experiment(self):
+        userid, expid = self.create_experiment_with_user()
+        trial = {'response': 'ANY_RESPONSE',
+                 'stimulus': 'ANY_STIMULUS',
+                 'condition': 'ANY_CONDITION'}
+        resp = hug.test.post(api,
+                             '/v1/experiments/{}/trials'.format(expid),
+                             [trial, trial, trial],
+                             headers=self.get_header(userid, basic=True))
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual(len(resp.data), 3)
+        with orm.db_session():
+            self.assertEqual(api.Experiment[expid].trials.count(), 3)
+
+    def test_post_trial_batch_ids_follow_order(self):
+        userid, expid = self.create_experiment_with_user()
+        trials = [{'response': i, 'stimulus': 'ANY_STIMULUS',
+                   'condition': 'ANY_CONDITION'} for i in range(4)]
+        trials[1]['_key'] = trials[3]['_key'] = 'ANY_KEY'
+        trials[3]['response'] = 1
+        resp = hug.test.post(api,
+                             '/v1/experiments/{}/trials'.format(expid),
+                             trials,
+                             headers=self.get_header(userid, basic=True))
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual(resp.data[1], resp.data[3])
+        with orm.db_session():
+            self.assertEqual([api.Trial[i].data[1] for i in resp.data],
+                             [0, 1, 2, 1])
+            self.assertEqual([api.Trial[i].seq for i in resp.data[:3]],
+                             [1, 2, 3])
+            self.assertEqual(api.Experiment[expid].version, 3)
+
+    def test_post_trial_batch_as_ndjson(self):
+        userid, expid = self.create_experiment_with_user()
+        trial = json.dumps({'response': 'ANY_RESPONSE',
+                            'stimulus': 'ANY_STIMULUS',
+                            'condition': 'ANY_CONDITION'})
+        headers = self.get_header(userid, basic=True)
+        headers['content-type'] = 'application/x-ndjson'
+        resp = hug.test.post(api,
+                             '/v1/experiments/{}/trials'.format(expid),
+                             '\n'.join([trial, trial]),
+                             headers=headers)
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual(len(resp.data), 2)
+
+    def test_post_malformed_json(self):
+        userid, expid = self.create_experiment_with_user()
+        for content_type in ['application/json', 'application/x-ndjson']:
+            headers = self.get_header(userid, basic=True)
+            headers['content-type'] = content_type
+            resp = hug.test.post(api,
+                                 '/v1/experiments/{}/trials'.format(expid),
+                                 '{"response": ', headers=headers)
+            self.assertEqual(resp.status, HTTP_400)
+
+    def test_post_trial_with_non_finite_number(self):
+        userid, expid = self.create_experiment_with_user()
+        for orjson in [encoding.orjson, None]:
+            with mock.patch.object(encoding, 'orjson', orjson):
+                resp = hug.test.post(
+                    api, '/v1/experiments/{}/trials'.format(expid),
+                    {'response': float('nan'),
+                     'stimulus': 'ANY_STIMULUS',
+                     'condition': 'ANY_CONDITION'},
+                    headers=self.get_header(userid, basic=True))
+                self.assertEqual(resp.status, HTTP_400)
+                headers = self.get_header(userid, basic=True)
+                headers['content-type'] = 'application/json'
+                resp = hug.test.post(
+                    api, '/v1/experiments/{}/trials'.format(expid),
+                    '{"response": [1e999], "stimulus": 1, "condition": 1}',
+                    headers=headers)
+                self.assertEqual(resp.status, HTTP_400)
+        with orm.db_session():
+            self.assertEqual(api.Experiment[expid].trials.count(), 0)
+
+    def test_post_trial_batch_with_invalid_trial_inserts_nothing(self):
+        userid, expid = self.create_experiment_with_user()
+        resp = hug.test.post(api,
+                             '/v1/experiments/{}/trials'.format(expid),
+                             [{'response': 'ANY_RESPONSE',
+                               'stimulus': 'ANY_STIMULUS',
+                               'condition': 'ANY_CONDITION'},
+                              {'response': 'ANY_RESPONSE'}],
+                             headers=self.get_header(userid, basic=True))
+        self.assertEqual(resp.status, HTTP_400)
+        with orm.db_session():
+            self.assertEqual(api.Experiment[expid].trials.count(), 0)
+
+    def test_post_trial_twice_with_same_key_creates_one_trial(self):
+        userid, expid = self.create_experiment_with_user()
+        trial = {'response': 'ANY_RESPONSE',
+                 'stimulus': 'ANY_STIMULUS',
+                 'condition': 'ANY_CONDITION',
+                 '_key': 'ANY_KEY'}
+        first = hug.test.post(api,
+                              '/v1/experiments/{}/trials'.format(expid),
+                              trial,
+                              headers=self.get_header(userid, basic=True))
+        api.trial_keys.clear()
+        second = hug.test.post(api,
+                               '/v1/experiments/{}/trials'.format(expid),
+                               trial,
+                               headers=self.get_header(userid, basic=True))
+        self.assertEqual(second.status, HTTP_200)
+        self.assertEqual(first.data, second.data)
+        self.assertNotIn('_key', second.data)
+        with orm.db_session():
+            self.assertEqual(api.Experiment[expid].trials.count(), 1)
+
+    def test_same_key_of_other_observer_creates_own_trial(self):
+        userid, expid = self.create_experiment_with_user()
+        other_id = self.create_user('OTHER_USER')
+        trial = {'response': 'ANY_RESPONSE',
+                 'stimulus': 'ANY_STIMULUS',
+                 'condition': 'ANY_CONDITION',
+                 '_key': 'ANY_KEY'}
+        first = hug.test.post(api,
+                              '/v1/experiments/{}/trials'.format(expid),
+                              trial,
+                              headers=self.get_header(userid, basic=True))
+        second = hug.test.post(api,
+                               '/v1/experiments/{}/trials'.format(expid),
+                               trial,
+                               headers=self.get_header(other_id, basic=True))
+        self.assertEqual(second.status, HTTP_200)
+        self.assertNotEqual(first.data['id'], second.data['id'])
+        self.assertEqual(second.data['observer'], other_id)
+
+    def test_same_key_with_other_trial_conflicts(self):
+        userid, expid = self.create_experiment_with_user()
+        trial = {'response': 'ANY_RESPONSE',
+                 'stimulus': 'ANY_STIMULUS',
+                 'condition': 'ANY_CONDITION',
+                 '_key': 'ANY_KEY'}
+        hug.test.post(api, '/v1/experiments/{}/trials'.format(expid), trial,
+                      headers=self.get_header(userid, basic=True))
+        for clear_cache in [False, True]:
+            if clear_cache:
+                api.trial_keys.clear()
+            resp = hug.test.post(api,
+                                 '/v1/experiments/{}/trials'.format(expid),
+                                 dict(trial, response='OTHER_RESPONSE'),
+                                 headers=self.get_header(userid, basic=True))
+            self.assertEqual(resp.status, HTTP_409)
+        with orm.db_session():
+            self.assertEqual(api.Experiment[expid].trials.count(), 1)
+
+    def test_retried_batch_with_idempotency_key_is_answered_from_cache(self):
+        userid, expid = self.create_experiment_with_user()
+        trial = {'response': 'ANY_RESPONSE',
+                 'stimulus': 'ANY_STIMULUS',
+                 'condition': 'ANY_CONDITION'}
+        headers = self.get_header(userid, basic=True)
+        headers['Idempotency-Key'] = 'ANY_KEY'
+        first = hug.test.post(api,
+                              '/v1/experiments/{}/trials'.format(expid),
+                              [trial, trial], headers=headers)
+        with mock.patch.object(api, 'locked_experiment') as locked:
+            second = hug.test.post(api,
+                                   '/v1/experiments/{}/trials'.format(expid),
+                                   [trial, trial], headers=headers)
+        locked.assert_not_called()
+        self.assertEqual(len(set(first.data)), 2)
+        self.assertEqual(first.data, second.data)
+
+    def test_post_trial_with_invalid_key(self):
+        userid, expid = self.create_experiment_with_user()
+        resp = hug.test.post(api,
+                             '/v1/experiments/{}/trials'.format(expid),
+                             {'response': 'ANY_RESPONSE',
+                              'stimulus': 'ANY_STIMULUS',
+                              'condition': 'ANY_CONDITION',
+                              '_key': 1},
+                             headers=self.get_header(userid, basic=True))
+        self.assertEqual(resp.status, HTTP_400)
+
     def test_get_trial_with_id(self):
         userid, expid = self.create_experiment_with_user()
         trial_ids = self.create_trials_in_experiment(expid, userid)
@@ -253,7 +518,7 @@ class TestExperimentsEndpoint(TestCase):
         self.assertEqual(resp.data['stimulus'], 'OTHER_STIMULUS')
         with orm.db_session():
             trial = api.db.Trial[trial_ids[0]]
-            self.assertIn('OTHER_STIMULUS', trial.trial_data.split(','))
+            self.assertIn('OTHER_STIMULUS', trial.data)
 
     def test_put_trial_from_nonexisting_exp(self):
         resp = hug.test.put(api,
@@ -309,6 +574,17 @@ class TestExperimentsEndpoint(TestCase):
         self.assertEqual(resp.status, HTTP_200)
         self.assertEqual(len(resp.data), 2)
 
+    def test_get_all_users_counts_trials_and_experiments(self):
+        userid, expid = self.create_experiment_with_user()
+        self.create_trials_in_experiment(expid, userid, 2)
+
+        resp = hug.test.get(api, '/v1/users/', headers=self.get_header())
+
+        self.assertEqual(resp.status, HTTP_200)
+        user = [user for user in resp.data if user['id'] == userid][0]
+        self.assertEqual(user['trial_count'], 2)
+        self.assertEqual(user['experiment_count'], 1)
+
     def test_put_user_updates_username(self):
         userid = self.create_user()
         resp = hug.test.put(api, '/v1/users/{}'.format(userid),
@@ -325,7 +601,9 @@ class TestExperimentsEndpoint(TestCase):
         self.assertEqual(resp.status, HTTP_200)
         with orm.db_session():
             user = api.User[userid]
-            self.assertEqual(user.password, 'NEW_PASSWORD')
+            self.assertNotEqual(user.password, 'NEW_PASSWORD')
+            self.assertTrue(crypto.check_password('NEW_PASSWORD',
+                                                  user.password))
 
     def test_put_user_on_invalid_key(self):
         userid = self.create_user()
@@ -355,6 +633,8 @@ class TestFlexibleExperimentSetup(TestCase):
     def setUp(self):
         api.db.drop_all_tables(with_all_data=True)
         api.db.create_tables()
+        crypto.credentials.clear()
+        api.trial_keys.clear()
 
         with orm.db_session():
             admin = api.db.User(username='ADMIN_USER',
@@ -372,6 +652,8 @@ class TestFlexibleExperimentSetup(TestCase):
         self.userid = user.id
         self.exp1id = exp1.id
         self.exp2id = exp2.id
+        self.passwords = {admin.id: 'ADMIN_PASSWORD',
+                          user.id: 'ANY_PASSWORD'}
 
     @orm.db_session()
     def get_header(self, userid=None):
@@ -380,7 +662,8 @@ class TestFlexibleExperimentSetup(TestCase):
 
         user = api.User[userid]
         basic_token = b64encode(
-            '{}:{}'.format(user.username, user.password).encode('utf8')
+            '{}:{}'.format(user.username,
+                           self.passwords[userid]).encode('utf8')
         ).decode('utf8')
         return {'Authorization': 'Basic {}'.format(basic_token)}
 
@@ -422,11 +705,697 @@ class TestFlexibleExperimentSetup(TestCase):
         self.assertEqual(resp.status, HTTP_400)
 
 
+class TestTrialQueries(TestCase):
+
+    def setUp(self):
+        api.db.drop_all_tables(with_all_data=True)
+        api.db.create_tables()
+        crypto.credentials.clear()
+        api.trial_keys.clear()
+
+        with orm.db_session():
+            admin = api.User(username='ADMIN', password='ANY_PASSWORD',
+                             isadmin=True)
+            other = api.User(username='OTHER', password='ANY_PASSWORD')
+            expr = api.Experiment(owner=admin, name='ANY_NAME',
+                                  variable_names='contrast,condition')
+            for i in range(10):
+                api.Trial(experiment=expr,
+                          observer=admin if i % 2 else other,
+                          data=[i / 10, 'easy' if i < 5 else 'hard'])
+        self.admin_id = admin.id
+        self.other_id = other.id
+        self.url = '/v1/experiments/{}/trials'.format(expr.id)
+        with orm.db_session():
+            self.headers = {'Authorization': create_token(admin.id)}
+
+    def get(self, **params):
+        resp = hug.test.get(api, self.url, params=params,
+                            headers=self.headers)
+        self.assertEqual(resp.status, HTTP_200)
+        return resp.data
+
+    def test_filter_by_observer(self):
+        trials = self.get(observer=self.other_id)
+        self.assertEqual(len(trials), 5)
+        self.assertTrue(all(trial['observer'] == self.other_id
+                            for trial in trials))
+
+    def test_filter_by_id_range(self):
+        trials = self.get(after_id=2, before_id=6)
+        self.assertEqual([trial['id'] for trial in trials], [3, 4, 5])
+
+    def test_filter_by_variable_equality(self):
+        trials = self.get(condition='hard')
+        self.assertEqual(len(trials), 5)
+
+    def test_filter_by_variable_range(self):
+        trials = self.get(contrast__gte=0.3, contrast__lt=0.6)
+        self.assertEqual([trial['contrast'] for trial in trials],
+                         [0.3, 0.4, 0.5])
+
+    def test_numeric_filters_ignore_strings_and_keep_floats(self):
+        with orm.db_session():
+            expr = api.Experiment(owner=api.User[self.admin_id],
+                                  name='MIXED', variable_names='x,cond')
+            for x in [0.25, 1.5, 1.9, 2, 2.7, 'abc', 'n/a']:
+                api.Trial(experiment=expr, observer=expr.owner,
+                          data=[x, 'nan' if x == 2 else 'ok'])
+        self.url = '/v1/experiments/{}/trials'.format(expr.id)
+
+        def xs(**params):
+            return [trial['x'] for trial in self.get(**params)]
+
+        self.assertEqual(xs(x=2), [2])
+        self.assertEqual(xs(x__gt=1), [1.5, 1.9, 2, 2.7])
+        self.assertEqual(xs(x__lte=1.9), [0.25, 1.5, 1.9])
+        self.assertEqual(xs(x=0), [])
+        self.assertEqual(xs(x__ne=2), [0.25, 1.5, 1.9, 2.7, 'abc', 'n/a'])
+        self.assertEqual(xs(x='abc'), ['abc'])
+        self.assertEqual(xs(cond='nan'), [2])
+
+    def test_filters_are_combined(self):
+        trials = self.get(condition='easy', observer=self.admin_id)
+        self.assertEqual([trial['contrast'] for trial in trials], [0.1, 0.3])
+
+    def test_projection(self):
+        trials = self.get(fields='id,contrast', limit=1)
+        self.assertEqual(trials, [{'id': 1, 'contrast': 0.0}])
+
+    def test_projection_of_unknown_field(self):
+        resp = hug.test.get(api, self.url, params={'fields': 'password'},
+                            headers=self.headers)
+        self.assertEqual(resp.status, HTTP_400)
+
+    def test_filters_apply_to_streams(self):
+        resp = hug.test.get(api, self.url,
+                            params={'stream': 'ndjson', 'condition': 'hard',
+                                    'fields': 'contrast'},
+                            headers=self.headers)
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual([json.loads(line) for line in resp.data.splitlines()],
+                         [{'contrast': 0.5}, {'contrast': 0.6},
+                          {'contrast': 0.7}, {'contrast': 0.8},
+                          {'contrast': 0.9}])
+
+
+class TestAggregate(TestCase):
+
+    def setUp(self):
+        api.db.drop_all_tables(with_all_data=True)
+        api.db.create_tables()
+
+        with orm.db_session():
+            admin = api.User(username='ADMIN', password='ANY_PASSWORD',
+                             isadmin=True)
+            expr = api.Experiment(owner=admin, name='ANY_NAME',
+                                  variable_names='contrast,condition,correct')
+            for i in range(8):
+                api.Trial(experiment=expr, observer=admin,
+                          data=[i, 'easy' if i < 4 else 'hard', i % 2])
+        self.admin_id = admin.id
+        self.url = '/v1/experiments/{}/aggregate'.format(expr.id)
+        with orm.db_session():
+            self.headers = {'Authorization': create_token(admin.id)}
+
+    def get(self, **params):
+        return hug.test.get(api, self.url, params=params,
+                            headers=self.headers)
+
+    def test_count_without_groups(self):
+        resp = self.get()
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual(resp.data, [{'count': 8}])
+
+    def test_grouped_statistics(self):
+        resp = self.get(group_by='condition', values='contrast,correct',
+                        stats='mean,min,max,sum')
+        self.assertEqual(resp.status, HTTP_200)
+        groups = {group['condition']: group for group in resp.data}
+        self.assertEqual(groups['easy']['count'], 4)
+        self.assertEqual(groups['easy']['contrast'],
+                         {'count': 4, 'mean': 1.5, 'min': 0, 'max': 3,
+                          'sum': 6})
+        self.assertEqual(groups['hard']['correct']['mean'], 0.5)
+
+    def test_group_by_observer_with_filter(self):
+        resp = self.get(group_by='observer', values='contrast',
+                        condition='hard')
+        self.assertEqual(resp.data, [{'observer': self.admin_id,
+                                      'count': 4,
+                                      'contrast': {'count': 4,
+                                                   'mean': 5.5}}])
+
+    def test_quantiles(self):
+        resp = self.get(values='contrast', quantiles='0.5,1')
+        self.assertEqual(resp.data[0]['contrast'],
+                         {'count': 8, 'mean': 3.5, 'q0.5': 3.5, 'q1': 7})
+
+    def test_non_numeric_values_are_left_out(self):
+        with orm.db_session():
+            expr = api.Experiment[1]
+            for x in ['abc', 'n/a', None]:
+                api.Trial(experiment=expr, observer=expr.owner,
+                          data=[x, 'easy', 0])
+        resp = self.get(values='contrast', stats='mean,min,sum',
+                        quantiles='0')
+        self.assertEqual(resp.data, [{'count': 11,
+                                      'contrast': {'count': 8,
+                                                   'mean': 3.5,
+                                                   'min': 0,
+                                                   'sum': 28,
+                                                   'q0': 0}}])
+
+    def test_group_by_composite_values(self):
+        with orm.db_session():
+            expr = api.Experiment[1]
+            for x in [[1, 2], [1, 2], {'a': 1}]:
+                api.Trial(experiment=expr, observer=expr.owner,
+                          data=[1, x, 0])
+        resp = self.get(group_by='condition', values='contrast',
+                        quantiles='0.5')
+        self.assertEqual(resp.status, HTTP_200)
+        counts = [(group['condition'], group['count'],
+                   group['contrast']['q0.5']) for group in resp.data]
+        self.assertIn(([1, 2], 2, 1), counts)
+        self.assertIn(({'a': 1}, 1, 1), counts)
+
+    def test_unknown_variable(self):
+        resp = self.get(values='ANY_VARIABLE')
+        self.assertEqual(resp.status, HTTP_400)
+
+    def test_invalid_quantile(self):
+        resp = self.get(values='contrast', quantiles='2')
+        self.assertEqual(resp.status, HTTP_400)
+
+
+class TestExport(TestCase):
+
+    def setUp(self):
+        api.db.drop_all_tables(with_all_data=True)
+        api.db.create_tables()
+
+        with orm.db_session():
+            admin = api.User(username='ADMIN', password='ANY_PASSWORD',
+                             isadmin=True)
+            expr = api.Experiment(owner=admin, name='ANY_NAME',
+                                  variable_names='contrast,condition')
+            for i in range(5):
+                api.Trial(experiment=expr, observer=admin,
+                          data=[i / 10, 'easy' if i < 3 else 'hard'])
+        self.url = '/v1/experiments/{}/export'.format(expr.id)
+        with orm.db_session():
+            self.headers = {'Authorization': create_token(admin.id)}
+
+    def get(self, **params):
+        resp = hug.test.get(api, self.url, params=params,
+                            headers=self.headers)
+        self.assertEqual(resp.status, HTTP_200)
+        if isinstance(resp.data, str):
+            return resp.data.encode('utf8')
+        return resp.data
+
+    def test_csv_is_default(self):
+        rows = list(csv.DictReader(io.StringIO(self.get().decode('utf8'))))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[1]['contrast'], '0.1')
+        self.assertEqual(rows[1]['condition'], 'easy')
+
+    def test_filters_apply_to_export(self):
+        rows = list(csv.DictReader(io.StringIO(
+            self.get(condition='hard').decode('utf8'))))
+        self.assertEqual([row['contrast'] for row in rows], ['0.3', '0.4'])
+
+    def test_unknown_format(self):
+        resp = hug.test.get(api, self.url, params={'format': 'xls'},
+                            headers=self.headers)
+        self.assertEqual(resp.status, HTTP_400)
+
+    @unittest.skipIf(export.pyarrow is None, 'requires pyarrow')
+    def test_arrow_stream(self):
+        table = export.pyarrow.ipc.open_stream(
+            self.get(format='arrow')).read_all()
+        self.assertEqual(table.column('contrast').to_pylist(),
+                         [0.0, 0.1, 0.2, 0.3, 0.4])
+        self.assertEqual(table.column('condition').to_pylist()[-1], 'hard')
+
+    @unittest.skipIf(export.pyarrow is None, 'requires pyarrow')
+    def test_types_cover_all_batches(self):
+        with orm.db_session():
+            expr = api.Experiment[1]
+            api.Trial(experiment=expr, observer=expr.owner,
+                      data=['timeout', 'hard'])
+        with mock.patch.object(export, 'BATCH_SIZE', 2):
+            table = export.pyarrow.ipc.open_stream(
+                self.get(format='arrow')).read_all()
+        self.assertEqual(table.column('contrast').to_pylist(),
+                         ['0.0', '0.1', '0.2', '0.3', '0.4', 'timeout'])
+
+    @unittest.skipIf(export.pyarrow is None, 'requires pyarrow')
+    def test_parquet_file(self):
+        table = export.pyarrow.parquet.read_table(
+            export.pyarrow.BufferReader(self.get(format='parquet')))
+        self.assertEqual(table.num_rows, 5)
+        self.assertEqual(table.column_names,
+                         ['id', 'experiment', 'observer',
+                          'contrast', 'condition'])
+
+
+class TestChanges(TestCase):
+
+    def setUp(self):
+        api.db.drop_all_tables(with_all_data=True)
+        api.db.create_tables()
+        crypto.credentials.clear()
+        api.trial_keys.clear()
+
+        with orm.db_session():
+            admin = api.User(username='ADMIN',
+                             password=crypto.hash_password('ANY_PASSWORD'),
+                             isadmin=True)
+            expr = api.Experiment(owner=admin, name='ANY_NAME',
+                                  variable_names='contrast')
+        self.url = '/v1/experiments/{}/'.format(expr.id)
+        with orm.db_session():
+            self.headers = {'Authorization': create_token(admin.id)}
+        basic_token = b64encode(b'ADMIN:ANY_PASSWORD').decode('utf8')
+        resp = hug.test.post(api, self.url + 'trials/',
+                             [{'contrast': c} for c in (0.1, 0.2, 0.3)],
+                             headers={'Authorization':
+                                      'Basic {}'.format(basic_token)})
+        self.trial_ids = resp.data
+
+    def changes(self, **params):
+        resp = hug.test.get(api, self.url + 'changes/', params=params,
+                            headers=self.headers)
+        self.assertEqual(resp.status, HTTP_200)
+        return resp.data
+
+    def test_all_trials_since_start(self):
+        changes = self.changes()
+        self.assertEqual([trial['id'] for trial in changes['trials']],
+                         self.trial_ids)
+        self.assertEqual(changes['cursor'], 3)
+
+    def test_nothing_new_keeps_cursor(self):
+        self.assertEqual(self.changes(since=3), {'trials': [], 'cursor': 3})
+
+    def test_pages_follow_cursor(self):
+        first = self.changes(limit=2)
+        second = self.changes(since=first['cursor'], limit=2)
+        self.assertEqual([trial['id'] for trial in second['trials']],
+                         self.trial_ids[2:])
+
+    def test_negative_limit(self):
+        resp = hug.test.get(api, self.url + 'changes/', params={'limit': -1},
+                            headers=self.headers)
+        self.assertEqual(resp.status, HTTP_400)
+
+    def test_modified_trials_are_changes(self):
+        hug.test.put(api, self.url + 'trials/{}/'.format(self.trial_ids[0]),
+                     {'contrast': 0.5}, headers=self.headers)
+        changes = self.changes(since=3)
+        self.assertEqual(changes['trials'],
+                         [{'id': self.trial_ids[0], 'experiment': 1,
+                           'observer': 1, 'contrast': 0.5}])
+        self.assertEqual(changes['cursor'], 4)
+
+    def test_changes_of_nonexisting_experiment(self):
+        resp = hug.test.get(api, '/v1/experiments/9/changes/',
+                            headers=self.headers)
+        self.assertEqual(resp.status, HTTP_404)
+
+
+class TestConditionalGet(TestCase):
+
+    def setUp(self):
+        api.db.drop_all_tables(with_all_data=True)
+        api.db.create_tables()
+        crypto.credentials.clear()
+        api.trial_keys.clear()
+
+        with orm.db_session():
+            admin = api.User(username='ADMIN',
+                             password=crypto.hash_password('ANY_PASSWORD'),
+                             isadmin=True)
+            expr = api.Experiment(owner=admin, name='ANY_NAME',
+                                  variable_names='contrast')
+            api.State(experiment=expr, observer=admin, state_json='"ANY"')
+        self.url = '/v1/experiments/{}/'.format(expr.id)
+        with orm.db_session():
+            self.headers = {'Authorization': create_token(admin.id)}
+        basic_token = b64encode(b'ADMIN:ANY_PASSWORD').decode('utf8')
+        self.basic_headers = {'Authorization': 'Basic {}'.format(basic_token)}
+
+    def revalidate(self, url, headers=None):
+        headers = headers or self.headers
+        resp = hug.test.get(api, url, headers=headers)
+        self.assertEqual(resp.status, HTTP_200)
+        return hug.test.get(api, url, headers=dict(
+            headers, **{'If-None-Match': resp.headers_dict['etag']}))
+
+    def test_unchanged_experiment_is_not_modified(self):
+        self.assertEqual(self.revalidate(self.url).status, HTTP_304)
+
+    def test_unchanged_trials_are_not_modified(self):
+        self.assertEqual(self.revalidate(self.url + 'trials/').status,
+                         HTTP_304)
+
+    def test_unchanged_state_is_not_modified(self):
+        self.assertEqual(
+            self.revalidate(self.url + 'state/', self.basic_headers).status,
+            HTTP_304)
+
+    def test_new_trial_changes_etag(self):
+        etag = hug.test.get(api, self.url + 'trials/',
+                            headers=self.headers).headers_dict['etag']
+        hug.test.post(api, self.url + 'trials/', {'contrast': 0.5},
+                      headers=self.basic_headers)
+        resp = hug.test.get(api, self.url + 'trials/',
+                            headers=dict(self.headers,
+                                         **{'If-None-Match': etag}))
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual(len(resp.data), 1)
+
+    def test_experiment_put_changes_etag(self):
+        etag = hug.test.get(api, self.url,
+                            headers=self.headers).headers_dict['etag']
+        hug.test.put(api, self.url, {'name': 'OTHER_NAME'},
+                     headers=self.headers)
+        resp = hug.test.get(api, self.url,
+                            headers=dict(self.headers,
+                                         **{'If-None-Match': etag}))
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual(resp.data['name'], 'OTHER_NAME')
+
+
+class TestCompression(TestCase):
+
+    def setUp(self):
+        api.db.drop_all_tables(with_all_data=True)
+        api.db.create_tables()
+
+        with orm.db_session():
+            admin = api.User(username='ADMIN', password='ANY_PASSWORD',
+                             isadmin=True)
+            expr = api.Experiment(owner=admin, name='ANY_NAME',
+                                  variable_names='contrast')
+            for i in range(100):
+                api.Trial(experiment=expr, observer=admin, data=[i])
+        self.url = '/v1/experiments/{}/'.format(expr.id)
+        with orm.db_session():
+            self.headers = {
+                'Authorization': create_token(admin.id).decode('ascii'),
+                'Accept-Encoding': 'gzip'}
+
+    def get(self, url, **params):
+        client = falcon.testing.TestClient(hug.API(api).http.server())
+        return client.simulate_get(url, params=params, headers=self.headers)
+
+    def test_large_response_is_compressed(self):
+        resp = self.get(self.url + 'trials/')
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(resp.content))), 100)
+
+    def test_stream_is_compressed(self):
+        resp = self.get(self.url + 'trials/', stream='ndjson')
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(gzip.decompress(resp.content).splitlines()), 100)
+
+    def test_small_response_is_not_compressed(self):
+        resp = self.get(self.url)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.json['trial_count'], 100)
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+
+    def test_identity_without_accept_encoding(self):
+        del self.headers['Accept-Encoding']
+        resp = self.get(self.url + 'trials/')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(len(resp.json), 100)
+
+
+class TestEvents(TestCase):
+
+    def setUp(self):
+        api.db.drop_all_tables(with_all_data=True)
+        api.db.create_tables()
+        crypto.credentials.clear()
+        api.trial_keys.clear()
+
+        with orm.db_session():
+            admin = api.User(username='ADMIN',
+                             password=crypto.hash_password('ANY_PASSWORD'),
+                             isadmin=True)
+            expr = api.Experiment(owner=admin, name='ANY_NAME',
+                                  variable_names='contrast')
+        self.url = '/v1/experiments/{}/'.format(expr.id)
+        self.exp_id = expr.id
+        with orm.db_session():
+            self.headers = {'Authorization': create_token(admin.id)}
+        basic_token = b64encode(b'ADMIN:ANY_PASSWORD').decode('utf8')
+        self.basic_headers = {'Authorization': 'Basic {}'.format(basic_token)}
+
+    def test_posted_trials_are_published(self):
+        subscription = events.hub.subscribe(self.exp_id)
+        hug.test.post(api, self.url + 'trials/', {'contrast': 0.5},
+                      headers=self.basic_headers)
+        events.hub.unsubscribe(subscription)
+        self.assertEqual(subscription.get(0),
+                         (1, {'id': 1, 'experiment': self.exp_id,
+                              'observer': 1, 'contrast': 0.5}))
+
+    def test_stream_replays_since_last_event_id(self):
+        hug.test.post(api, self.url + 'trials/',
+                      [{'contrast': 0.1}, {'contrast': 0.2}],
+                      headers=self.basic_headers)
+        subscription = events.Subscription(self.exp_id)
+        subscription.close()
+        with mock.patch.object(events.hub, 'subscribe',
+                               return_value=subscription):
+            resp = hug.test.get(api, self.url + 'events/',
+                                headers=dict(self.headers,
+                                             **{'Last-Event-ID': '1'}))
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual(resp.headers_dict['content-type'],
+                         'text/event-stream')
+        self.assertIn('id: 2\nevent: trial\n', resp.data)
+        self.assertNotIn('id: 1\n', resp.data)
+
+    def test_events_of_nonexisting_experiment(self):
+        resp = hug.test.get(api, '/v1/experiments/9/events/',
+                            headers=self.headers)
+        self.assertEqual(resp.status, HTTP_404)
+
+
+class TestWriteBehind(TestCase):
+
+    def setUp(self):
+        api.db.drop_all_tables(with_all_data=True)
+        api.db.create_tables()
+        crypto.credentials.clear()
+        api.trial_keys.clear()
+
+        with orm.db_session():
+            user = api.User(username='ANY_USER', password='ANY_PASSWORD')
+            expr = api.Experiment(owner=user, name='ANY_NAME',
+                                  variable_names='A,B')
+        self.expr_id = expr.id
+        self.headers = {'Authorization': get_basic_token('ANY_USER',
+                                                         'ANY_PASSWORD')}
+        # The in-memory database is per thread, so the tests write the
+        # queued trials themselves instead of starting the writer thread.
+        ingest.writer = ingest.TrialWriter(flush_interval=0)
+
+    def tearDown(self):
+        ingest.writer = None
+
+    def drain(self):
+        ingest.writer.write(ingest.writer.next_batch())
+
+    def test_post_trial_is_accepted_and_written_later(self):
+        resp = hug.test.post(api,
+                             '/v1/experiments/{}/trials'.format(self.expr_id),
+                             {'A': 'a', 'B': 'b'},
+                             headers=self.headers)
+        self.assertEqual(resp.status, HTTP_202)
+        self.assertEqual(resp.data['A'], 'a')
+
+        self.drain()
+        with orm.db_session():
+            self.assertEqual(api.Experiment[self.expr_id].trials.count(), 1)
+
+    def test_post_trial_batch_is_written_later(self):
+        resp = hug.test.post(api,
+                             '/v1/experiments/{}/trials'.format(self.expr_id),
+                             [{'A': 'a', 'B': 'b'}] * 3,
+                             headers=self.headers)
+        self.assertEqual(resp.status, HTTP_202)
+        self.assertEqual(len(set(resp.data)), 3)
+
+        self.drain()
+        with orm.db_session():
+            expr = api.Experiment[self.expr_id]
+            self.assertEqual(expr.trials.count(), 3)
+            self.assertEqual(sorted(expr.trials.seq), [1, 2, 3])
+            self.assertEqual(expr.version, 3)
+
+    def test_retried_trial_is_written_once(self):
+        for _ in range(2):
+            resp = hug.test.post(
+                api, '/v1/experiments/{}/trials'.format(self.expr_id),
+                {'A': 'a', 'B': 'b', '_key': 'ANY_KEY'},
+                headers=self.headers)
+            self.assertEqual(resp.data['id'], 'ANY_KEY')
+        self.drain()
+        with orm.db_session():
+            self.assertEqual(api.Experiment[self.expr_id].trials.count(), 1)
+
+    def test_written_trials_are_published(self):
+        subscription = events.hub.subscribe(self.expr_id)
+        hug.test.post(api, '/v1/experiments/{}/trials'.format(self.expr_id),
+                      {'A': 'a', 'B': 'b'}, headers=self.headers)
+        self.drain()
+        events.hub.unsubscribe(subscription)
+        seq, trial = subscription.get(0)
+        self.assertEqual((seq, trial['A']), (1, 'a'))
+
+    def test_invalid_trial_is_rejected_before_queueing(self):
+        resp = hug.test.post(api,
+                             '/v1/experiments/{}/trials'.format(self.expr_id),
+                             {'A': 'a'},
+                             headers=self.headers)
+        self.assertEqual(resp.status, HTTP_400)
+        self.assertTrue(ingest.writer.queue.empty())
+
+    def test_full_queue_gives_503(self):
+        ingest.writer = ingest.TrialWriter(queue_size=1)
+        ingest.writer.queue.put(None)
+        resp = hug.test.post(api,
+                             '/v1/experiments/{}/trials'.format(self.expr_id),
+                             {'A': 'a', 'B': 'b'},
+                             headers=self.headers)
+        self.assertEqual(resp.status, HTTP_503)
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        api.db.drop_all_tables(with_all_data=True)
+        api.db.create_tables()
+        crypto.credentials.clear()
+        metrics.registry.clear()
+        crypto.tokens.clear()
+        with orm.db_session():
+            api.User(username='ANY_USER', password='ANY_PASSWORD')
+            admin = api.User(username='ANY_ADMIN', password='ANY_PASSWORD',
+                             isadmin=True)
+        self.headers = {'Authorization': get_basic_token('ANY_USER',
+                                                         'ANY_PASSWORD')}
+        self.admin = {
+            'Authorization': create_token(admin.id).decode('ascii')}
+        mock.patch.object(metrics, 'ENABLED', True).start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def test_requests_are_reported_per_route(self):
+        hug.test.get(api, '/v1/token/', headers=self.headers)
+        resp = hug.test.get(api, '/metrics', headers=self.admin)
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertTrue(resp.headers_dict['content-type'].startswith(
+            'text/plain; version=0.0.4'))
+        text = resp.data if isinstance(resp.data, str) else \
+            resp.data.decode('utf8')
+        self.assertIn('beehaiv_requests_total{method="GET",'
+                      'route="/v{api_version}/token/",status="200"} 1', text)
+        self.assertIn('phase="auth"', text)
+
+    def test_metrics_need_admin(self):
+        resp = hug.test.get(api, '/metrics')
+        self.assertEqual(resp.status, HTTP_401)
+        resp = hug.test.get(api, '/metrics', headers=self.headers)
+        self.assertEqual(resp.status, HTTP_401)
+
+    def test_metrics_are_off_by_default(self):
+        with mock.patch.object(metrics, 'ENABLED', False):
+            hug.test.get(api, '/v1/token/', headers=self.headers)
+            resp = hug.test.get(api, '/metrics', headers=self.admin)
+        self.assertEqual(resp.status, HTTP_404)
+        self.assertEqual(metrics.registry.requests, {})
+
+    def test_queries_are_counted(self):
+        metrics.begin()
+        with orm.db_session():
+            api.User.get(username='ANY_USER')
+        self.assertGreater(metrics.end().queries, 0)
+
+    def test_server_timing_header(self):
+        with mock.patch.object(metrics, 'SERVER_TIMING', True):
+            resp = hug.test.get(api, '/v1/token/', headers=self.headers)
+        self.assertIn('auth;dur=', resp.headers_dict['Server-Timing'])
+
+    def test_no_server_timing_header_by_default(self):
+        with mock.patch.object(metrics, 'SERVER_TIMING', False):
+            resp = hug.test.get(api, '/v1/token/', headers=self.headers)
+        self.assertNotIn('Server-Timing', resp.headers_dict)
+
+
+class TestQueryBudget(TestCase):
+    """Queries per request must not grow with the number of rows"""
+
+    def setUp(self):
+        api.db.drop_all_tables(with_all_data=True)
+        api.db.create_tables()
+        crypto.credentials.clear()
+        crypto.tokens.clear()
+        api.trial_keys.clear()
+        with orm.db_session():
+            admin = api.User(username='ANY_ADMIN', password='ANY_PASSWORD',
+                             isadmin=True)
+            for i in range(5):
+                expr = api.Experiment(owner=admin, name='EXP{}'.format(i),
+                                      variable_names='A,B')
+                expr.add_trials(admin, [['a', 'b']] * 5)
+        self.headers = {
+            'Authorization': create_token(admin.id).decode('ascii')}
+        self.basic = {'Authorization': get_basic_token('ANY_ADMIN',
+                                                       'ANY_PASSWORD')}
+
+    def get(self, url, headers=None):
+        resp = hug.test.get(api, url, headers=headers or self.headers)
+        self.assertEqual(resp.status, HTTP_200)
+
+    def test_listings(self):
+        with metrics.query_budget(3):
+            self.get('/v1/experiments/')
+            self.get('/v1/experiments/1/')
+            self.get('/v1/experiments/1/trials/')
+            self.get('/v1/experiments/1/trials/1/')
+            self.get('/v1/experiments/1/changes/')
+            self.get('/v1/experiments/1/aggregate/')
+            self.get('/v1/users/')
+
+    def test_post_trials(self):
+        with metrics.query_budget(7):
+            resp = hug.test.post(api, '/v1/experiments/1/trials/',
+                                 [{'A': 'a', 'B': 'b'}] * 20,
+                                 headers=self.basic)
+        self.assertEqual(resp.status, HTTP_200)
+
+    def test_budget_catches_excess_queries(self):
+        with self.assertRaises(metrics.QueryBudgetExceeded):
+            with metrics.query_budget(1):
+                self.get('/v1/experiments/')
+
+
 class TestAutentication(TestCase):
 
     def setUp(self):
         api.db.drop_all_tables(with_all_data=True)
         api.db.create_tables()
+        crypto.credentials.clear()
+        api.trial_keys.clear()
 
         with orm.db_session():
             admin = api.User(username='ADMIN',
@@ -479,6 +1448,67 @@ class TestAutentication(TestCase):
             user = api.User[self.user_id]
             self.assertTrue(user.isadmin)
 
+    def test_changed_password_invalidates_cached_credentials(self):
+        old_token = get_basic_token('ANY_USER', 'ANY_PASSWORD')
+        resp = hug.test.get(api, '/v1/token/',
+                            headers={'Authorization': old_token})
+        self.assertEqual(resp.status, HTTP_200)
+
+        hug.test.put(api,
+                     '/v1/users/{}'.format(self.user_id),
+                     {'password': 'OTHER_PASSWORD'},
+                     headers=self.get_header(self.user_id))
+
+        resp = hug.test.get(api, '/v1/token/',
+                            headers={'Authorization': old_token})
+        self.assertEqual(resp.status, HTTP_401)
+
+    def test_refresh_token_gives_access_token(self):
+        basic_token = get_basic_token('ANY_USER', 'ANY_PASSWORD')
+        resp = hug.test.get(api, '/v1/refresh_token/',
+                            headers={'Authorization': basic_token})
+        self.assertEqual(resp.status, HTTP_200)
+
+        resp = hug.test.get(api, '/v1/token/refresh/',
+                            headers={'Authorization': resp.data})
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual(crypto.verify_token(resp.data)['id'], self.user_id)
+
+    def test_changed_password_revokes_refresh_token(self):
+        basic_token = get_basic_token('ANY_USER', 'ANY_PASSWORD')
+        refresh_token = hug.test.get(api, '/v1/refresh_token/',
+                                     headers={'Authorization': basic_token}
+                                     ).data
+
+        hug.test.put(api,
+                     '/v1/users/{}'.format(self.user_id),
+                     {'password': 'OTHER_PASSWORD'},
+                     headers=self.get_header(self.user_id))
+
+        resp = hug.test.get(api, '/v1/token/refresh/',
+                            headers={'Authorization': refresh_token})
+        self.assertEqual(resp.status, HTTP_401)
+
+    def test_access_token_can_post_trials(self):
+        with orm.db_session():
+            expr = api.Experiment(owner=api.User[self.user_id],
+                                  name='ANY_NAME', variable_names='A')
+        resp = hug.test.post(api, '/v1/experiments/{}/trials/'.format(expr.id),
+                             {'A': 1}, headers=self.get_header(self.user_id))
+        self.assertEqual(resp.status, HTTP_200)
+
+    def test_refresh_token_is_no_access_token(self):
+        with orm.db_session():
+            token = create_token(self.user_id, 'refresh')
+        resp = hug.test.get(api, '/v1/users/{}'.format(self.user_id),
+                            headers={'Authorization': token})
+        self.assertEqual(resp.status, HTTP_401)
+
+    def test_access_token_cannot_refresh(self):
+        resp = hug.test.get(api, '/v1/token/refresh/',
+                            headers=self.get_header(self.user_id))
+        self.assertEqual(resp.status, HTTP_401)
+
     def test_other_user_cannot_change_users_info(self):
         resp = hug.test.put(api,
                             '/v1/users/{}'.format(self.user_id),
@@ -495,6 +1525,8 @@ class TestState(TestCase):
     def setUp(self):
         api.db.drop_all_tables(with_all_data=True)
         api.db.create_tables()
+        crypto.credentials.clear()
+        api.trial_keys.clear()
 
         with orm.db_session():
             admin = api.User(username='ADMIN',
@@ -550,6 +1582,13 @@ class TestState(TestCase):
                              headers={'Authorization': self.basic_token})
         self.assertEqual(resp.status, HTTP_400)
 
+    def test_state_is_unique_per_observer_and_experiment(self):
+        with self.assertRaises(orm.TransactionIntegrityError):
+            with orm.db_session():
+                api.State(observer=api.User[self.admin_id],
+                          experiment=api.Experiment[self.expr_id],
+                          state_json='"ANY_STATE"')
+
     def test_post_state_with_no_state(self):
         resp = hug.test.post(api,
                              '/v1/experiments/{}/state/'.format(self.other_id),
@@ -570,3 +1609,144 @@ class TestState(TestCase):
                             {'state': 'ANY_STATE'},
                             headers={'Authorization': self.basic_token})
         self.assertEqual(resp.status, HTTP_400)
+
+
+class TestStateUpdates(TestCase):
+
+    def setUp(self):
+        api.db.drop_all_tables(with_all_data=True)
+        api.db.create_tables()
+        crypto.credentials.clear()
+        api.trial_keys.clear()
+
+        with orm.db_session():
+            admin = api.User(username='ADMIN', password='ANY_PASSWORD',
+                             isadmin=True)
+            expr = api.Experiment(owner=admin, name='ANY_NAME',
+                                  variable_names='v1')
+            api.State(observer=admin, experiment=expr,
+                      state_json='{"level": 1, "history": [1]}')
+        self.url = '/v1/experiments/{}/state/'.format(expr.id)
+        self.basic_token = get_basic_token('ADMIN', 'ANY_PASSWORD')
+
+    def headers(self, **headers):
+        headers['Authorization'] = self.basic_token
+        return headers
+
+    def etag(self):
+        return hug.test.get(api, self.url,
+                            headers=self.headers()).headers_dict['etag']
+
+    def test_put_with_current_etag(self):
+        resp = hug.test.put(api, self.url, {'state': {'level': 2}},
+                            headers=self.headers(**{'If-Match': self.etag()}))
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual(resp.data, {'level': 2})
+        self.assertEqual(resp.headers_dict['etag'], self.etag())
+
+    def test_etag_is_weak(self):
+        self.assertTrue(self.etag().startswith('W/"'))
+
+    def test_put_with_stale_etag_fails(self):
+        etag = self.etag()
+        hug.test.put(api, self.url, {'state': {'level': 2}},
+                     headers=self.headers())
+        resp = hug.test.put(api, self.url, {'state': {'level': 3}},
+                            headers=self.headers(**{'If-Match': etag}))
+        self.assertEqual(resp.status, HTTP_412)
+        self.assertEqual(hug.test.get(api, self.url,
+                                      headers=self.headers()).data,
+                         {'level': 2})
+
+    def test_merge_patch(self):
+        resp = hug.test.patch(
+            api, self.url, {'level': 2},
+            headers=self.headers(**{'content-type': patch.MERGE_PATCH}))
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual(resp.data, {'level': 2, 'history': [1]})
+
+    def test_json_patch(self):
+        resp = hug.test.patch(
+            api, self.url,
+            [{'op': 'replace', 'path': '/level', 'value': 2},
+             {'op': 'add', 'path': '/history/-', 'value': 2}],
+            headers=self.headers(**{'content-type': patch.JSON_PATCH}))
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual(resp.data, {'level': 2, 'history': [1, 2]})
+
+    def test_failed_json_patch_changes_nothing(self):
+        resp = hug.test.patch(
+            api, self.url,
+            [{'op': 'replace', 'path': '/level', 'value': 2},
+             {'op': 'test', 'path': '/level', 'value': 1}],
+            headers=self.headers(**{'content-type': patch.JSON_PATCH}))
+        self.assertEqual(resp.status, HTTP_422)
+        self.assertEqual(hug.test.get(api, self.url,
+                                      headers=self.headers()).data['level'],
+                         1)
+
+    def test_patch_needs_patch_media_type(self):
+        resp = hug.test.patch(api, self.url, {'level': 2},
+                              headers=self.headers())
+        self.assertEqual(resp.status, HTTP_415)
+
+
+class TestSteps(TestCase):
+
+    def setUp(self):
+        api.db.drop_all_tables(with_all_data=True)
+        api.db.create_tables()
+        crypto.credentials.clear()
+        api.trial_keys.clear()
+
+        with orm.db_session():
+            admin = api.User(username='ADMIN', password='ANY_PASSWORD',
+                             isadmin=True)
+            expr = api.Experiment(owner=admin, name='ANY_NAME',
+                                  variable_names='contrast,correct')
+        self.expr_id = expr.id
+        self.url = '/v1/experiments/{}/steps/'.format(expr.id)
+        self.basic_token = get_basic_token('ADMIN', 'ANY_PASSWORD')
+
+    def post(self, body, **headers):
+        headers['Authorization'] = self.basic_token
+        return hug.test.post(api, self.url, body, headers=headers)
+
+    def test_trial_and_state_are_stored(self):
+        resp = self.post({'trials': {'contrast': 0.5, 'correct': 1},
+                          'state': {'contrast': 0.4}})
+        self.assertEqual(resp.status, HTTP_200)
+        self.assertEqual(resp.data, {'trials': [1],
+                                     'state': {'contrast': 0.4}})
+        with orm.db_session():
+            expr = api.Experiment[self.expr_id]
+            self.assertEqual(expr.trials.count(), 1)
+            self.assertEqual(api.State.get(experiment=expr).state_json,
+                             '{"contrast":0.4}')
+
+    def test_merge_patch_of_existing_state(self):
+        self.post({'trials': [], 'state': {'contrast': 0.5, 'step': 1}})
+        resp = self.post({'trials': [{'contrast': 0.5, 'correct': 0}],
+                          'merge_patch': {'contrast': 0.6}})
+        self.assertEqual(resp.data['state'], {'contrast': 0.6, 'step': 1})
+
+    def test_stale_state_rejects_trials_too(self):
+        etag = self.post({'trials': [],
+                          'state': 1}).headers_dict['etag']
+        self.post({'trials': [], 'state': 2})
+        resp = self.post({'trials': [{'contrast': 0.5, 'correct': 0}],
+                          'state': 3}, **{'If-Match': etag})
+        self.assertEqual(resp.status, HTTP_412)
+        with orm.db_session():
+            self.assertEqual(api.Experiment[self.expr_id].trials.count(), 0)
+
+    def test_invalid_trial_rejects_state_update(self):
+        resp = self.post({'trials': [{'contrast': 0.5}], 'state': 1})
+        self.assertEqual(resp.status, HTTP_400)
+        with orm.db_session():
+            self.assertIsNone(api.State.get())
+
+    def test_only_one_state_update(self):
+        resp = self.post({'trials': [], 'state': 1,
+                          'merge_patch': {'a': 1}})
+        self.assertEqual(resp.status, HTTP_400)
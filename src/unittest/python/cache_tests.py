@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+from beehaiv.cache import TTLCache
+
+
+class TestTTLCache(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = TTLCache(maxsize=2, ttl=10, clock=lambda: self.now)
+
+    def test_get_returns_stored_value(self):
+        self.cache.set('ANY_KEY', 'ANY_VALUE')
+        self.assertEqual(self.cache.get('ANY_KEY'), 'ANY_VALUE')
+
+    def test_entries_expire_after_ttl(self):
+        self.cache.set('ANY_KEY', 'ANY_VALUE')
+        self.now = 10
+        self.assertIsNone(self.cache.get('ANY_KEY'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_ttl_can_only_be_shortened(self):
+        self.cache.set('SHORT', 'ANY_VALUE', ttl=1)
+        self.cache.set('LONG', 'ANY_VALUE', ttl=100)
+        self.now = 5
+        self.assertIsNone(self.cache.get('SHORT'))
+        self.assertEqual(self.cache.get('LONG'), 'ANY_VALUE')
+        self.now = 10
+        self.assertIsNone(self.cache.get('LONG'))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.set('FIRST', 1)
+        self.cache.set('SECOND', 2)
+        self.cache.get('FIRST')
+        self.cache.set('THIRD', 3)
+        self.assertIsNone(self.cache.get('SECOND'))
+        self.assertEqual(self.cache.get('FIRST'), 1)
+
+    def test_pop_removes_entry(self):
+        self.cache.set('ANY_KEY', 'ANY_VALUE')
+        self.assertEqual(self.cache.pop('ANY_KEY'), 'ANY_VALUE')
+        self.assertIsNone(self.cache.get('ANY_KEY'))
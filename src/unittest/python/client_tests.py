@@ -0,0 +1,160 @@
+from unittest import TestCase, mock
+import base64
+import json
+import os
+import tempfile
+import time
+
+from beehaiv_client import Client, Journal, UploadError
+from beehaiv_client.client import token_expiry
+
+
+def make_token(exp):
+    payload = base64.urlsafe_b64encode(
+        json.dumps({'exp': exp}).encode('utf8')).decode('ascii')
+    return 'HEADER.{}.SIGNATURE'.format(payload.rstrip('='))
+
+
+def response(status_code, data=None):
+    return mock.Mock(status_code=status_code, reason='ANY_REASON',
+                     text='ANY_TEXT', **{'json.return_value': data})
+
+
+class TestJournal(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.journal = Journal(os.path.join(directory.name, 'journal'))
+        self.addCleanup(self.journal.close)
+
+    def test_batches_are_per_experiment(self):
+        self.journal.append(1, {'a': 1})
+        self.journal.append(2, {'a': 2})
+        self.journal.append(1, {'a': 3})
+        batch, exp_id, trials = self.journal.next_batch(10)
+        self.assertEqual(exp_id, 1)
+        self.assertEqual([trial for key, trial in trials],
+                         [{'a': 1}, {'a': 3}])
+
+    def test_unfinished_batch_is_repeated(self):
+        self.journal.append(1, {'a': 1})
+        first = self.journal.next_batch(10)
+        self.journal.append(1, {'a': 2})
+        self.assertEqual(self.journal.next_batch(10), first)
+
+    def test_non_finite_numbers_are_not_journaled(self):
+        with self.assertRaises(ValueError):
+            self.journal.append(1, {'a': float('nan')})
+        self.assertEqual(self.journal.count(), 0)
+
+    def test_finished_batch_is_not_pending(self):
+        self.journal.append(1, {'a': 1})
+        batch, exp_id, trials = self.journal.next_batch(10)
+        self.journal.finish(batch)
+        self.assertIsNone(self.journal.next_batch(10))
+        self.assertEqual(self.journal.count('uploaded'), 1)
+
+
+class TestClient(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.session = mock.Mock()
+        self.token = make_token(time.time() + 300)
+        self.session.get.return_value = response(200, self.token)
+        self.session.post.return_value = response(200, [1])
+        self.client = Client('http://ANY_HOST/', 'ANY_USER', 'ANY_PASSWORD',
+                             journal=os.path.join(directory.name, 'journal'),
+                             session=self.session)
+        self.addCleanup(self.client.journal.close)
+
+    def test_record_does_not_touch_network(self):
+        self.client.record(1, {'a': 1})
+        self.session.get.assert_not_called()
+        self.session.post.assert_not_called()
+
+    def test_upload_reuses_token(self):
+        self.client.record(1, {'a': 1})
+        self.client.upload_pending()
+        key = self.client.record(1, {'a': 2})
+        self.client.upload_pending()
+        self.session.get.assert_called_once()
+        url = self.session.post.call_args[0][0]
+        kwargs = self.session.post.call_args[1]
+        self.assertEqual(url, 'http://ANY_HOST/v1/experiments/1/trials/')
+        self.assertEqual(kwargs['json'], [{'a': 2, '_key': key}])
+        self.assertEqual(kwargs['headers']['Authorization'], self.token)
+        self.assertEqual(self.client.journal.count(), 0)
+
+    def test_server_error_keeps_batch(self):
+        self.session.post.return_value = response(503)
+        self.client.record(1, {'a': 1})
+        with self.assertRaises(UploadError):
+            self.client.upload_pending()
+        self.assertEqual(self.client.journal.count(), 1)
+
+    def test_retry_sends_same_idempotency_key(self):
+        self.client.record(1, {'a': 1})
+        self.session.post.return_value = response(503)
+        with self.assertRaises(UploadError):
+            self.client.upload_pending()
+        self.session.post.return_value = response(200, [1])
+        self.client.upload_pending()
+        keys = [call[1]['headers']['Idempotency-Key']
+                for call in self.session.post.call_args_list]
+        self.assertEqual(len(keys), 2)
+        self.assertEqual(keys[0], keys[1])
+
+    def test_trials_are_sent_with_journal_keys(self):
+        self.session.post.return_value = response(200, [1])
+        key = self.client.record(1, {'a': 1})
+        self.client.upload_pending()
+        body = self.session.post.call_args[1]['json']
+        self.assertEqual(body, [{'a': 1, '_key': key}])
+
+    def test_rejected_batch_is_not_retried(self):
+        self.session.post.return_value = response(400)
+        self.client.record(1, {'a': 1})
+        self.client.upload_pending()
+        self.assertEqual(self.client.journal.count('rejected'), 1)
+
+    def test_batch_is_rejected_after_repeated_server_errors(self):
+        self.client.max_server_errors = 3
+        self.client.record(1, {'a': 1})
+        self.session.post.return_value = response(500)
+        for _ in range(2):
+            with self.assertRaises(UploadError):
+                self.client.upload_pending()
+        self.client.record(2, {'a': 2})
+        self.session.post.side_effect = [response(500), response(200, [1])]
+        self.client.upload_pending()
+        self.assertEqual(self.client.journal.count('rejected'), 1)
+        self.assertEqual(self.client.journal.count('uploaded'), 1)
+
+    def test_unavailable_server_never_rejects(self):
+        self.client.max_server_errors = 1
+        self.client.record(1, {'a': 1})
+        self.session.post.return_value = response(503)
+        for _ in range(3):
+            with self.assertRaises(UploadError):
+                self.client.upload_pending()
+        self.assertEqual(self.client.journal.count(), 1)
+
+    def test_expired_token_is_renewed_on_401(self):
+        self.session.post.side_effect = [response(401), response(200, [1])]
+        self.client.record(1, {'a': 1})
+        self.client.upload_pending()
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_background_upload(self):
+        self.client.flush_interval = 0.01
+        with self.client:
+            self.client.record(1, {'a': 1})
+            self.assertTrue(self.client.flush(timeout=5))
+        self.session.post.assert_called_once()
+
+    def test_token_expiry(self):
+        self.assertEqual(token_expiry(make_token(123)), 123)
+        self.assertEqual(token_expiry('ANY_TOKEN'), 0)
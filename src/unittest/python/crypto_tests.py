@@ -1,4 +1,5 @@
 from unittest import TestCase, mock
+import time
 import jwt
 from pony import orm
 
@@ -9,6 +10,7 @@ class TestVerifyUser(TestCase):
 
     def setUp(self):
         self.mock_user = mock.patch('beehaiv.crypto.User').start()
+        crypto.credentials.clear()
 
     def tearDown(self):
         mock.patch.stopall()
@@ -32,11 +34,91 @@ class TestVerifyUser(TestCase):
         auth = crypto.verify_user('ANY_USERNAME', 'ANY_PASSWORD')
         self.assertFalse(auth)
 
+    def test_user_does_not_exist(self):
+        self.mock_user.get.return_value = None
+
+        auth = crypto.verify_user('ANY_USERNAME', 'ANY_PASSWORD')
+        self.assertFalse(auth)
+
+    def test_verified_user_is_served_from_cache(self):
+        mock_user = mock.Mock()
+        mock_user.password = 'ANY_PASSWORD'
+        mock_user.username = 'ANY_USERNAME'
+        self.mock_user.get.return_value = mock_user
+
+        crypto.verify_user('ANY_USERNAME', 'ANY_PASSWORD')
+        auth = crypto.verify_user('ANY_USERNAME', 'ANY_PASSWORD')
+        self.assertEqual(auth['username'], 'ANY_USERNAME')
+        self.assertEqual(self.mock_user.get.call_count, 1)
+
+    def test_cache_does_not_accept_other_password(self):
+        mock_user = mock.Mock()
+        mock_user.password = 'ANY_PASSWORD'
+        mock_user.username = 'ANY_USERNAME'
+        self.mock_user.get.return_value = mock_user
+
+        crypto.verify_user('ANY_USERNAME', 'ANY_PASSWORD')
+        auth = crypto.verify_user('ANY_USERNAME', 'OTHER_PASSWORD')
+        self.assertFalse(auth)
+
+    def test_forget_user_drops_cached_credentials(self):
+        mock_user = mock.Mock()
+        mock_user.password = 'ANY_PASSWORD'
+        mock_user.username = 'ANY_USERNAME'
+        self.mock_user.get.return_value = mock_user
+
+        crypto.verify_user('ANY_USERNAME', 'ANY_PASSWORD')
+        crypto.forget_user('ANY_USERNAME')
+        crypto.verify_user('ANY_USERNAME', 'ANY_PASSWORD')
+        self.assertEqual(self.mock_user.get.call_count, 2)
+
+    def test_user_with_hashed_password(self):
+        mock_user = mock.Mock()
+        mock_user.password = crypto.hash_password('ANY_PASSWORD', 1000)
+        mock_user.username = 'ANY_USERNAME'
+        self.mock_user.get.return_value = mock_user
+
+        self.assertTrue(crypto.verify_user('ANY_USERNAME', 'ANY_PASSWORD'))
+        self.assertFalse(crypto.verify_user('ANY_USERNAME', 'OTHER_PASSWORD'))
+
+    def test_plaintext_password_is_hashed_on_login(self):
+        mock_user = mock.Mock()
+        mock_user.password = 'ANY_PASSWORD'
+        mock_user.username = 'ANY_USERNAME'
+        self.mock_user.get.return_value = mock_user
+        self.mock_user.__getitem__.return_value = mock_user
+
+        crypto.verify_user('ANY_USERNAME', 'ANY_PASSWORD')
+        self.assertTrue(crypto.is_hashed(mock_user.password))
+        self.assertTrue(crypto.check_password('ANY_PASSWORD',
+                                              mock_user.password))
+
+
+class TestPasswordHashing(TestCase):
+
+    def test_hash_is_salted(self):
+        self.assertNotEqual(crypto.hash_password('ANY_PASSWORD', 1000),
+                            crypto.hash_password('ANY_PASSWORD', 1000))
+
+    def test_check_password(self):
+        stored = crypto.hash_password('ANY_PASSWORD', 1000)
+        self.assertTrue(crypto.check_password('ANY_PASSWORD', stored))
+        self.assertFalse(crypto.check_password('OTHER_PASSWORD', stored))
+
+    def test_kdf_runs_in_worker_pool(self):
+        with mock.patch('beehaiv.crypto.kdf_pool') as mock_pool:
+            mock_pool.submit.return_value.result.return_value = 'ANY_HASH'
+            self.assertEqual(crypto.run_kdf(crypto.hash_password, 'ANY'),
+                             'ANY_HASH')
+            mock_pool.submit.assert_called_once_with(crypto.hash_password,
+                                                     'ANY')
+
 
 class TestVerifyToken(TestCase):
 
     def setUp(self):
         self.mock_decode = mock.patch('beehaiv.crypto.jwt.decode').start()
+        crypto.tokens.clear()
 
     def tearDown(self):
         mock.patch.stopall()
@@ -51,11 +133,52 @@ class TestVerifyToken(TestCase):
         auth = crypto.verify_token('ANY_TOKEN')
         self.assertFalse(auth)
 
+    def test_verified_token_is_cached(self):
+        self.mock_decode.return_value = {'username': 'ANY_USERNAME',
+                                         'exp': time.time() + 60}
+        crypto.verify_token('ANY_TOKEN')
+        self.assertEqual(crypto.verify_token('ANY_TOKEN')['username'],
+                         'ANY_USERNAME')
+        self.mock_decode.assert_called_once()
+
+    def test_cached_token_expires_with_exp(self):
+        self.mock_decode.return_value = {'username': 'ANY_USERNAME',
+                                         'exp': time.time() - 1}
+        crypto.verify_token('ANY_TOKEN')
+        crypto.verify_token('ANY_TOKEN')
+        self.assertEqual(self.mock_decode.call_count, 2)
+
+    def test_refresh_token_is_no_access_token(self):
+        self.mock_decode.return_value = {'username': 'ANY_USERNAME',
+                                         'type': 'refresh'}
+        self.assertFalse(crypto.verify_token('ANY_TOKEN'))
+
+
+class TestTokens(TestCase):
+
+    def setUp(self):
+        crypto.tokens.clear()
+        self.user = {'username': 'ANY_USERNAME', 'isadmin': False, 'id': 1}
+
+    def test_lifetime(self):
+        token = crypto.encode_token(self.user, lifetime=3600)
+        info = crypto.verify_token(token)
+        self.assertAlmostEqual(info['exp'], time.time() + 3600, delta=5)
+
+    def test_expired_token(self):
+        token = crypto.encode_token(self.user, lifetime=-1)
+        self.assertFalse(crypto.verify_token(token))
+
+    def test_access_token_is_no_refresh_token(self):
+        token = crypto.encode_token(self.user)
+        self.assertFalse(crypto.verify_refresh_token(token))
+
 
 class TestVerifyAdmin(TestCase):
 
     def setUp(self):
         self.mock_decode = mock.patch('beehaiv.crypto.jwt.decode').start()
+        crypto.tokens.clear()
 
     def tearDown(self):
         mock.patch.stopall()
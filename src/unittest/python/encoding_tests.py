@@ -0,0 +1,60 @@
+from unittest import TestCase, mock
+import gzip
+
+from beehaiv import encoding
+
+
+class TestNegotiate(TestCase):
+
+    def test_no_header_gives_identity(self):
+        self.assertIsNone(encoding.negotiate(None, ['gzip']))
+
+    def test_server_preference_wins(self):
+        self.assertEqual(encoding.negotiate('gzip, zstd', ['zstd', 'gzip']),
+                         'zstd')
+
+    def test_zero_quality_is_refused(self):
+        self.assertEqual(encoding.negotiate('zstd;q=0, gzip;q=0.5',
+                                            ['zstd', 'gzip']), 'gzip')
+
+    def test_wildcard(self):
+        self.assertEqual(encoding.negotiate('*', ['gzip']), 'gzip')
+
+    def test_unsupported_encoding(self):
+        self.assertIsNone(encoding.negotiate('deflate', ['gzip']))
+
+
+class TestConfiguredEncodings(TestCase):
+
+    def test_unavailable_encodings_are_dropped(self):
+        self.assertEqual(encoding.configured_encodings(
+            {'BEEHAIV_COMPRESSION': 'unknown,gzip'}), ['gzip'])
+
+    def test_empty_disables_compression(self):
+        self.assertEqual(encoding.configured_encodings(
+            {'BEEHAIV_COMPRESSION': ''}), [])
+
+
+class TestCompression(TestCase):
+
+    def test_chunks_decompress_to_input(self):
+        chunks = list(encoding.compress_chunks([b'ANY' * 100, b'DATA'],
+                                               'gzip'))
+        self.assertTrue(all(chunks))
+        self.assertEqual(gzip.decompress(b''.join(chunks)),
+                         b'ANY' * 100 + b'DATA')
+
+    def test_dumps_falls_back_for_big_integers(self):
+        self.assertEqual(encoding.dumps([2 ** 70]),
+                         b'[1180591620717411303424]')
+
+
+class TestLoads(TestCase):
+
+    def test_non_finite_constants_are_rejected(self):
+        for orjson in [encoding.orjson, None]:
+            with mock.patch.object(encoding, 'orjson', orjson):
+                with self.assertRaises(ValueError):
+                    encoding.loads('[NaN]')
+                with self.assertRaises(ValueError):
+                    encoding.loads('{"a": -Infinity}')
@@ -0,0 +1,83 @@
+from unittest import TestCase
+import queue
+
+from beehaiv import events
+
+
+class TestSubscription(TestCase):
+
+    def test_overflow_is_replaced_by_resync(self):
+        subscription = events.Subscription(1, maxsize=2)
+        subscription.put([(1, 'A'), (2, 'B'), (3, 'C')])
+        self.assertIs(subscription.get(0), events.RESYNC)
+        subscription.put([(4, 'D')])
+        self.assertEqual(subscription.get(0), (4, 'D'))
+
+    def test_close_wakes_up_reader(self):
+        subscription = events.Subscription(1)
+        subscription.put([(1, 'A')])
+        subscription.close()
+        self.assertIsNone(subscription.get(0))
+
+
+class TestHub(TestCase):
+
+    def setUp(self):
+        self.hub = events.Hub()
+
+    def test_publish_reaches_subscribers_of_experiment(self):
+        first = self.hub.subscribe(1)
+        other = self.hub.subscribe(2)
+        self.hub.publish(1, [(1, 'A')])
+        self.assertEqual(first.get(0), (1, 'A'))
+        with self.assertRaises(queue.Empty):
+            other.get(0)
+
+    def test_unsubscribe(self):
+        subscription = self.hub.subscribe(1)
+        self.hub.unsubscribe(subscription)
+        self.assertFalse(self.hub.has_subscribers(1))
+
+
+class TestSSE(TestCase):
+
+    def setUp(self):
+        self.subscription = events.hub.subscribe(1)
+        self.stored = [(1, {'id': 1}), (2, {'id': 2}), (3, {'id': 3})]
+        self.queries = []
+
+    def changes(self, since):
+        self.queries.append(since)
+        return [(seq, trial) for seq, trial in self.stored if seq > since]
+
+    def stream(self, since=0):
+        self.subscription.queue.put_nowait(None)
+        return b''.join(events.sse(self.subscription, self.changes, since,
+                                   heartbeat=0))
+
+    def event_ids(self, data):
+        return [int(line[4:]) for line in data.splitlines()
+                if line.startswith(b'id: ')]
+
+    def test_backlog_then_live_events(self):
+        self.stored = self.stored[:2]
+        self.subscription.put([(2, {'id': 2}), (3, {'id': 3})])
+        data = self.stream(since=1)
+        self.assertEqual(self.event_ids(data), [2, 3])
+        self.assertIn(b'data: {"id":3}', data)
+
+    def test_skipped_sequence_number_catches_up(self):
+        self.subscription.put([(3, {'id': 3})])
+        self.stored = self.stored[:1]
+        data = b''
+        stream = events.sse(self.subscription, self.changes, 0, heartbeat=0)
+        data += next(stream) + next(stream)
+        self.stored.extend([(2, {'id': 2}), (3, {'id': 3})])
+        self.subscription.queue.put_nowait(None)
+        data += b''.join(stream)
+        self.assertEqual(self.event_ids(data), [1, 2, 3])
+        self.assertEqual(self.queries, [0, 1])
+
+    def test_end_of_stream_unsubscribes(self):
+        self.stream()
+        self.assertFalse(events.hub.has_subscribers(1))
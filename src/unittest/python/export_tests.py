@@ -0,0 +1,82 @@
+from unittest import TestCase
+import unittest
+
+from beehaiv import export
+
+
+class TestCSVChunks(TestCase):
+
+    def test_header_without_batches(self):
+        data = b''.join(export.csv_chunks(['contrast'], []))
+        self.assertEqual(data, b'id,experiment,observer,contrast\r\n')
+
+    def test_one_chunk_per_batch(self):
+        chunks = list(export.csv_chunks(
+            ['contrast'],
+            [[{'id': 1, 'experiment': 1, 'observer': 1, 'contrast': 0.5}],
+             [{'id': 2, 'experiment': 1, 'observer': 1, 'contrast': 1}]]))
+        self.assertEqual(chunks[1:], [b'1,1,1,0.5\r\n', b'2,1,1,1\r\n'])
+
+    def test_nested_values_are_json(self):
+        data = b''.join(export.csv_chunks(
+            ['value'],
+            [[{'id': 1, 'experiment': 1, 'observer': 1,
+               'value': [1, True]}]]))
+        self.assertEqual(data.splitlines()[1], b'1,1,1,"[1, true]"')
+
+    def test_booleans_are_json(self):
+        data = b''.join(export.csv_chunks(
+            ['value'],
+            [[{'id': 1, 'experiment': 1, 'observer': 1, 'value': False}]]))
+        self.assertEqual(data.splitlines()[1], b'1,1,1,false')
+
+
+@unittest.skipIf(export.pyarrow is None, 'requires pyarrow')
+class TestArrowChunks(TestCase):
+
+    def trial(self, id_, value):
+        return {'id': id_, 'experiment': 1, 'observer': 1, 'value': value}
+
+    def read(self, batches, types=None):
+        data = b''.join(export.arrow_chunks(['value'], batches,
+                                            types=types))
+        return export.pyarrow.ipc.open_stream(data).read_all()
+
+    def test_types_come_from_json_types(self):
+        table = self.read([[self.trial(1, 1), self.trial(2, 0.5)]],
+                          {'value': {'number'}})
+        self.assertEqual(table.schema.field('value').type,
+                         export.pyarrow.float64())
+        self.assertEqual(table.column('value').to_pylist(), [1.0, 0.5])
+
+    def test_mixed_values_are_exported_as_strings(self):
+        table = self.read([[self.trial(1, 0.5)], [self.trial(2, 'x')]],
+                          {'value': {'number', 'text'}})
+        self.assertEqual(table.column('value').to_pylist(), ['0.5', 'x'])
+
+    def test_value_of_other_type_fails(self):
+        with self.assertRaises(export.ExportError):
+            self.read([[self.trial(1, 'x')]], {'value': {'number'}})
+
+    def test_failed_stream_is_unreadable(self):
+        for file_format in ['arrow', 'parquet']:
+            chunks = []
+            with self.assertRaises(export.ExportError):
+                for chunk in export.arrow_chunks(
+                        ['value'],
+                        [[self.trial(1, 0.5)], [self.trial(2, 'x')]],
+                        file_format, {'value': {'number'}}):
+                    chunks.append(chunk)
+            self.assertTrue(chunks)
+            data = export.pyarrow.BufferReader(b''.join(chunks))
+            with self.assertRaises(export.pyarrow.ArrowInvalid):
+                if file_format == 'parquet':
+                    export.pyarrow.parquet.read_table(data)
+                else:
+                    export.pyarrow.ipc.open_stream(data).read_all()
+
+    def test_empty_export_has_schema(self):
+        table = self.read([])
+        self.assertEqual(table.num_rows, 0)
+        self.assertEqual(table.column_names,
+                         ['id', 'experiment', 'observer', 'value'])
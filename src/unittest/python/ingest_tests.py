@@ -0,0 +1,39 @@
+from unittest import TestCase, mock
+
+from beehaiv import ingest
+
+
+class TestTrialWriter(TestCase):
+
+    def setUp(self):
+        self.writer = ingest.TrialWriter(batch_size=3, flush_interval=0)
+
+    def test_next_batch_stops_at_batch_size(self):
+        for _ in range(3):
+            self.writer.submit(1, 1, [['ANY'], ['ANY']])
+        self.assertEqual(len(self.writer.next_batch()), 2)
+        self.assertEqual(len(self.writer.next_batch()), 1)
+        self.assertEqual(self.writer.next_batch(), [])
+
+    def test_submit_returns_one_id_per_trial(self):
+        ids = self.writer.submit(1, 1, [['ANY'], ['ANY']])
+        self.assertEqual(len(set(ids)), 2)
+
+    def test_submit_uses_idempotency_keys_as_ids(self):
+        ids = self.writer.submit(1, 1, [['ANY'], ['ANY']], ['ANY_KEY', None])
+        self.assertEqual(ids[0], 'ANY_KEY')
+        self.assertNotEqual(ids[1], 'ANY_KEY')
+
+    def test_failed_group_commit_is_retried_per_request(self):
+        self.writer.insert = mock.Mock(side_effect=[Exception, [], []])
+        self.writer.write(['FIRST', 'SECOND'])
+        self.assertEqual(self.writer.insert.call_args_list[1:],
+                         [mock.call(['FIRST']), mock.call(['SECOND'])])
+
+    def test_stop_drains_queue(self):
+        self.writer.insert = mock.Mock(return_value=[])
+        self.writer.submit(1, 1, [['ANY']])
+        self.writer.start()
+        self.writer.stop()
+        self.assertTrue(self.writer.queue.empty())
+        self.writer.insert.assert_called_once()
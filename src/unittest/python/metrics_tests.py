@@ -0,0 +1,113 @@
+from unittest import TestCase, mock
+
+from pony import orm
+
+from beehaiv import metrics
+
+
+class TestRequestTimer(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.timer = metrics.RequestTimer(clock=lambda: self.now)
+
+    def test_phases_accumulate(self):
+        for _ in range(2):
+            self.timer.enter('db')
+            self.now += 1
+            self.timer.exit()
+        self.assertEqual(self.timer.phases['db'], 2)
+
+    def test_nested_phase_is_not_counted_twice(self):
+        self.timer.enter('auth')
+        self.now += 1
+        self.timer.enter('db')
+        self.now += 2
+        self.timer.exit()
+        self.now += 3
+        self.timer.exit()
+        self.assertEqual(self.timer.phases['auth'], 4)
+        self.assertEqual(self.timer.phases['db'], 2)
+
+    def test_phase_without_request_does_nothing(self):
+        metrics.end()
+        with metrics.phase('db'):
+            pass
+        self.assertIsNone(metrics.current())
+
+    def test_server_timing(self):
+        self.timer.phases['db'] = 0.0015
+        self.now = 0.003
+        self.assertEqual(metrics.server_timing(self.timer),
+                         'auth;dur=0.00, db;dur=1.50, serialize;dur=0.00, '
+                         'total;dur=3.00')
+
+
+class TestRegistry(TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        timer = metrics.RequestTimer(clock=lambda: 0.02)
+        timer.start = 0
+        timer.queries = 3
+        self.registry.observe('GET', '/v{api_version}/token/', '200', timer)
+        self.text = self.registry.render().decode('utf8')
+
+    def test_requests_are_counted(self):
+        self.assertIn('beehaiv_requests_total{method="GET",'
+                      'route="/v{api_version}/token/",status="200"} 1\n',
+                      self.text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        labels = 'method="GET",route="/v{api_version}/token/"'
+        self.assertIn('beehaiv_request_duration_seconds_bucket{'
+                      + labels + ',le="0.01"} 0\n', self.text)
+        self.assertIn('beehaiv_request_duration_seconds_bucket{'
+                      + labels + ',le="0.025"} 1\n', self.text)
+        self.assertIn('beehaiv_request_duration_seconds_bucket{'
+                      + labels + ',le="+Inf"} 1\n', self.text)
+        self.assertIn('beehaiv_request_queries_sum{' + labels + '} 3.0\n',
+                      self.text)
+
+    def test_every_phase_is_reported(self):
+        for phase in metrics.PHASES:
+            self.assertIn('phase="{}"'.format(phase), self.text)
+
+    def test_label_values_are_escaped(self):
+        self.assertEqual(metrics.escape('a"b\\c\nd'), 'a\\"b\\\\c\\nd')
+
+
+class TestQueryDiagnostics(TestCase):
+
+    def setUp(self):
+        self.db = orm.Database()
+        self.db.bind(provider='sqlite', filename=':memory:')
+        metrics.instrument(self.db)
+
+    def test_statements_are_counted(self):
+        timer = metrics.begin()
+        with orm.db_session():
+            self.db.select('1')
+            self.db.select('2')
+        metrics.end()
+        self.assertEqual(timer.queries, 2)
+
+    def test_slow_statements_are_logged(self):
+        with mock.patch.object(metrics, 'SLOW_QUERY_MS', 1e-9), \
+                self.assertLogs('beehaiv.metrics') as logs:
+            with orm.db_session():
+                self.db.select('42')
+        self.assertIn('select 42', logs.output[0])
+
+    def test_query_budget_fails_on_excess_queries(self):
+        timer = metrics.RequestTimer()
+        timer.queries = 3
+        with self.assertRaises(metrics.QueryBudgetExceeded):
+            with metrics.query_budget(2):
+                metrics.check_budget(timer)
+
+    def test_query_budget_passes_within_limit(self):
+        timer = metrics.RequestTimer()
+        timer.queries = 2
+        with metrics.query_budget(2):
+            metrics.check_budget(timer)
@@ -0,0 +1,93 @@
+from unittest import TestCase
+from pony import orm
+
+from beehaiv import migrations
+
+
+class TestUpgrade(TestCase):
+
+    def setUp(self):
+        self.db = orm.Database()
+        self.db.bind(provider='sqlite', filename=':memory:')
+        with orm.db_session():
+            self.db.execute('CREATE TABLE "Trial" ('
+                            '"id" INTEGER PRIMARY KEY AUTOINCREMENT, '
+                            '"experiment" INTEGER NOT NULL, '
+                            '"observer" INTEGER NOT NULL, '
+                            '"trial_data" TEXT NOT NULL)')
+            self.db.execute("INSERT INTO \"Trial\" VALUES (1, 1, 1, 'a,1')")
+            self.db.execute('CREATE TABLE "State" ('
+                            '"id" INTEGER PRIMARY KEY AUTOINCREMENT, '
+                            '"experiment" INTEGER NOT NULL, '
+                            '"observer" INTEGER NOT NULL, '
+                            '"state_json" TEXT NOT NULL)')
+            self.db.execute('INSERT INTO "State" VALUES '
+                            "(1, 1, 1, '\"OLD\"'), (2, 1, 1, '\"NEW\"')")
+
+    def test_trial_data_is_split_into_json(self):
+        migrations.upgrade(self.db)
+        with orm.db_session():
+            self.assertSetEqual(migrations.columns(self.db, 'Trial'),
+                                {'id', 'experiment', 'observer', 'data',
+                                 'seq', 'key'})
+            self.assertEqual(self.db.select('"data" FROM "Trial"'),
+                             ['["a", 1]'])
+
+    def test_only_exact_numbers_are_typed(self):
+        self.assertEqual(
+            [migrations.typed_value(text) for text in
+             ['1', '-2', '0.5', '1.0', '01', '1e3', 'nan', 'inf', ' 1', '']],
+            [1, -2, 0.5, 1.0, '01', '1e3', 'nan', 'inf', ' 1', ''])
+
+    def test_upgrade_twice_does_nothing(self):
+        migrations.upgrade(self.db)
+        migrations.upgrade(self.db)
+        with orm.db_session():
+            self.assertEqual(self.db.select('"data" FROM "Trial"'),
+                             ['["a", 1]'])
+
+    def test_trial_indexes_are_created(self):
+        migrations.upgrade(self.db)
+        with orm.db_session():
+            indexes = self.db.select('name FROM pragma_index_list(\'Trial\')')
+        self.assertTrue({'idx_trial__experiment_id',
+                         'idx_trial__experiment_seq',
+                         'idx_trial__observer'}.issubset(indexes))
+
+    def test_trial_keys_are_unique_per_observer(self):
+        migrations.upgrade(self.db)
+        with orm.db_session():
+            self.db.execute('CREATE UNIQUE INDEX "unq_trial__experiment_key" '
+                            'ON "Trial" ("experiment", "key")')
+        migrations.upgrade(self.db)
+        with orm.db_session():
+            indexes = self.db.select('name FROM pragma_index_list(\'Trial\')')
+        self.assertIn('unq_trial__experiment_observer_key', indexes)
+        self.assertNotIn('unq_trial__experiment_key', indexes)
+
+    def test_change_sequence_starts_after_existing_trials(self):
+        with orm.db_session():
+            self.db.execute('CREATE TABLE "Experiment" ('
+                            '"id" INTEGER PRIMARY KEY AUTOINCREMENT)')
+            self.db.execute('INSERT INTO "Experiment" VALUES (1), (2)')
+        migrations.upgrade(self.db)
+        with orm.db_session():
+            self.assertEqual(self.db.select('"seq" FROM "Trial"'), [1])
+            self.assertEqual(self.db.select('"version" FROM "Experiment" '
+                                            'ORDER BY "id"'), [1, 0])
+
+    def test_duplicate_states_are_dropped_before_adding_key(self):
+        migrations.upgrade(self.db)
+        with orm.db_session():
+            self.assertEqual(self.db.select('state_json FROM "State"'),
+                             ['"NEW"'])
+            with self.assertRaises(orm.IntegrityError):
+                self.db.execute('INSERT INTO "State" '
+                                '("id", "experiment", "observer", '
+                                '"state_json") '
+                                "VALUES (3, 1, 1, '\"ANY\"')")
+
+    def test_states_get_a_version(self):
+        migrations.upgrade(self.db)
+        with orm.db_session():
+            self.assertEqual(self.db.select('"version" FROM "State"'), [1])
@@ -0,0 +1,71 @@
+from unittest import TestCase
+
+from beehaiv import patch
+
+
+class TestMergePatch(TestCase):
+
+    def test_rfc7386_example(self):
+        target = {'title': 'Goodbye!',
+                  'author': {'givenName': 'John', 'familyName': 'Doe'},
+                  'tags': ['example', 'sample'],
+                  'content': 'This will be unchanged'}
+        result = patch.merge_patch(target, {
+            'title': 'Hello!',
+            'phoneNumber': '+01-123-456-7890',
+            'author': {'familyName': None},
+            'tags': ['example']})
+        self.assertEqual(result, {'title': 'Hello!',
+                                  'author': {'givenName': 'John'},
+                                  'tags': ['example'],
+                                  'content': 'This will be unchanged',
+                                  'phoneNumber': '+01-123-456-7890'})
+
+    def test_non_object_patch_replaces_target(self):
+        self.assertEqual(patch.merge_patch({'a': 1}, [1]), [1])
+
+
+class TestJSONPatch(TestCase):
+
+    def test_operations(self):
+        document = {'a': {'b': [1, 2]}, 'c': 1}
+        result = patch.json_patch(document, [
+            {'op': 'add', 'path': '/a/b/1', 'value': 5},
+            {'op': 'remove', 'path': '/c'},
+            {'op': 'copy', 'from': '/a/b', 'path': '/d'},
+            {'op': 'move', 'from': '/a/b/0', 'path': '/e'},
+            {'op': 'replace', 'path': '/a/b/1', 'value': 0},
+            {'op': 'test', 'path': '/e', 'value': 1}])
+        self.assertEqual(result, {'a': {'b': [5, 0]}, 'd': [1, 5, 2], 'e': 1})
+        self.assertEqual(document, {'a': {'b': [1, 2]}, 'c': 1})
+
+    def test_escaped_pointer(self):
+        self.assertEqual(patch.json_patch({'a/b': 1, 'm~n': 2}, [
+            {'op': 'remove', 'path': '/a~1b'},
+            {'op': 'remove', 'path': '/m~0n'}]), {})
+
+    def test_failed_test(self):
+        with self.assertRaises(patch.PatchError):
+            patch.json_patch({'a': 1}, [{'op': 'test', 'path': '/a',
+                                         'value': 2}])
+
+    def test_test_compares_types(self):
+        for value, other in [(1, True), (0, False), ('1', 1), (None, 0),
+                             ([1], [True]), ({'b': 0}, {'b': False})]:
+            with self.assertRaises(patch.PatchError):
+                patch.json_patch({'a': value}, [{'op': 'test', 'path': '/a',
+                                                 'value': other}])
+
+    def test_test_compares_numbers_by_value(self):
+        self.assertEqual(patch.json_patch({'a': [1, {'b': 2.0}]}, [
+            {'op': 'test', 'path': '/a', 'value': [1.0, {'b': 2}]}]),
+            {'a': [1, {'b': 2.0}]})
+
+    def test_missing_path(self):
+        with self.assertRaises(patch.PatchError):
+            patch.json_patch({}, [{'op': 'replace', 'path': '/a',
+                                   'value': 2}])
+
+    def test_malformed_operation(self):
+        with self.assertRaises(patch.PatchError):
+            patch.json_patch({}, [{'op': 'add'}])
@@ -0,0 +1,32 @@
+from unittest import TestCase
+import json
+
+from beehaiv import streaming
+
+
+class TestStream(TestCase):
+
+    def test_read_returns_chunks_then_empty(self):
+        stream = streaming.Stream([b'ANY', b'CHUNK'])
+        self.assertEqual(stream.read(), b'ANY')
+        self.assertEqual(stream.read(), b'CHUNK')
+        self.assertEqual(stream.read(), b'')
+
+
+class TestJSONArray(TestCase):
+
+    def test_no_batches_give_empty_array(self):
+        self.assertEqual(b''.join(streaming.json_array([])), b'[]')
+
+    def test_batches_are_joined_into_one_array(self):
+        data = b''.join(streaming.json_array([[{'id': 1}], [{'id': 2}]]))
+        self.assertEqual(json.loads(data.decode('utf8')),
+                         [{'id': 1}, {'id': 2}])
+
+
+class TestNDJSONLines(TestCase):
+
+    def test_one_line_per_item(self):
+        data = b''.join(streaming.ndjson_lines([[{'id': 1}, {'id': 2}]]))
+        self.assertEqual([json.loads(line) for line in data.splitlines()],
+                         [{'id': 1}, {'id': 2}])